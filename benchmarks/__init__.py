@@ -0,0 +1,3 @@
+"""
+Benchmarks for pyafl_qemu_trace
+"""
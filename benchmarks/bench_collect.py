@@ -0,0 +1,112 @@
+"""
+Benchmark collecting a log from a pipe as a function of its size
+
+Run with `python -m benchmarks.bench_collect [--sizes MB ...]`. A synthetic log is
+written into a pipe by a thread while it is collected by appending each chunk to
+`bytes` (what `TraceRunner.run` used to do, which is quadratic), by growing a
+`bytearray` that chunks are read into in place, and with the `LogBuffer`
+`TraceRunner.run` reads logs into.
+"""
+
+from argparse import ArgumentParser
+from functools import partial
+from os import close, pipe, read, readv, write
+from threading import Thread
+from typing import Callable
+
+from benchmarks.common import synthetic_log, timeit
+from pyafl_qemu_trace.run.process import LogBuffer, grow_pipe
+
+CHUNK_SIZE = 1 << 20
+
+
+def concat(fd: int) -> bytes:
+    """
+    Collect by appending each chunk to `bytes`
+    """
+    data = b""
+    chunk = read(fd, CHUNK_SIZE)
+    while chunk:
+        data += chunk
+        chunk = read(fd, CHUNK_SIZE)
+    return data
+
+
+def grow(fd: int) -> bytearray:
+    """
+    Collect by reading into a doubling `bytearray` in place
+    """
+    buf = bytearray(CHUNK_SIZE)
+    length = 0
+    while True:
+        if len(buf) - length < CHUNK_SIZE:
+            buf += bytes(len(buf))
+        with memoryview(buf) as view:
+            count = readv(fd, [view[length : length + CHUNK_SIZE]])
+        if not count:
+            del buf[length:]
+            return buf
+        length += count
+
+
+def log_buffer(fd: int) -> bytes:
+    """
+    Collect with a `LogBuffer`
+    """
+    buf = LogBuffer()
+    while buf.readfrom(fd, CHUNK_SIZE):
+        pass
+    return buf.getvalue()  # type: ignore
+
+
+def through_pipe(log: bytes, collect: Callable[[int], object]) -> object:
+    """
+    Write a log into a pipe from a thread while collecting it from the other end
+    """
+    rfd, wfd = pipe()
+    grow_pipe(rfd)
+
+    def writer() -> None:
+        view = memoryview(log)
+        while view:
+            view = view[write(wfd, view[:CHUNK_SIZE]) :]
+        close(wfd)
+
+    thread = Thread(target=writer)
+    thread.start()
+    try:
+        return collect(rfd)
+    finally:
+        thread.join()
+        close(rfd)
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="*", default=[16, 64, 256])
+    parser.add_argument(
+        "--max-concat", type=int, default=64, help="largest size to time concat on"
+    )
+    args = parser.parse_args()
+
+    base = synthetic_log(100000)
+    for size in args.sizes:
+        log = (base * (size * 2**20 // len(base) + 1))[: size * 2**20]
+        collectors = {"bytearray": grow, "LogBuffer": log_buffer}
+        if size <= args.max_concat:
+            collectors = {"concat": concat, **collectors}
+
+        for name, collect in collectors.items():
+            elapsed, res = timeit(partial(through_pipe, log, collect))
+            assert len(res) == len(log)  # type: ignore
+            print(
+                f"{size} MB {name}: {elapsed:.3f}s "
+                f"({len(log) / elapsed / 1e6:.0f} MB/s)"
+            )
+
+
+if __name__ == "__main__":
+    main()
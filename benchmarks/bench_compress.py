@@ -0,0 +1,104 @@
+"""
+Benchmark capturing and parsing compressed logs
+
+Run with `python -m benchmarks.bench_compress [--blocks N] [--runs N]`. A synthetic
+log is written through `LogWriter` with each available compression and parsed back
+from the file, which is compared to parsing it from memory. If the x86_64 tracer is
+built, the `xxd` test binary is also traced and parsed end to end with the log
+collected in memory and with it compressed to a file.
+"""
+
+from argparse import ArgumentParser
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Optional
+
+from benchmarks.common import synthetic_log, timeit
+from pyafl_qemu_trace import TraceParser, TraceRunner, qemu_list
+from pyafl_qemu_trace.parse.compressed import LogWriter
+from pyafl_qemu_trace.run import LogFile
+
+XXD = Path(__file__).parent.parent / "test" / "binaries" / "xxd"
+INPUT = b"\x41" * 400
+
+# Size of the chunks the synthetic log is written in, like the runner's reads
+CHUNK_SIZE = 1 << 20
+
+
+def write(path: Path, log: bytes) -> LogWriter:
+    """
+    Write a log through a `LogWriter` in chunks
+    """
+    writer = LogWriter(path)
+    for pos in range(0, len(log), CHUNK_SIZE):
+        writer(log[pos : pos + CHUNK_SIZE])
+    writer.close()
+    return writer
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=2_000_000)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    log = synthetic_log(args.blocks)
+    size = len(log) / 1e6
+    elapsed, _ = timeit(lambda: TraceParser.parse(log), 1)
+    print(f"in memory: {size:.1f} MB, parse {elapsed:.2f} s")
+
+    with TemporaryDirectory() as tmpdir:
+        for suffix in (".log", ".gz", ".zst", ".lz4"):
+            path = Path(tmpdir) / f"trace{suffix}"
+            try:
+                elapsed, _ = timeit(partial(write, path, log), 1)
+            except ValueError as exc:
+                print(f"{suffix}: skipped ({exc})")
+                continue
+            parsed, _ = timeit(partial(TraceParser.parse, path), 1)
+            stored = path.stat().st_size / 1e6
+            print(
+                f"{suffix}: {stored:.1f} MB ({size / stored:.1f}x), write "
+                f"{size / elapsed:.0f} MB/s, parse {parsed:.2f} s"
+            )
+
+        if "x86_64" not in qemu_list():
+            print("x86_64 tracer not built, skipping end to end runs")
+            return
+
+        def trace(log_file: Optional[Path] = None) -> None:
+            """
+            Trace xxd and parse its log, from memory or from `log_file`
+            """
+            for _ in range(args.runs):
+                _, _, _, traced = TraceRunner.run(
+                    "x86_64",
+                    str(XXD),
+                    input_data=INPUT,
+                    timeout=30,
+                    log_sink=None if log_file is None else LogFile(log_file),
+                )
+                TraceParser.parse(traced)
+
+        floor, _ = timeit(trace)
+        print(f"trace+parse in memory: {floor / args.runs * 1e3:.1f} ms/trace")
+
+        for suffix in (".gz", ".zst", ".lz4"):
+            path = Path(tmpdir) / f"xxd{suffix}"
+            try:
+                elapsed, _ = timeit(partial(trace, path))
+            except ValueError as exc:
+                print(f"trace+parse {suffix}: skipped ({exc})")
+                continue
+            print(
+                f"trace+parse {suffix}: {elapsed / args.runs * 1e3:.1f} ms/trace "
+                f"({path.stat().st_size / 1e6:.1f} MB per log)"
+            )
+
+
+if __name__ == "__main__":
+    main()
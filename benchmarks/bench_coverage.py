@@ -0,0 +1,75 @@
+"""
+Benchmark edge coverage extraction and corpus-wide coverage operations
+
+Run with `python -m benchmarks.bench_coverage [--traces N] [--blocks N]`. A corpus of
+synthetic logs is reduced to edge coverage maps with `TraceParser.coverage`, which is
+compared to parsing each log into a full `TraceResult`, and then the maps are merged
+and checked for novelty against the coverage seen so far the way a fuzzer triages
+its queue.
+"""
+
+from argparse import ArgumentParser
+from time import perf_counter
+
+from benchmarks.common import synthetic_log, timeit
+from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace.parse import CoverageMap, vectorized
+from pyafl_qemu_trace.parse.coverage import NOTHING_NEW
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--traces", type=int, default=200)
+    parser.add_argument("--blocks", type=int, default=20000)
+    args = parser.parse_args()
+
+    logs = [synthetic_log(args.blocks, seed=seed) for seed in range(args.traces)]
+    size = sum(map(len, logs))
+
+    backends = [False]
+    if vectorized.available():
+        backends.append(True)
+
+    for vectorize in backends:
+        name = "numpy" if vectorize else "regex"
+        elapsed, _ = timeit(
+            lambda vectorize=vectorize: [
+                TraceParser.parse(log, vectorize=vectorize) for log in logs
+            ],
+            1,
+        )
+        print(f"parse ({name}): {args.traces / elapsed:.1f} traces/s")
+        elapsed, maps = timeit(
+            lambda vectorize=vectorize: [
+                TraceParser.coverage(log, vectorize=vectorize) for log in logs
+            ],
+            1,
+        )
+        print(
+            f"coverage ({name}): {args.traces / elapsed:.1f} traces/s "
+            f"({size / elapsed / 1e6:.1f} MB/s)"
+        )
+
+    start = perf_counter()
+    seen = CoverageMap.empty()
+    interesting = 0
+    for cov in maps:  # type: ignore
+        if cov.new(seen) != NOTHING_NEW:
+            interesting += 1
+            seen |= cov
+    elapsed = perf_counter() - start
+    print(
+        f"triage: {interesting}/{args.traces} interesting, {seen.edges} edges in "
+        f"{elapsed * 1e3:.1f} ms ({elapsed / args.traces * 1e6:.0f} us/map)"
+    )
+
+    elapsed, union = timeit(lambda: CoverageMap.union(maps))  # type: ignore
+    assert union == seen
+    print(f"union: {args.traces} maps in {elapsed * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark comparing the traces of different inputs
+
+Run with `python -m benchmarks.bench_diff [--blocks N]`. A synthetic trace is
+compared with a copy that has a few blocks removed and a few others inserted, with
+each available backend, and aligning a small prefix of both is compared to aligning
+it with `difflib` alone.
+"""
+
+from argparse import ArgumentParser
+from array import array
+from difflib import SequenceMatcher
+from functools import partial
+from random import Random
+
+from benchmarks.common import synthetic_log, timeit
+from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace.parse import vectorized
+from pyafl_qemu_trace.parse.diff import align, first_divergence
+
+# Length of the prefix aligned with difflib alone
+DIFFLIB_LENGTH = 20_000
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    a = TraceParser.parse(synthetic_log(args.blocks), vectorize=True).addrs
+    rng = Random(0)
+    b = array(a.typecode, a)
+    for pos in sorted((rng.randrange(len(b)) for _ in range(10)), reverse=True):
+        b[pos : pos + rng.randrange(100)] = array(a.typecode, a[: rng.randrange(100)])
+    print(f"{len(a)} and {len(b)} blocks")
+
+    for vectorize in (False, True) if vectorized.available() else (False,):
+        name = "numpy" if vectorize else "python"
+        first, divergence = timeit(partial(first_divergence, a, b, vectorize))
+        elapsed, regions = timeit(partial(align, a, b, vectorize=vectorize), 1)
+        print(
+            f"{name}: first divergence at {divergence} in {first * 1e3:.1f} ms, "
+            f"{len(regions)} regions in {elapsed:.2f} s"
+        )
+
+    length = min(DIFFLIB_LENGTH, len(b))
+    x, y = a[:length].tolist(), b[:length].tolist()
+    elapsed, _ = timeit(
+        lambda: SequenceMatcher(None, x, y, autojunk=False).get_opcodes(), 1
+    )
+    aligned, _ = timeit(partial(align, a[:length], b[:length]), 1)
+    print(
+        f"first {length} blocks: difflib {elapsed:.2f} s, align {aligned * 1e3:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
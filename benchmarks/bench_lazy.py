@@ -0,0 +1,59 @@
+"""
+Benchmark lazily decoded maps and syscalls against decoding them while parsing
+
+Run with `python -m benchmarks.bench_lazy [--blocks N] [--syscall-every N]`. A
+synthetic log dense with syscalls is parsed eagerly and with
+`TraceParser.parse_lazy`, and the parse time and the memory held by the result (not
+counting the log) are compared, along with the cost of then looking at every
+syscall.
+"""
+
+from argparse import ArgumentParser
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+
+from benchmarks.common import synthetic_log
+from pyafl_qemu_trace import TraceParser
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=2_000_000)
+    parser.add_argument("--syscall-every", type=int, default=4)
+    args = parser.parse_args()
+
+    log = synthetic_log(args.blocks, syscall_every=args.syscall_every)
+    print(f"{len(log) / 1e6:.1f} MB log")
+
+    for lazy in (False, True):
+        name = "lazy" if lazy else "eager"
+        parse = TraceParser.parse_lazy if lazy else TraceParser.parse
+
+        began = perf_counter()
+        res = parse(log)
+        elapsed = perf_counter() - began
+        began = perf_counter()
+        touched = sum(1 for _ in res.syscalls.values())
+        touch = perf_counter() - began
+        del res
+
+        # Measure the result on its own, since tracing allocations slows everything
+        start()
+        res = parse(log)
+        size, _ = get_traced_memory()
+        sum(1 for _ in res.syscalls.values())
+        full, _ = get_traced_memory()
+        stop()
+
+        print(
+            f"{name}: parse {elapsed:.2f} s, {len(res.syscalls)} syscalls and "
+            f"{len(res.maps)} dumps in {size / 1e6:.1f} MB, decoding all {touched} "
+            f"took {touch:.2f} s ({full / 1e6:.1f} MB after)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark classifying the addresses of a long trace by memory mapping
+
+Run with `python -m benchmarks.bench_maps [--blocks N] [--snapshots N]`. A trace of
+synthetic addresses spread over the mappings of a process with shared libraries is
+classified with `MapIndex` on each backend, and compared to looking up each address
+in its snapshot with a Python loop, which is timed on a sample and extrapolated.
+"""
+
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_right
+from functools import partial
+from random import Random
+from time import perf_counter
+from typing import Dict, Set
+
+from benchmarks.common import timeit
+from pyafl_qemu_trace.parse import MapIndex, vectorized
+from pyafl_qemu_trace.parse.parse import MMap
+
+# Number of addresses the Python loop is timed on
+LOOP_SAMPLE = 1_000_000
+
+
+def synthetic_maps(snapshots: int, blocks: int, rng: Random) -> Dict[int, Set[MMap]]:
+    """
+    Generate memory map snapshots of a binary and 12 libraries, plus an anonymous
+    region that moves between snapshots
+    """
+    base = [
+        MMap(start + off, start + off + size, size, prot)
+        for start in [0x555555554000]
+        + [0x7FFFF7000000 + i * 0x400000 for i in range(12)]
+        for off, size, prot in ((0, 0x2000, "r-x"), (0x200000, 0x2000, "rw-"))
+    ]
+    maps = {}
+    for key in sorted(rng.sample(range(blocks), snapshots - 1)) + [-1]:
+        anon = 0x7FFFF7FF0000 - rng.randrange(64) * 0x1000
+        maps[key] = set(base) | {MMap(anon, anon + 0x1000, 0x1000, "rw-")}
+    return maps
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=20_000_000)
+    parser.add_argument("--snapshots", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = Random(0)
+    maps = synthetic_maps(args.snapshots, args.blocks, rng)
+    pool = array(
+        "Q",
+        [
+            mmap.start + rng.randrange(0, mmap.size, 16)
+            for mmap in maps[-1]
+            if "x" in mmap.prot
+            for _ in range(500)
+        ],
+    )
+    addrs = array("Q", (pool[rng.randrange(len(pool))] for _ in range(1 << 16)))
+    addrs *= -(-args.blocks // len(addrs))
+    del addrs[args.blocks :]
+
+    index = MapIndex(maps)
+    backends = [False]
+    if vectorized.available():
+        backends.append(True)
+    for vectorize in backends:
+        name = "numpy" if vectorize else "python"
+        elapsed, ids = timeit(partial(index.classify, addrs, vectorize), 1)
+        print(
+            f"classify ({name}): {args.blocks / elapsed / 1e6:.1f}M addrs/s, "
+            f"{args.blocks} addrs in {elapsed:.2f} s"
+        )
+        elapsed, _ = timeit(partial(index.rebase, addrs, vectorize), 1)
+        print(f"rebase ({name}): {args.blocks / elapsed / 1e6:.1f}M addrs/s")
+
+    # Look each address up in the sorted mappings of its snapshot, one at a time
+    keys = sorted(maps)
+    snapshots = [sorted(maps[key], key=lambda mmap: mmap.start) for key in keys]
+    firsts = [key + 1 for key in keys]
+    starts = [[mmap.start for mmap in snap] for snap in snapshots]
+    sample = min(LOOP_SAMPLE, args.blocks)
+    start = perf_counter()
+    found = []
+    for pos in range(sample):
+        snap = bisect_right(firsts, pos) - 1
+        addr = addrs[pos]
+        mmap = snapshots[snap][bisect_right(starts[snap], addr) - 1]
+        found.append(mmap if addr < mmap.end else None)
+    elapsed = (perf_counter() - start) * args.blocks / sample
+    assert [index.ids[mmap] for mmap in found] == list(ids[:sample])  # type: ignore
+    print(f"per-address loop: {args.blocks / elapsed / 1e6:.1f}M addrs/s (estimated)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark `TraceParser.parse` throughput
+
+Run with `python -m benchmarks.bench_parse [LOG ...] [--records KIND ...]`. Each log
+given is parsed in turn. Without arguments the Flight_Routes test binary is traced and
+its log parsed, or a synthetic log is generated if there is no tracer for this
+machine (or with `--synthetic`). Each
+`--records` selection (such as `ADDRS` or `SYSCALLS,MAPS`) is timed separately, by
+default every record and only the addresses.
+"""
+
+from argparse import ArgumentParser
+from functools import partial, reduce
+from operator import or_
+from pathlib import Path
+from sys import stderr
+
+from benchmarks.common import TARGETS, recorded_logs, synthetic_log, timeit
+from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace.parse import Records, vectorized
+
+
+# Single kinds of records, to report selections by name
+KINDS = (Records.ADDRS, Records.MAPS, Records.SYSCALLS, Records.MAPPING, Records.TBS)
+
+
+def records_arg(value: str) -> Records:
+    """
+    Parse a comma separated list of record kinds
+    """
+    return reduce(or_, (Records[kind.strip().upper()] for kind in value.split(",")))
+
+
+def bench(
+    name: str, log: bytes, workers: int = 1, records: Records = Records.DEFAULT
+) -> None:
+    """
+    Parse a log with each available backend and report the throughput
+
+    :param name: Name to report the log as
+    :param log: The log contents
+    :param workers: The number of processes to parse on
+    :param records: The kinds of records to parse
+    """
+    lines = log.count(b"\n")
+    backends = [False]
+    if vectorized.available():
+        backends.append(True)
+
+    for vectorize in backends:
+        elapsed, res = timeit(
+            partial(
+                TraceParser.parse_parallel,
+                log,
+                workers,
+                vectorize=vectorize,
+                records=records,
+            )
+        )
+        print(
+            f"{name} ({'numpy' if vectorize else 'regex'}, {workers} workers, "
+            f"{'|'.join(kind.name for kind in KINDS if records & kind)}): "
+            f"{lines} lines, "
+            f"{len(res.addrs)} addrs in {elapsed:.3f}s "  # type: ignore
+            f"({lines / elapsed:,.0f} lines/s, {elapsed / lines * 1e9:.0f} ns/line, "
+            f"{len(log) / elapsed / 1e6:.1f} MB/s)"
+        )
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("logs", nargs="*", type=Path)
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--blocks", type=int, default=1000000)
+    parser.add_argument("--workers", type=int, nargs="*", default=[1])
+    parser.add_argument(
+        "--records",
+        type=records_arg,
+        nargs="*",
+        default=[Records.DEFAULT, Records.ADDRS],
+    )
+    args = parser.parse_args()
+
+    logs = [(log.name, log.read_bytes()) for log in args.logs]
+    if not logs and not args.synthetic:
+        logs = recorded_logs(t for t in TARGETS if t.name == "Flight_Routes")
+        if not logs:
+            print("No tracer for Flight_Routes, using a synthetic log", file=stderr)
+    if not logs:
+        logs.append(("synthetic", synthetic_log(args.blocks)))
+
+    for name, log in logs:
+        for workers in args.workers:
+            for records in args.records:
+                bench(name, log, workers, records)
+
+
+if __name__ == "__main__":
+    main()
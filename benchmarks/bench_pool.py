@@ -0,0 +1,97 @@
+"""
+Benchmark tracing many inputs with `TraceRunner.run` and with a warm `TracerPool`
+
+Run with `python -m benchmarks.bench_pool [--inputs N] [--workers N]`. Each input of
+`test/inputs` is traced with the Flight_Routes test binary, first by starting a new
+tracer for every input, then with fork servers, and finally with a `BatchTracer`
+that also reduces every log to its edge coverage.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, List, Tuple
+
+from pyafl_qemu_trace import BatchTracer, TraceRunner, TracerPool
+from pyafl_qemu_trace.run import CoverageSink
+
+TEST_DIR = Path(__file__).parent.parent / "test"
+FLIGHT_ROUTES = TEST_DIR / "binaries" / "Flight_Routes" / "Flight_Routes"
+
+
+def bench(
+    name: str,
+    run: Callable[..., Tuple[int, bytes, bytes, bytes]],
+    inputs: List[bytes],
+    workers: int,
+) -> None:
+    """
+    Trace every input with `run` and report the executions per second
+
+    :param name: Name to report the runner as
+    :param run: `TraceRunner.run` or `TracerPool.run`
+    :param inputs: The inputs to trace
+    :param workers: The number of inputs to trace at once
+    """
+
+    def trace(input_data: bytes) -> int:
+        """
+        Trace one input and return the size of its log
+        """
+        return len(
+            run(
+                "x86_64",
+                str(FLIGHT_ROUTES),
+                cwd=str(FLIGHT_ROUTES.parent),
+                input_data=input_data,
+                timeout=30,
+                ld_library_paths=[str(FLIGHT_ROUTES.parent)],
+            )[3]
+        )
+
+    start = perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        logged = sum(executor.map(trace, inputs))
+    elapsed = perf_counter() - start
+
+    print(
+        f"{name}: {len(inputs)} inputs in {elapsed:.2f}s "
+        f"({len(inputs) / elapsed:.1f} execs/s, {logged / elapsed / 1e6:.1f} MB/s "
+        "of log)"
+    )
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--inputs", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    infiles = sorted((TEST_DIR / "inputs").iterdir())[: args.inputs]
+    inputs = [infile.read_bytes() for infile in infiles]
+
+    bench("TraceRunner.run", TraceRunner.run, inputs, args.workers)
+    with TracerPool(args.workers) as pool:
+        bench("TracerPool.run", pool.run, inputs, args.workers)
+
+    sink = CoverageSink()
+    stats = BatchTracer(
+        "x86_64",
+        str(FLIGHT_ROUTES),
+        cwd=str(FLIGHT_ROUTES.parent),
+        timeout=30,
+        ld_library_paths=[str(FLIGHT_ROUTES.parent)],
+        tracers=args.workers,
+    ).run(infiles, sink)
+    print(
+        f"BatchTracer.run: {stats.done} inputs ({stats.inputs_per_sec:.1f} inputs/s), "
+        f"{len(sink.interesting)} interesting, {sink.coverage.edges} edges"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark building and querying a `RangeMap` against inserting and looking up one
+range at a time
+
+Run with `python -m benchmarks.bench_ranges [--blocks N] [--addrs N]`. Ranges shaped
+like the basic blocks of a large binary are inserted one by one into sorted lists and
+looked up with a bisect per address, as the Binary Ninja trace viewer used to, and
+compared to building a `RangeMap` in bulk and looking up every address with
+`lookup_many`.
+"""
+
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
+from functools import partial
+from random import Random
+from typing import List, Tuple
+
+from benchmarks.common import timeit
+from pyafl_qemu_trace.parse import RangeMap, vectorized
+
+BASE = 0x555555554000
+
+
+def insert_each(ranges: List[Tuple[int, int, int]]) -> Tuple[list, list, list]:
+    """
+    Insert ranges one at a time into sorted lists of bounds and values
+    """
+    lowers: list = []
+    uppers: list = []
+    values: list = []
+    for lower, upper, value in ranges:
+        pos = bisect_left(uppers, upper)
+        uppers.insert(pos, upper)
+        lowers.insert(pos, lower)
+        values.insert(pos, value)
+    return lowers, uppers, values
+
+
+def lookup_each(lists: Tuple[list, list, list], addrs: array) -> List[int]:
+    """
+    Look up each address with a bisect
+    """
+    lowers, uppers, values = lists
+    found = []
+    for addr in addrs:
+        pos = bisect_left(uppers, addr)
+        found.append(-1 if pos >= len(values) or lowers[pos] > addr else values[pos])
+    return found
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=200_000)
+    parser.add_argument("--addrs", type=int, default=5_000_000)
+    args = parser.parse_args()
+
+    rng = Random(0)
+    ranges = []
+    start = BASE
+    for value in range(args.blocks):
+        end = start + rng.randrange(4, 64)
+        ranges.append((start, end, value))
+        start = end
+    rng.shuffle(ranges)
+    # Traces revisit a small set of blocks over and over
+    hot = [rng.randrange(BASE, start) for _ in range(20_000)]
+    addrs = array("Q", (rng.choice(hot) for _ in range(args.addrs)))
+
+    elapsed, lists = timeit(partial(insert_each, ranges), 1)
+    print(f"{args.blocks} ranges inserted one at a time in {elapsed:.2f} s")
+    elapsed, rmap = timeit(partial(RangeMap.from_ranges, ranges), 1)
+    print(f"{args.blocks} ranges built in bulk in {elapsed:.2f} s")
+
+    elapsed, _ = timeit(partial(lookup_each, lists, addrs), 1)
+    print(f"{args.addrs} addresses looked up one at a time in {elapsed:.2f} s")
+    for vectorize in (False, True) if vectorized.available() else (False,):
+        elapsed, _ = timeit(partial(rmap.lookup_many, addrs, vectorize))
+        print(
+            f"{args.addrs} addresses looked up with lookup_many"
+            f"{' (numpy)' if vectorize else ''} in {elapsed:.2f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
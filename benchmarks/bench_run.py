@@ -0,0 +1,58 @@
+"""
+Benchmark the per-trace overhead of `TraceRunner.run`
+
+Run with `python -m benchmarks.bench_run [--runs N]`. The small `xxd` test binary is
+traced repeatedly with `TraceRunner.run`, and with `subprocess.run` on the same
+tracer command line logging to a file, which is the floor the runner is measured
+against.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from subprocess import run
+from tempfile import TemporaryDirectory
+
+from benchmarks.common import timeit
+from pyafl_qemu_trace import TraceRunner
+
+XXD = Path(__file__).parent.parent / "test" / "binaries" / "xxd"
+INPUT = b"\x41" * 400
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    def runner() -> None:
+        """
+        Trace xxd with the runner
+        """
+        for _ in range(args.runs):
+            TraceRunner.run("x86_64", str(XXD), input_data=INPUT, timeout=30)
+
+    with TemporaryDirectory(dir="/dev/shm") as tmpdir:
+        command = TraceRunner.command("x86_64", str(XXD), str(Path(tmpdir) / "log"))
+
+        def direct() -> None:
+            """
+            Trace xxd with a bare subprocess call
+            """
+            for _ in range(args.runs):
+                run(command, input=INPUT, capture_output=True, timeout=30, check=True)
+
+        floor, _ = timeit(direct)
+
+    elapsed, _ = timeit(runner)
+    print(
+        f"subprocess.run: {floor / args.runs * 1e3:.2f} ms/trace\n"
+        f"TraceRunner.run: {elapsed / args.runs * 1e3:.2f} ms/trace "
+        f"({(elapsed - floor) / args.runs * 1e3:+.2f} ms/trace overhead)"
+    )
+
+
+if __name__ == "__main__":
+    main()
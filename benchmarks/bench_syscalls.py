@@ -0,0 +1,75 @@
+"""
+Benchmark storing syscalls in a `SyscallTable` against a dict of `Syscall`
+
+Run with `python -m benchmarks.bench_syscalls [--blocks N] [--syscall-every N]`. A
+synthetic log dense with syscalls is parsed both ways, and the parse time, the
+memory held by the syscalls and the time to find the failing `openat` calls
+and to count syscalls by name are compared.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+from functools import partial
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+from typing import Dict, List, Mapping
+
+from benchmarks.common import synthetic_log, timeit
+from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace.parse import Records, SyscallTable
+from pyafl_qemu_trace.parse.parse import Syscall
+
+
+def failing_opens(syscalls: Mapping[int, Syscall]) -> List[int]:
+    """
+    Find the indices of the failing `openat` calls of a dict of `Syscall`
+    """
+    return [i for i, s in syscalls.items() if s.name == "openat" and s.ret < 0]
+
+
+def histogram(syscalls: Mapping[int, Syscall]) -> Dict[str, int]:
+    """
+    Count the syscalls of a dict of `Syscall` by name
+    """
+    return Counter(s.name for s in syscalls.values())
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=2_000_000)
+    parser.add_argument("--syscall-every", type=int, default=4)
+    args = parser.parse_args()
+
+    log = synthetic_log(args.blocks, syscall_every=args.syscall_every)
+    print(f"{len(log) / 1e6:.1f} MB log")
+
+    for table in (False, True):
+        began = perf_counter()
+        res = TraceParser.parse(log, syscall_table=table)
+        elapsed = perf_counter() - began
+        if isinstance(res.syscalls, SyscallTable):
+            where, _ = timeit(partial(res.syscalls.where, "openat", failed=True))
+            count, _ = timeit(res.syscalls.histogram)
+        else:
+            where, _ = timeit(partial(failing_opens, res.syscalls))
+            count, _ = timeit(partial(histogram, res.syscalls))
+        del res
+
+        # Measure the syscalls on their own, since tracing allocations slows parsing
+        start()
+        res = TraceParser.parse(log, records=Records.SYSCALLS, syscall_table=table)
+        size, _ = get_traced_memory()
+        stop()
+
+        print(
+            f"{'table' if table else 'dict'}: parse {elapsed:.2f} s, "
+            f"{len(res.syscalls)} syscalls in {size / 1e6:.1f} MB, failing openat "
+            f"{where * 1e3:.1f} ms, histogram {count * 1e3:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
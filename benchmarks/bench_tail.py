@@ -0,0 +1,56 @@
+"""
+Benchmark keeping only the end of a trace against parsing all of it
+
+Run with `python -m benchmarks.bench_tail [--blocks N] [--length N]`. A synthetic log
+is written to a file and its last blocks are taken from a full parse and with
+`TraceParser.tail`, comparing the time and the peak memory allocated by each.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+from typing import Callable, Tuple
+
+from benchmarks.common import synthetic_log
+from pyafl_qemu_trace import TraceParser
+
+
+def measure(func: Callable[[], object]) -> Tuple[float, float]:
+    """
+    Run a function once, returning its time and the peak memory it allocated
+    """
+    began = perf_counter()
+    func()
+    elapsed = perf_counter() - began
+    # Measured separately, since tracing allocations slows parsing
+    start()
+    func()
+    _, peak = get_traced_memory()
+    stop()
+    return elapsed, peak
+
+
+def main() -> None:
+    """
+    Run the benchmark
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--blocks", type=int, default=5_000_000)
+    parser.add_argument("--length", type=int, default=4096)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        path = Path(tmp) / "trace.log"
+        path.write_bytes(synthetic_log(args.blocks))
+        print(f"{path.stat().st_size / 1e6:.1f} MB log")
+
+        elapsed, peak = measure(lambda: TraceParser.parse(path).addrs[-args.length :])
+        print(f"full parse: {elapsed:.2f} s, peak {peak / 1e6:.1f} MB")
+        elapsed, peak = measure(lambda: TraceParser.tail(path, args.length))
+        print(f"tail: {elapsed:.2f} s, peak {peak / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
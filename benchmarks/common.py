@@ -0,0 +1,146 @@
+"""
+Shared helpers for the benchmarks
+"""
+
+from pathlib import Path
+from random import Random
+from time import perf_counter
+from typing import Any, Callable, Iterable, List, NamedTuple, Tuple
+
+from pyafl_qemu_trace import TraceRunner, qemu_path
+
+BENCH_DIR = Path(__file__).parent
+TEST_DIR = BENCH_DIR.parent / "test"
+
+HEADER = (
+    b"host mmap_min_addr=0x10000\n"
+    b"guest_base  0x0\n"
+    b"start            end              size             prot\n"
+    b"0000555555554000-0000555555556000 0000000000002000 r-x\n"
+    b"0000555555756000-0000555555758000 0000000000002000 rw-\n"
+    b"00007ffff7dd3000-00007ffff7dfc000 0000000000029000 r-x\n"
+    b"start_brk   0x0000555555758000\n"
+    b"end_code    0x0000555555555c2c\n"
+    b"start_code  0x0000555555554000\n"
+    b"start_data  0x0000555555755d90\n"
+    b"end_data    0x0000555555756010\n"
+    b"start_stack 0x00007fffffffe3b0\n"
+    b"brk         0x0000555555758000\n"
+    b"entry       0x00007ffff7dd4090\n"
+    b"argv_start  0x00007fffffffe3b8\n"
+    b"env_start   0x00007fffffffe3c8\n"
+    b"auxv_start  0x00007fffffffe3d8\n"
+)
+
+
+def synthetic_log(blocks: int, syscall_every: int = 500, seed: int = 0) -> bytes:
+    """
+    Generate a log shaped like an `exec,nochain,page,strace` log of an x86_64 binary
+
+    :param blocks: The number of trace lines
+    :param syscall_every: The average number of trace lines between syscalls
+    :param seed: Seed for the generator
+    """
+    rng = Random(seed)
+    pool = [0x555555554000 + rng.randrange(0, 0x2000, 16) for _ in range(2000)] + [
+        0x7FFFF7DD3000 + rng.randrange(0, 0x29000, 16) for _ in range(6000)
+    ]
+    lines: List[bytes] = [HEADER]
+    host = 0x7FFFE8000100
+
+    for _ in range(blocks):
+        # Each block is translated once, so it always runs from the same host code
+        block = rng.randrange(len(pool))
+        lines.append(
+            b"Trace 0: 0x%x [00000000/%016x/0x40c0b3] \n"
+            % (host + block * 0x140, pool[block])
+        )
+        if rng.randrange(syscall_every) == 0:
+            if rng.randrange(4) == 0:
+                lines.append(
+                    b"12345 mmap(NULL,8192,PROT_READ|PROT_WRITE,"
+                    b"MAP_PRIVATE|MAP_ANONYMOUS,-1,0) = 0x00007ffff7ff5000\n"
+                    b"start            end              size             prot\n"
+                    b"0000555555554000-0000555555556000 0000000000002000 r-x\n"
+                    b"00007ffff7ff5000-00007ffff7ff7000 0000000000002000 rw-\n"
+                )
+            else:
+                lines.append(
+                    b'12345 openat(AT_FDCWD,"/etc/ld.so.preload",O_RDONLY|O_CLOEXEC)'
+                    b" = -1 errno=2 (No such file or directory)\n"
+                )
+
+    lines.append(b"12345 exit_group(0)\n")
+    return b"".join(lines)
+
+
+def timeit(func: Callable[[], object], repeat: int = 3) -> Tuple[float, object]:
+    """
+    Time a function, returning the best wall-clock time of `repeat` runs and the
+    result of the last run
+
+    :param func: The function to time
+    :param repeat: The number of runs
+    """
+    best = float("inf")
+    res: object = None
+    for _ in range(repeat):
+        start = perf_counter()
+        res = func()
+        best = min(best, perf_counter() - start)
+    return best, res
+
+
+class Target(NamedTuple):
+    """
+    A binary to trace and the input to trace it with
+    """
+
+    name: str
+    platform: str
+    binary: Path
+    input_data: bytes
+    ld_library_paths: List[str]
+
+
+TARGETS = [
+    Target("xxd", "x86_64", TEST_DIR / "binaries" / "xxd", b"\x41" * 400, []),
+    Target(
+        "Flight_Routes",
+        "x86_64",
+        TEST_DIR / "binaries" / "Flight_Routes" / "Flight_Routes",
+        (TEST_DIR / "inputs" / "Flight_Routes_1").read_bytes(),
+        [str(TEST_DIR / "binaries" / "Flight_Routes")],
+    ),
+]
+
+
+def trace(target: Target, **kwargs: Any) -> Any:
+    """
+    Trace a target with `TraceRunner.run`
+    """
+    return TraceRunner.run(
+        target.platform,
+        str(target.binary),
+        cwd=str(target.binary.parent),
+        input_data=target.input_data,
+        timeout=60,
+        ld_library_paths=target.ld_library_paths,
+        **kwargs,
+    )
+
+
+def recorded_logs(targets: Iterable[Target]) -> List[Tuple[str, bytes]]:
+    """
+    Trace each target there is a tracer for and return the logs by target name
+
+    :param targets: The targets to trace
+    """
+    logs = []
+    for target in targets:
+        try:
+            qemu_path(target.platform)
+        except ValueError:
+            continue
+        logs.append((target.name, trace(target)[3]))
+    return logs
@@ -0,0 +1,273 @@
+"""
+Benchmark suite reporting machine-readable results for regression tracking
+
+Run with `python -m benchmarks.suite [--output FILE] [--record DIR] [--logs LOG ...]
+[--parse-only]`. Each of these is measured separately:
+
+* startup: the time from starting `TraceRunner.run` to the first chunk of the log
+* collect: the log throughput of tracing the checked-in `xxd` and `Flight_Routes`
+  test binaries with `TraceRunner.run`
+* parse: `TraceParser.parse` lines per second with each backend
+* export: the time to write a parsed trace with `TraceResult.export` (JSON) and
+  `TraceResult.save` (binary)
+
+Every measurement runs in a fresh process and reports the peak RSS of that process,
+and the run benchmarks also report the peak RSS of the tracer. The parse and export
+benchmarks need no tracer: they parse the logs given with `--logs`, such as the logs
+of the test binaries an earlier run saved with `--record DIR`, or a synthetic log.
+Results are written as JSON, to stdout unless `--output` is given, and progress is
+reported on stderr.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from json import dumps
+from multiprocessing import get_context
+from os import cpu_count
+from pathlib import Path
+from platform import machine, platform, python_version
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from statistics import median
+from subprocess import DEVNULL, CalledProcessError, check_output
+from sys import platform as platform_name
+from sys import stderr
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.common import BENCH_DIR, TARGETS, Target, synthetic_log, timeit, trace
+from pyafl_qemu_trace import TraceParser, qemu_path
+from pyafl_qemu_trace.parse import vectorized
+from pyafl_qemu_trace.parse.compressed import read_log
+from pyafl_qemu_trace.run import LogFile
+
+PROC_STATUS = Path("/proc/self/status")
+
+Result = Dict[str, Any]
+
+
+def note_first(first: List[float], _: bytes) -> None:
+    """
+    Log sink that notes when the first chunk of a log arrives
+    """
+    if not first:
+        first.append(perf_counter())
+
+
+def bench_startup(target: Target, repeat: int) -> List[Result]:
+    """
+    Measure the time until the tracer logs its first chunk
+    """
+    firsts = []
+    totals = []
+    for _ in range(repeat):
+        first: List[float] = []
+        began = perf_counter()
+        trace(target, log_sink=partial(note_first, first))
+        totals.append(perf_counter() - began)
+        firsts.append(first[0] - began)
+    return [
+        {
+            "benchmark": "startup",
+            "target": target.name,
+            "seconds": median(firsts),
+            "run_seconds": median(totals),
+        }
+    ]
+
+
+def bench_collect(target: Target, repeat: int) -> List[Result]:
+    """
+    Measure the throughput of collecting a target's log
+    """
+    elapsed, res = timeit(partial(trace, target), repeat)
+    size = len(res[3])  # type: ignore
+    return [
+        {
+            "benchmark": "collect",
+            "target": target.name,
+            "seconds": elapsed,
+            "bytes": size,
+            "mb_per_second": size / elapsed / 1e6,
+        }
+    ]
+
+
+def bench_parse(name: str, path: Path, vectorize: bool, repeat: int) -> List[Result]:
+    """
+    Measure the throughput of parsing a log held in memory
+    """
+    log = b"".join(read_log(path))
+    lines = log.count(b"\n")
+    elapsed, res = timeit(partial(TraceParser.parse, log, vectorize=vectorize), repeat)
+    return [
+        {
+            "benchmark": "parse",
+            "target": name,
+            "backend": "numpy" if vectorize else "regex",
+            "seconds": elapsed,
+            "lines": lines,
+            "blocks": len(res.addrs),  # type: ignore
+            "lines_per_second": lines / elapsed,
+            "mb_per_second": len(log) / elapsed / 1e6,
+        }
+    ]
+
+
+def bench_export(name: str, path: Path, repeat: int) -> List[Result]:
+    """
+    Measure the time to write a parsed log as JSON and in the binary format
+    """
+    res = TraceParser.parse(b"".join(read_log(path)))
+    results = []
+    with TemporaryDirectory() as tmp:
+        for fmt, out, write in (
+            ("json", Path(tmp) / "trace.json", res.export),
+            ("binary", Path(tmp) / "trace.pqt", res.save),
+        ):
+            # `export` only writes to existing files
+            out.touch()
+            elapsed, _ = timeit(partial(write, out), repeat)
+            results.append(
+                {
+                    "benchmark": "export",
+                    "target": name,
+                    "format": fmt,
+                    "seconds": elapsed,
+                    "blocks": len(res.addrs),
+                    "bytes": out.stat().st_size,
+                }
+            )
+    return results
+
+
+def max_rss_mb(who: int) -> float:
+    """
+    Get the peak RSS of this process or of its largest waited-for child in MB
+
+    Linux carries the peak of `getrusage` over `exec`, so it is never less than the
+    RSS of the process that started the one measured. The peak of this process is
+    read from /proc instead where it can be, which starts over at `exec`.
+    """
+    if who == RUSAGE_SELF and PROC_STATUS.is_file():
+        for line in PROC_STATUS.read_text(encoding="utf-8").splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024 / 1e6
+    maxrss = getrusage(who).ru_maxrss
+    # Bytes on macOS and kilobytes everywhere else
+    return maxrss / 1e6 if platform_name == "darwin" else maxrss * 1024 / 1e6
+
+
+def measure(func: Callable[..., List[Result]], *args: Any) -> List[Result]:
+    """
+    Run a benchmark and add the peak RSS of the process (and of the tracer, if one
+    was run) to its results
+    """
+    results = func(*args)
+    for result in results:
+        result["peak_rss_mb"] = max_rss_mb(RUSAGE_SELF)
+        if result["benchmark"] in ("startup", "collect"):
+            result["tracer_peak_rss_mb"] = max_rss_mb(RUSAGE_CHILDREN)
+    return results
+
+
+def isolated(func: Callable[..., List[Result]], *args: Any) -> List[Result]:
+    """
+    Run a benchmark in a fresh process, so its peak RSS is its own
+    """
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(measure, func, *args).result()
+
+
+def metadata() -> Dict[str, Any]:
+    """
+    Describe the machine and the code the benchmarks ran on
+    """
+    try:
+        commit: Optional[str] = check_output(
+            ["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, stderr=DEVNULL, text=True
+        ).strip()
+    except (CalledProcessError, OSError):
+        commit = None
+    numpy = None
+    if vectorized.available():
+        numpy = __import__("numpy").__version__
+    return {
+        "time": time(),
+        "commit": commit,
+        "python": python_version(),
+        "platform": platform(),
+        "machine": machine(),
+        "cpus": cpu_count(),
+        "numpy": numpy,
+    }
+
+
+def report(result: Result) -> None:
+    """
+    Print a result to stderr as it comes in
+    """
+    desc = ", ".join(
+        f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}"
+        for key, value in result.items()
+        if key not in ("benchmark", "target")
+    )
+    print(f"{result['benchmark']} {result['target']}: {desc}", file=stderr)
+
+
+def main() -> None:
+    """
+    Run the benchmarks
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--logs", type=Path, nargs="*", default=[])
+    parser.add_argument("--record", type=Path)
+    parser.add_argument("--parse-only", action="store_true")
+    parser.add_argument("--blocks", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results: List[Result] = []
+
+    def add(found: List[Result]) -> None:
+        for result in found:
+            report(result)
+        results.extend(found)
+
+    logs = {log.name.split(".")[0]: log for log in args.logs}
+    for target in [] if args.parse_only else TARGETS:
+        try:
+            qemu_path(target.platform)
+        except ValueError as err:
+            add([{"benchmark": "run", "target": target.name, "skipped": str(err)}])
+            continue
+        add(isolated(bench_startup, target, args.repeat))
+        add(isolated(bench_collect, target, args.repeat))
+        if args.record is not None:
+            args.record.mkdir(parents=True, exist_ok=True)
+            logs[target.name] = trace(
+                target, log_sink=LogFile(args.record / f"{target.name}.log.gz")
+            )[3]
+
+    with TemporaryDirectory() as tmp:
+        if not logs:
+            logs["synthetic"] = Path(tmp) / "synthetic.log"
+            logs["synthetic"].write_bytes(synthetic_log(args.blocks))
+
+        backends = (False, True) if vectorized.available() else (False,)
+        for name, log in logs.items():
+            for vectorize in backends:
+                add(isolated(bench_parse, name, log, vectorize, args.repeat))
+            add(isolated(bench_export, name, log, args.repeat))
+
+    output = dumps({"meta": metadata(), "results": results}, indent=2)
+    if args.output is not None:
+        args.output.write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,24 @@
+from array import array
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 from pkg_resources import resource_filename
 
 PREFIX = "afl-qemu-trace-"
 
+# Size in bits of a guest address on each platform
+PLATFORM_BITS = {
+    "aarch64": 64,
+    "arm": 32,
+    "i386": 32,
+    "mips": 32,
+    "mips64": 64,
+    "ppc": 32,
+    "ppc64": 64,
+    "riscv32": 32,
+    "riscv64": 64,
+    "x86_64": 64,
+}
+
 
 def qemu_path(platform: str) -> str:
     """
@@ -39,6 +54,26 @@ def qemu_list() -> List[str]:
     )
 
 
+def addr_typecode(platform: Optional[str] = None) -> str:
+    """
+    Get the smallest array typecode that holds a guest address for the given
+    platform, defaulting to 64 bits if no platform is given
+
+    :param platform: A platform identifier (e.g. `x86_64`)
+    """
+    if platform is None:
+        return "Q"
+
+    if platform not in PLATFORM_BITS:
+        raise ValueError(f"No address size known for {platform}")
+
+    return next(
+        typecode
+        for typecode in ("I", "L", "Q")
+        if array(typecode).itemsize * 8 >= PLATFORM_BITS[platform]
+    )
+
+
 from pyafl_qemu_trace.events import QEMUEvent
-from pyafl_qemu_trace.run import TraceRunner
+from pyafl_qemu_trace.run import BatchTracer, TraceCache, TraceRunner, TracerPool
 from pyafl_qemu_trace.parse import TraceParser
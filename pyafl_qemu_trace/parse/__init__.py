@@ -1 +1,12 @@
+from pyafl_qemu_trace.parse.addrs import InternedAddrs
+from pyafl_qemu_trace.parse.compressed import LogWriter
+from pyafl_qemu_trace.parse.lazy import LazyRecords
+from pyafl_qemu_trace.parse.coverage import CoverageCollector, CoverageMap
+from pyafl_qemu_trace.parse.diff import TraceDiff
 from pyafl_qemu_trace.parse.parse import TraceParser
+from pyafl_qemu_trace.parse.maps import MapIndex
+from pyafl_qemu_trace.parse.ranges import RangeMap
+from pyafl_qemu_trace.parse.regs import Records
+from pyafl_qemu_trace.parse.syscalls import SyscallTable
+from pyafl_qemu_trace.parse.stream import TraceCollector, TraceStream
+from pyafl_qemu_trace.parse.tail import TailCollector, TraceTail
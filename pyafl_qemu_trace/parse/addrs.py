@@ -0,0 +1,156 @@
+"""
+Compact storage for traced guest addresses
+"""
+
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Union, overload
+
+# Typecodes for block IDs, from narrowest to widest
+ID_TYPECODES = ("B", "H", "I", "Q")
+
+
+class _Interner(Dict[int, int]):
+    """
+    Mapping of addresses to block IDs that assigns the next ID to unseen addresses
+    """
+
+    def __init__(self, table: array) -> None:
+        """
+        Initialize the interner
+
+        :param table: The block address table, which new addresses are appended to
+        """
+        super().__init__()
+        self.table = table
+
+    def __missing__(self, addr: int) -> int:
+        """
+        Assign an ID to a new address
+        """
+        ident = self[addr] = len(self.table)
+        self.table.append(addr)
+        return ident
+
+
+class InternedAddrs:
+    """
+    Sequence of guest addresses stored as IDs into a table of unique block addresses
+
+    A trace revisits the same blocks over and over, so storing an ID per block that is
+    only as wide as the number of unique blocks needs (usually 1 or 2 bytes) instead of
+    a full address shrinks long traces several times over. Indexing and iteration
+    look up each ID in the table, which is done in C when iterating.
+    """
+
+    def __init__(self, typecode: str = "Q", addrs: Iterable[int] = ()) -> None:
+        """
+        Initialize the sequence
+
+        :param typecode: The array typecode of the block address table
+        :param addrs: Initial addresses
+        """
+        self.table: Union[array, memoryview] = array(typecode)
+        self.ids: Union[array, memoryview] = array(ID_TYPECODES[0])
+        self._interner: Optional[_Interner] = _Interner(self.table)
+        self.extend(addrs)
+
+    @classmethod
+    def from_parts(
+        cls, table: Union[array, memoryview], ids: Union[array, memoryview]
+    ) -> "InternedAddrs":
+        """
+        Create a sequence from an existing block table and IDs, which are used as
+        they are (for example read-only views of a file) until it is extended
+
+        :param table: The block address table
+        :param ids: The block IDs
+        """
+        addrs = cls.__new__(cls)
+        addrs.table = table
+        addrs.ids = ids
+        addrs._interner = None
+        return addrs
+
+    @property
+    def typecode(self) -> str:
+        """
+        The typecode of the block addresses
+        """
+        return (
+            self.table.typecode if isinstance(self.table, array) else self.table.format
+        )
+
+    def append(self, addr: int) -> None:
+        """
+        Append an address
+
+        :param addr: The address
+        """
+        self.extend((addr,))
+
+    def extend(self, addrs: Iterable[int]) -> None:
+        """
+        Append a sequence of addresses
+
+        :param addrs: The addresses
+        """
+        # IDs given as a view are copied into an array the first time they grow
+        ids = (
+            self.ids
+            if isinstance(self.ids, array)
+            else array(self.ids.format, self.ids)
+        )
+        if self._interner is None:
+            self.table = array(self.typecode, self.table)
+            self._interner = _Interner(self.table)
+            self._interner.update((addr, i) for i, addr in enumerate(self.table))
+
+        new_ids = list(map(self._interner.__getitem__, addrs))
+
+        while len(self.table) > 1 << (ids.itemsize * 8):
+            ids = array(ID_TYPECODES[ID_TYPECODES.index(ids.typecode) + 1], ids)
+
+        ids.fromlist(new_ids)
+        self.ids = ids
+
+    def tolist(self) -> List[int]:
+        """
+        Get the addresses as a list
+        """
+        return list(self)
+
+    def toarray(self) -> array:
+        """
+        Get the addresses as a plain array
+        """
+        return array(self.typecode, self)
+
+    def __len__(self) -> int:
+        """
+        Get the number of addresses
+        """
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Iterate over the addresses
+        """
+        return map(self.table.__getitem__, self.ids)
+
+    @overload
+    def __getitem__(self, index: int) -> int:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> array:
+        ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[int, array]:
+        """
+        Get an address, or a slice of addresses as a plain array
+
+        :param index: The index or slice
+        """
+        if isinstance(index, slice):
+            return array(self.typecode, map(self.table.__getitem__, self.ids[index]))
+        return self.table[self.ids[index]]
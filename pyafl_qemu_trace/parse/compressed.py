@@ -0,0 +1,130 @@
+"""
+Reading and writing logs as compressed files
+
+Logs are long runs of nearly identical lines and compress very well, so keeping raw
+logs around for reprocessing is much cheaper compressed. The compression of a log
+file is chosen by its suffix: `.gz` uses gzip from the standard library, and `.zst`
+and `.lz4` use the optional `zstandard` and `lz4` packages, which compress several
+times faster. Files with any other suffix are plain logs.
+"""
+
+import gzip
+from importlib import import_module
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterator, Optional, Tuple, cast
+
+# Size of the chunks compressed logs are read in
+READ_CHUNK_SIZE = 1 << 22
+
+
+def _gzip(path: Path, mode: str, level: Optional[int]) -> Any:
+    """
+    Open a gzip file, by default at the fastest level since logs are written as
+    fast as the tracer produces them
+    """
+    return gzip.open(path, mode, compresslevel=1 if level is None else level)
+
+
+def _zstd(path: Path, mode: str, level: Optional[int]) -> Any:
+    """
+    Open a zstd file
+    """
+    zstandard = import_module("zstandard")
+    if "w" in mode:
+        cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+        return zstandard.open(path, mode, cctx=cctx)
+    return zstandard.open(path, mode)
+
+
+def _lz4(path: Path, mode: str, level: Optional[int]) -> Any:
+    """
+    Open an lz4 frame file
+    """
+    frame = import_module("lz4.frame")
+    return frame.open(path, mode, compression_level=0 if level is None else level)
+
+
+# Opener and package of each compressed log suffix
+CODECS: Dict[str, Tuple[Callable[[Path, str, Optional[int]], Any], str]] = {
+    ".gz": (_gzip, "gzip"),
+    ".zst": (_zstd, "zstandard"),
+    ".lz4": (_lz4, "lz4"),
+}
+
+
+def is_compressed(path: Path) -> bool:
+    """
+    Check whether a log file is compressed, going by its suffix
+
+    :param path: The log file
+    """
+    return path.suffix in CODECS
+
+
+def open_log(path: Path, mode: str = "rb", level: Optional[int] = None) -> BinaryIO:
+    """
+    Open a log file, compressed or decompressed according to its suffix
+
+    :param path: The log file
+    :param mode: `rb` to read the log or `wb` to write it
+    :param level: The compression level to write at, by default a fast one
+    """
+    if path.suffix not in CODECS:
+        return cast(BinaryIO, open(path, mode))  # pylint: disable=consider-using-with
+
+    opener, package = CODECS[path.suffix]
+    try:
+        return cast(BinaryIO, opener(path, mode, level))
+    except ImportError as exc:
+        raise ValueError(
+            f"Logs compressed as {path.suffix} need the {package} package"
+        ) from exc
+
+
+def read_log(path: Path, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Read a log file in chunks, decompressing it as it is read
+
+    :param path: The log file
+    :param chunk_size: The size of the decompressed chunks
+    """
+    with open_log(path) as fil:
+        chunk = fil.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = fil.read(chunk_size)
+
+
+class LogWriter:
+    """
+    Log sink that writes a log to a file as it is read, compressing it if the file
+    has a compressed suffix, for use as the `log_sink` of `TraceRunner.run`
+    """
+
+    def __init__(self, path: Path, level: Optional[int] = None) -> None:
+        """
+        Initialize the writer
+
+        :param path: The file to write the log to
+        :param level: The compression level, by default a fast one
+        """
+        self.path = path
+        # Size of the log before compression
+        self.size = 0
+        self._file = open_log(path, "wb", level)
+
+    def __call__(self, chunk: bytes) -> None:
+        """
+        Write the next chunk of the log
+
+        :param chunk: The next chunk of the log
+        """
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def close(self) -> Path:
+        """
+        Finish writing the log and return the path it was written to
+        """
+        self._file.close()
+        return self.path
@@ -0,0 +1,312 @@
+"""
+AFL-style edge coverage of afl qemu trace logs
+
+Each pair of consecutive guest blocks is an edge, hashed into a map of `MAP_SIZE`
+counters the same way AFL's QEMU mode does:
+
+    cur = ((addr >> 4) ^ (addr << 8)) & (MAP_SIZE - 1)
+    counts[cur ^ prev] += 1
+    prev = cur >> 1
+
+Hit counts are then classified into AFL's buckets (1, 2, 3, 4-7, 8-15, 16-31, 32-127
+and 128+), each of which is a single bit, so a `CoverageMap` is a set of
+(edge, bucket) pairs and maps of any number of traces can be merged and compared
+with bitwise operations, just like AFL's virgin maps.
+
+Unlike AFL's 8-bit counters, which wrap around, counts are kept in full and saturate
+at 255, so an edge hit 256 times is in the 128+ bucket rather than looking unhit (as
+it would in AFL without AFL++'s NeverZero counters). Maps may therefore differ from
+AFL's for edges hit more than 255 times.
+"""
+
+from array import array
+from collections import Counter
+from functools import reduce
+from itertools import islice
+from operator import or_
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from attr import define
+
+from pyafl_qemu_trace.parse import vectorized
+from pyafl_qemu_trace.parse.addrs import InternedAddrs
+from pyafl_qemu_trace.parse.regs import Records
+from pyafl_qemu_trace.parse.stream import AddrsEvent, TraceStream
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+# Number of edge counters, which is AFL's default map size
+MAP_SIZE = 1 << 16
+
+# Bucket of each hit count up to 255, above which counts saturate
+BUCKETS = bytes([0, 1, 2, 4] + [8] * 4 + [16] * 8 + [32] * 16 + [64] * 96 + [128] * 128)
+
+# Translation of buckets to whether the edge was hit at all
+HIT = bytes([0] + [1] * 255)
+
+# Novelty of a map against previously seen coverage, as returned by `CoverageMap.new`
+NOTHING_NEW = 0
+NEW_COUNTS = 1
+NEW_EDGES = 2
+
+
+def block_hash(addr: int) -> int:
+    """
+    Get the location of a block in the map, as AFL's QEMU mode computes it
+
+    :param addr: The guest address of the block
+    """
+    return ((addr >> 4) ^ (addr << 8)) & (MAP_SIZE - 1)
+
+
+@define(frozen=True, slots=True)
+class CoverageMap:
+    """
+    Bucketed edge hit counts of one or more traces, with one bit set per bucket an
+    edge was hit in
+    """
+
+    data: bytes
+
+    @classmethod
+    def empty(cls) -> "CoverageMap":
+        """
+        Get a map with no coverage
+        """
+        return cls(bytes(MAP_SIZE))
+
+    @classmethod
+    def union(cls, maps: Iterable["CoverageMap"]) -> "CoverageMap":
+        """
+        Merge the coverage of many maps
+
+        :param maps: The maps to merge
+        """
+        return cls._from_int(reduce(or_, (_to_int(m) for m in maps), 0))
+
+    @property
+    def edges(self) -> int:
+        """
+        The number of edges hit
+        """
+        return MAP_SIZE - self.data.count(0)
+
+    def edge_ids(self) -> List[int]:
+        """
+        Get the indices in the map of the edges hit
+        """
+        if vectorized.available():
+            return np.flatnonzero(np.frombuffer(self.data, dtype=np.uint8)).tolist()
+        return [i for i, bucket in enumerate(self.data) if bucket]
+
+    def new(self, seen: "CoverageMap") -> int:
+        """
+        Check whether this map has coverage that another does not, like AFL's
+        `has_new_bits`
+
+        :param seen: The coverage seen so far, such as the union of a corpus
+        :return: `NEW_EDGES` if an edge was hit that `seen` never hit, `NEW_COUNTS`
+            if only an edge was hit a number of times in a new bucket, and
+            `NOTHING_NEW` otherwise
+        """
+        if not _to_int(self) & ~_to_int(seen):
+            return NOTHING_NEW
+
+        hit = int.from_bytes(self.data.translate(HIT), "little")
+        if hit & ~int.from_bytes(seen.data.translate(HIT), "little"):
+            return NEW_EDGES
+        return NEW_COUNTS
+
+    def __or__(self, other: "CoverageMap") -> "CoverageMap":
+        """
+        Get the coverage of either map
+        """
+        return self._from_int(_to_int(self) | _to_int(other))
+
+    def __and__(self, other: "CoverageMap") -> "CoverageMap":
+        """
+        Get the coverage of both maps
+        """
+        return self._from_int(_to_int(self) & _to_int(other))
+
+    def __sub__(self, other: "CoverageMap") -> "CoverageMap":
+        """
+        Get the coverage of this map that is not in the other
+        """
+        return self._from_int(_to_int(self) & ~_to_int(other))
+
+    def __bool__(self) -> bool:
+        """
+        Check whether any edge was hit
+        """
+        return any(self.data)
+
+    @classmethod
+    def _from_int(cls, value: int) -> "CoverageMap":
+        """
+        Create a map from an integer made by `_to_int`
+        """
+        return cls(value.to_bytes(MAP_SIZE, "little"))
+
+
+def _to_int(coverage: CoverageMap) -> int:
+    """
+    Get a map as a single integer to operate on all buckets at once
+    """
+    return int.from_bytes(coverage.data, "little")
+
+
+class EdgeCounter:
+    """
+    Counts the edges of a trace from runs of consecutive guest addresses, which do
+    not have to be kept once they are counted
+    """
+
+    def __init__(
+        self,
+        code_range: Optional[Tuple[int, int]] = None,
+        vectorize: Optional[bool] = None,
+    ) -> None:
+        """
+        Initialize the counter
+
+        :param code_range: Only count blocks with addresses in this half-open range,
+            like AFL only instruments the code of the main binary (for example
+            `(result.start_code, result.end_code)`). By default every block counts.
+        :param vectorize: Whether to count with NumPy, by default if it is installed
+        """
+        if vectorize is None:
+            vectorize = vectorized.available()
+        elif vectorize and not vectorized.available():
+            raise ValueError("The vectorized backend requires NumPy to be installed")
+
+        self._code_range = code_range
+        self._vectorize = vectorize
+        self._prev = 0
+        # Hit counts of the whole map with NumPy, otherwise of the edges hit so far
+        self._counts: Any = (
+            np.zeros(MAP_SIZE, dtype=np.uint64) if vectorize else Counter()
+        )
+
+    def update(self, addrs: Union[array, InternedAddrs, memoryview]) -> None:
+        """
+        Count the edges of the next run of addresses of the trace
+
+        :param addrs: The addresses
+        """
+        if self._vectorize:
+            self._update_vectorized(addrs)
+            return
+
+        if self._code_range is not None:
+            lo, hi = self._code_range
+            addrs = array("Q", (addr for addr in addrs if lo <= addr < hi))
+        if not len(addrs):
+            return
+
+        # Traces loop over the same few edges, so count each distinct pair of
+        # consecutive blocks in C and only hash the distinct pairs
+        counts = self._counts
+        counts[block_hash(addrs[0]) ^ self._prev] += 1
+        for (prev, cur), count in Counter(zip(addrs, islice(addrs, 1, None))).items():
+            counts[block_hash(cur) ^ (block_hash(prev) >> 1)] += count
+        self._prev = block_hash(addrs[-1]) >> 1
+
+    def _update_vectorized(
+        self, addrs: Union[array, InternedAddrs, memoryview]
+    ) -> None:
+        """
+        Count the edges of the next run of addresses with NumPy
+        """
+        if isinstance(addrs, InternedAddrs):
+            values = np.asarray(addrs.table, dtype=np.uint64)[np.asarray(addrs.ids)]
+        else:
+            values = np.asarray(addrs).astype(np.uint64, copy=False)
+
+        if self._code_range is not None:
+            lo, hi = self._code_range
+            values = values[(values >= lo) & (values < hi)]
+        if not len(values):
+            return
+
+        cur = ((values >> np.uint64(4)) ^ (values << np.uint64(8))) & np.uint64(
+            MAP_SIZE - 1
+        )
+        prev = np.empty_like(cur)
+        prev[0] = self._prev
+        prev[1:] = cur[:-1] >> np.uint64(1)
+        self._counts += np.bincount(
+            (cur ^ prev).astype(np.intp), minlength=MAP_SIZE
+        ).astype(np.uint64)
+        self._prev = int(cur[-1]) >> 1
+
+    def counts(self) -> Dict[int, int]:
+        """
+        Get the raw hit counts of the edges hit so far, by index in the map
+        """
+        if self._vectorize:
+            edges = np.flatnonzero(self._counts)
+            return dict(zip(edges.tolist(), self._counts[edges].tolist()))
+        return dict(self._counts)
+
+    def coverage(self) -> CoverageMap:
+        """
+        Get the bucketed coverage of the edges counted so far, with counts over 255
+        saturating in the 128+ bucket
+        """
+        if self._vectorize:
+            buckets = np.frombuffer(BUCKETS, dtype=np.uint8)
+            return CoverageMap(buckets[np.minimum(self._counts, 255)].tobytes())
+
+        data = bytearray(MAP_SIZE)
+        for edge, count in self._counts.items():
+            data[edge] = BUCKETS[min(count, 255)]
+        return CoverageMap(bytes(data))
+
+
+class CoverageCollector:
+    """
+    Log sink that incrementally counts the edges of a log, for use as the `log_sink`
+    of `TraceRunner.run` to get the coverage of a trace without keeping its log or
+    its addresses
+    """
+
+    def __init__(
+        self,
+        code_range: Optional[Tuple[int, int]] = None,
+        vectorize: Optional[bool] = None,
+    ) -> None:
+        """
+        Initialize the collector
+
+        :param code_range: Only count blocks with addresses in this half-open range
+        :param vectorize: Whether to use the NumPy backend, by default if available
+        """
+        self._stream = TraceStream(vectorize=vectorize, records=Records.ADDRS)
+        self._counter = EdgeCounter(code_range, vectorize)
+
+    def __call__(self, chunk: bytes) -> None:
+        """
+        Count the edges of the next chunk of the log
+
+        :param chunk: The next chunk of the log
+        """
+        self._apply(self._stream.feed(chunk))
+
+    def close(self) -> CoverageMap:
+        """
+        Count any remaining edges and return the coverage
+        """
+        self._apply(self._stream.close())
+        return self._counter.coverage()
+
+    def _apply(self, events: Iterable[Any]) -> None:
+        """
+        Count the addresses in events
+        """
+        for event in events:
+            if isinstance(event, AddrsEvent):
+                self._counter.update(event.addrs)
@@ -0,0 +1,494 @@
+"""
+Comparison of the traces of different inputs
+
+Triaging a crash usually starts by comparing its trace with the trace of a similar
+input that does not crash. The first divergence is found by comparing the address
+arrays piece by piece. Aligning the rest of the traces follows patience diff: every
+window of `window` consecutive addresses is hashed, windows that occur exactly once
+in each trace are anchors, and the longest run of anchors in the same order in both
+traces splits them into gaps. Each gap is trimmed of its common prefix and suffix,
+and what remains is aligned exactly with `difflib` if it is small or reported as one
+differing region otherwise. Only a sample of the windows, chosen by their hash so
+the same windows are chosen in both traces, are considered as anchors, which keeps
+aligning traces of tens of millions of blocks to a few passes over their addresses
+with NumPy. Without it, every window is hashed in Python, which is only practical
+for traces of up to a few million blocks.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from difflib import SequenceMatcher
+from itertools import groupby
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+from attr import define
+
+from pyafl_qemu_trace.parse import vectorized
+from pyafl_qemu_trace.parse.addrs import InternedAddrs
+from pyafl_qemu_trace.parse.parse import Syscall, TraceResult
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+# Number of addresses compared at once, which bounds the size of the temporary
+# arrays
+PIECE_LENGTH = 1 << 22
+
+# Longest gap between anchors, on either side, that is aligned exactly
+EXACT_LENGTH = 2048
+
+# Odd multiplier of the polynomial hash of address windows
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+Addrs = Union[array, InternedAddrs, memoryview]
+
+
+@define(frozen=True, slots=True)
+class DiffRegion:  # pylint: disable=too-few-public-methods
+    """
+    Aligned regions of two traces that differ, as half-open ranges of indices. One of
+    the ranges is empty if addresses were only inserted in one trace.
+    """
+
+    first_start: int
+    first_end: int
+    second_start: int
+    second_end: int
+
+
+@define(frozen=True, slots=True)
+class TraceDiff:  # pylint: disable=too-few-public-methods
+    """
+    Differences between two traces
+    """
+
+    # Index of the first address where the traces differ, which is the length of the
+    # shorter trace if it is a prefix of the other, or None if they are the same
+    divergence: Optional[int]
+    # Aligned regions where the traces differ, in order
+    regions: List[DiffRegion]
+    # Syscalls of each trace logged near the divergence, by index
+    first_syscalls: Dict[int, Syscall]
+    second_syscalls: Dict[int, Syscall]
+
+    @classmethod
+    def between(  # pylint: disable=too-many-arguments
+        cls,
+        first: TraceResult,
+        second: TraceResult,
+        radius: int = 64,
+        window: int = 16,
+        sample: int = 32,
+        vectorize: Optional[bool] = None,
+    ) -> "TraceDiff":
+        """
+        Compare two traces
+
+        :param first: The first trace, such as the trace of a crashing input
+        :param second: The second trace
+        :param radius: Collect syscalls logged at most this many addresses before or
+            after the divergence
+        :param window: The number of consecutive addresses hashed together to find
+            anchors. Shorter windows find more anchors in repetitive traces, but
+            fewer of them are unique.
+        :param sample: Consider about one in this many windows as anchors
+        :param vectorize: Whether to compare with NumPy, by default if it is
+            installed
+        """
+        divergence = first_divergence(first.addrs, second.addrs, vectorize)
+        if divergence is None:
+            return cls(None, [], {}, {})
+        return cls(
+            divergence,
+            align(first.addrs, second.addrs, window, sample, vectorize),
+            syscalls_near(first.syscalls, divergence, radius),
+            syscalls_near(second.syscalls, divergence, radius),
+        )
+
+
+def first_divergence(
+    first: Addrs, second: Addrs, vectorize: Optional[bool] = None
+) -> Optional[int]:
+    """
+    Find the first index where two traces differ
+
+    :param first: The addresses of the first trace, such as `TraceResult.addrs`
+    :param second: The addresses of the second trace
+    :param vectorize: Whether to compare with NumPy, by default if it is installed
+    :return: The index, which is the length of the shorter trace if it is a prefix
+        of the other, or None if the traces are the same
+    """
+    first, second = _prepare(first, second, vectorize)
+    length = min(len(first), len(second))
+    pos = _prefix(first, second, 0, 0, length)
+    return None if pos == length and len(first) == len(second) else pos
+
+
+def divergence_of(
+    traces: Sequence[Addrs], vectorize: Optional[bool] = None
+) -> Optional[int]:
+    """
+    Find the first index where a set of traces do not all agree
+
+    :param traces: The addresses of each trace
+    :param vectorize: Whether to compare with NumPy, by default if it is installed
+    :return: The index, or None if the traces are all the same (or there are none)
+    """
+    if not traces:
+        return None
+    divergences = [
+        pos
+        for pos in (first_divergence(traces[0], other, vectorize) for other in traces)
+        if pos is not None
+    ]
+    return min(divergences) if divergences else None
+
+
+def align(
+    first: Addrs,
+    second: Addrs,
+    window: int = 16,
+    sample: int = 32,
+    vectorize: Optional[bool] = None,
+) -> List[DiffRegion]:
+    """
+    Align two traces and find the regions where they differ
+
+    :param first: The addresses of the first trace, such as `TraceResult.addrs`
+    :param second: The addresses of the second trace
+    :param window: The number of consecutive addresses hashed together to find
+        anchors
+    :param sample: Consider about one in this many windows as anchors
+    :param vectorize: Whether to align with NumPy, by default if it is installed
+    :return: The differing regions, in order
+    """
+    first, second = _prepare(first, second, vectorize)
+    regions: List[DiffRegion] = []
+    first_pos = second_pos = 0
+    for _, group in groupby(
+        _anchors(first, second, window, sample), lambda anchor: anchor[0] - anchor[1]
+    ):
+        # Consecutive anchors on the same diagonal usually match along with
+        # everything between them, which is checked in one comparison
+        run = list(group)
+        first_start, second_start = run[0]
+        length = run[-1][0] + window - first_start
+        if first_start >= first_pos and second_start >= second_pos:
+            if _prefix(first, second, first_start, second_start, length) == length:
+                _gap(
+                    first,
+                    second,
+                    (first_pos, first_start),
+                    (second_pos, second_start),
+                    regions,
+                )
+                first_pos, second_pos = first_start + length, second_start + length
+                continue
+
+        for first_anchor, second_anchor in run:
+            # An anchor overlapping the one before it only extends it if it is on
+            # the same diagonal, and windows whose hashes collide are not anchors
+            diagonal = first_anchor - first_pos == second_anchor - second_pos
+            if (
+                first_anchor < first_pos or second_anchor < second_pos
+            ) and not diagonal:
+                continue
+            if _prefix(first, second, first_anchor, second_anchor, window) != window:
+                continue
+            if first_anchor >= first_pos:
+                _gap(
+                    first,
+                    second,
+                    (first_pos, first_anchor),
+                    (second_pos, second_anchor),
+                    regions,
+                )
+            first_pos, second_pos = first_anchor + window, second_anchor + window
+    _gap(first, second, (first_pos, len(first)), (second_pos, len(second)), regions)
+    return regions
+
+
+def syscalls_near(
+    syscalls: Mapping[int, Syscall], index: int, radius: int
+) -> Dict[int, Syscall]:
+    """
+    Find the syscalls logged near an index of a trace
+
+    :param syscalls: The syscalls of the trace, such as `TraceResult.syscalls`
+    :param index: The index
+    :param radius: The number of addresses before and after the index to look at
+    """
+    keys = sorted(syscalls)
+    first = bisect_left(keys, index - radius)
+    last = bisect_right(keys, index + radius, first)
+    return {key: syscalls[key] for key in keys[first:last]}
+
+
+def _prepare(first: Addrs, second: Addrs, vectorize: Optional[bool]) -> Tuple[Any, Any]:
+    """
+    Get the addresses of two traces in the representation of the chosen backend:
+    64 bit NumPy arrays, or otherwise 64 bit memoryviews that compare in C
+    """
+    if vectorize is None:
+        vectorize = vectorized.available()
+    elif vectorize and not vectorized.available():
+        raise ValueError("The vectorized backend requires NumPy to be installed")
+
+    def convert(addrs: Addrs) -> Any:
+        if isinstance(addrs, InternedAddrs):
+            if vectorize:
+                table = np.asarray(addrs.table, dtype=np.uint64)
+                return table[np.asarray(addrs.ids)]
+            addrs = addrs.toarray()
+        if vectorize:
+            return np.asarray(addrs).astype(np.uint64, copy=False)
+        view = memoryview(addrs)
+        return view if view.format == "Q" else memoryview(array("Q", view))
+
+    return convert(first), convert(second)
+
+
+def _prefix(
+    first: Any, second: Any, first_start: int, second_start: int, length: int
+) -> int:
+    """
+    Find the length of the common prefix of two runs of addresses
+
+    :param first: The first trace
+    :param second: The second trace
+    :param first_start: The index the run of the first trace starts at
+    :param second_start: The index the run of the second trace starts at
+    :param length: The length of the runs
+    """
+    for pos in range(0, length, PIECE_LENGTH):
+        end = min(pos + PIECE_LENGTH, length)
+        first_piece = first[first_start + pos : first_start + end]
+        second_piece = second[second_start + pos : second_start + end]
+        if isinstance(first, memoryview):
+            if first_piece != second_piece:
+                return pos + _mismatch(first_piece, second_piece)
+        else:
+            found = np.flatnonzero(first_piece != second_piece)
+            if len(found):
+                return pos + int(found[0])
+    return length
+
+
+def _suffix(
+    first: Any, second: Any, first_end: int, second_end: int, length: int
+) -> int:
+    """
+    Find the length of the common suffix of two runs of addresses
+
+    :param first: The first trace
+    :param second: The second trace
+    :param first_end: The index the run of the first trace ends at
+    :param second_end: The index the run of the second trace ends at
+    :param length: The length of the runs
+    """
+    for pos in range(0, length, PIECE_LENGTH):
+        end = min(pos + PIECE_LENGTH, length)
+        first_piece = first[first_end - end : first_end - pos]
+        second_piece = second[second_end - end : second_end - pos]
+        if isinstance(first, memoryview):
+            if first_piece != second_piece:
+                return pos + _mismatch(first_piece[::-1], second_piece[::-1])
+        else:
+            found = np.flatnonzero(first_piece != second_piece)
+            if len(found):
+                return end - 1 - int(found[-1])
+    return length
+
+
+def _mismatch(first: memoryview, second: memoryview) -> int:
+    """
+    Find the first index where two different runs of addresses differ by bisecting
+    them, so that every comparison is done in C
+    """
+    low, high = 0, len(first)
+    while high - low > 1:
+        mid = (low + high) // 2
+        if first[low:mid] == second[low:mid]:
+            low = mid
+        else:
+            high = mid
+    return low
+
+
+def _gap(
+    first: Any,
+    second: Any,
+    first_span: Tuple[int, int],
+    second_span: Tuple[int, int],
+    regions: List[DiffRegion],
+) -> None:
+    """
+    Align the addresses of two traces between consecutive anchors
+
+    :param first: The first trace
+    :param second: The second trace
+    :param first_span: The start and end index of the gap in the first trace
+    :param second_span: The start and end index of the gap in the second trace
+    :param regions: The regions to add the differing regions of the gap to
+    """
+    (first_start, first_end), (second_start, second_end) = first_span, second_span
+    common = _prefix(
+        first,
+        second,
+        first_start,
+        second_start,
+        min(first_end - first_start, second_end - second_start),
+    )
+    first_start, second_start = first_start + common, second_start + common
+    common = _suffix(
+        first,
+        second,
+        first_end,
+        second_end,
+        min(first_end - first_start, second_end - second_start),
+    )
+    first_end, second_end = first_end - common, second_end - common
+
+    if first_start == first_end and second_start == second_end:
+        return
+    if (
+        first_start == first_end
+        or second_start == second_end
+        or max(first_end - first_start, second_end - second_start) > EXACT_LENGTH
+    ):
+        regions.append(DiffRegion(first_start, first_end, second_start, second_end))
+        return
+
+    matcher = SequenceMatcher(
+        None,
+        first[first_start:first_end].tolist(),
+        second[second_start:second_end].tolist(),
+        autojunk=False,
+    )
+    for tag, first_lo, first_hi, second_lo, second_hi in matcher.get_opcodes():
+        if tag != "equal":
+            regions.append(
+                DiffRegion(
+                    first_start + first_lo,
+                    first_start + first_hi,
+                    second_start + second_lo,
+                    second_start + second_hi,
+                )
+            )
+
+
+def _anchors(
+    first: Any, second: Any, window: int, sample: int
+) -> List[Tuple[int, int]]:
+    """
+    Find the longest run of windows unique to both traces that are in the same order
+    in both
+
+    :param first: The first trace
+    :param second: The second trace
+    :param window: The number of addresses in a window
+    :param sample: Consider about one in this many windows
+    :return: The index of each anchor window in the first and second trace, in
+        order
+    """
+    if isinstance(first, memoryview):
+        first_unique, second_unique = (
+            _unique_windows(addrs, window, sample) for addrs in (first, second)
+        )
+        pairs = sorted(
+            (pos, second_unique[key])
+            for key, pos in first_unique.items()
+            if key in second_unique
+        )
+    else:
+        first_hashes, first_pos = _unique_windows_vectorized(first, window, sample)
+        second_hashes, second_pos = _unique_windows_vectorized(second, window, sample)
+        _, first_found, second_found = np.intersect1d(
+            first_hashes, second_hashes, assume_unique=True, return_indices=True
+        )
+        first_pos, second_pos = first_pos[first_found], second_pos[second_found]
+        order = np.argsort(first_pos)
+        pairs = list(zip(first_pos[order].tolist(), second_pos[order].tolist()))
+
+    return _in_order(pairs)
+
+
+def _in_order(pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Find the longest run of pairs of indices, sorted by their first index, whose
+    second indices are increasing too
+
+    :param pairs: The pairs of indices in the first and second trace
+    """
+    tails: List[int] = []
+    tail_ids: List[int] = []
+    prevs: List[int] = []
+    for ident, (_, second_anchor) in enumerate(pairs):
+        pos = bisect_left(tails, second_anchor)
+        prevs.append(tail_ids[pos - 1] if pos > 0 else -1)
+        if pos == len(tails):
+            tails.append(second_anchor)
+            tail_ids.append(ident)
+        else:
+            tails[pos] = second_anchor
+            tail_ids[pos] = ident
+
+    chain: List[Tuple[int, int]] = []
+    ident = tail_ids[-1] if tail_ids else -1
+    while ident >= 0:
+        chain.append(pairs[ident])
+        ident = prevs[ident]
+    chain.reverse()
+    return chain
+
+
+def _unique_windows(addrs: memoryview, window: int, sample: int) -> Dict[bytes, int]:
+    """
+    Find the sampled windows of a trace that occur once in it
+
+    Every window is sliced and hashed in Python to decide whether it is sampled, so
+    this takes around a second per million addresses. That is fine for the traces
+    of single inputs, but traces of tens of millions of blocks should be aligned
+    with the vectorized backend.
+
+    :return: The index of each unique window by its contents
+    """
+    width = window * addrs.itemsize
+    buf = addrs.cast("B")
+    found: Dict[bytes, int] = {}
+    for pos in range(len(addrs) - window + 1):
+        key = buf[pos * addrs.itemsize : pos * addrs.itemsize + width].tobytes()
+        if hash(key) % sample == 0:
+            found[key] = -1 if key in found else pos
+    return {key: pos for key, pos in found.items() if pos >= 0}
+
+
+def _unique_windows_vectorized(
+    addrs: "np.ndarray", window: int, sample: int
+) -> Tuple["np.ndarray", "np.ndarray"]:
+    """
+    Find the sampled windows of a trace whose hash occurs once in it with NumPy
+
+    :return: The sorted hashes of the unique windows, and the index of each
+    """
+    count = len(addrs) - window + 1
+    if count <= 0:
+        return np.empty(0, np.uint64), np.empty(0, np.int64)
+
+    hashes = np.zeros(count, np.uint64)
+    for pos in range(window):
+        hashes *= np.uint64(HASH_MULTIPLIER)
+        hashes += addrs[pos : pos + count]
+    # Mix the high bits into the low ones the sample is chosen by
+    hashes ^= hashes >> np.uint64(29)
+    hashes *= np.uint64(HASH_MULTIPLIER)
+    hashes ^= hashes >> np.uint64(32)
+
+    positions = np.flatnonzero(hashes % np.uint64(sample) == 0)
+    values, first, counts = np.unique(
+        hashes[positions], return_index=True, return_counts=True
+    )
+    unique = counts == 1
+    return values[unique], positions[first[unique]]
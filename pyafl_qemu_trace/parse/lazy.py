@@ -0,0 +1,113 @@
+"""
+Records of a trace that are decoded from the log on first access
+
+Building an `MMap` or `Syscall` runs several conversions per field, which dominates
+parsing logs with many syscalls even though most records are never looked at.
+`LazyRecords` instead keeps the log and the index, start and end offset of each
+record in arrays while it is scanned, and decodes a record only when it is first
+accessed.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+class LazyRecords(Mapping[int, V]):
+    """
+    Read-only mapping of index in the trace to the record logged after that index,
+    which decodes each record the first time it is accessed and keeps the log it
+    was scanned from alive until then
+    """
+
+    def __init__(
+        self,
+        buf: Any,
+        decode: Callable[[Any, int, int], V],
+        merge: Optional[Callable[[V, V], V]] = None,
+    ) -> None:
+        """
+        Initialize the records
+
+        :param buf: The log the records are scanned from
+        :param decode: Decodes the record between a start and end offset of the log
+        :param merge: Merges records logged after the same index. By default the last
+            one is kept.
+        """
+        self._buf = buf
+        self._decode = decode
+        self._merge = merge
+        # Index, start offset and end offset of each record, in the order logged
+        self._indices: "array[int]" = array("q")
+        self._starts: "array[int]" = array("Q")
+        self._ends: "array[int]" = array("Q")
+        self._len = 0
+        self._decoded: Dict[int, V] = {}
+
+    def add(self, index: int, start: int, end: int) -> None:
+        """
+        Add a record, which must not be logged before any record already added
+
+        :param index: The index of the last address before the record
+        :param start: The offset in the log the record starts at
+        :param end: The offset in the log the record ends at
+        """
+        if not self._indices or self._indices[-1] != index:
+            self._len += 1
+        self._indices.append(index)
+        self._starts.append(start)
+        self._ends.append(end)
+
+    def __getitem__(self, index: int) -> V:
+        """
+        Get the record logged after an index, decoding it if needed
+        """
+        if index in self._decoded:
+            return self._decoded[index]
+
+        first = bisect_left(self._indices, index)
+        last = bisect_right(self._indices, index, first)
+        if first == last:
+            raise KeyError(index)
+
+        if self._merge is None:
+            first = last - 1
+        value = self._decode(self._buf, self._starts[first], self._ends[first])
+        for pos in range(first + 1, last):
+            value = self._merge(  # type: ignore
+                value, self._decode(self._buf, self._starts[pos], self._ends[pos])
+            )
+
+        self._decoded[index] = value
+        return value
+
+    def __contains__(self, index: object) -> bool:
+        """
+        Check whether a record was logged after an index without decoding it
+        """
+        if not isinstance(index, int):
+            return False
+        pos = bisect_left(self._indices, index)
+        return pos < len(self._indices) and self._indices[pos] == index
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Iterate over the indices records were logged after, in order
+        """
+        return (index for index, _ in groupby(self._indices))
+
+    def __len__(self) -> int:
+        """
+        Get the number of indices records were logged after
+        """
+        return self._len
+
+    @property
+    def decoded(self) -> int:
+        """
+        The number of records decoded so far
+        """
+        return len(self._decoded)
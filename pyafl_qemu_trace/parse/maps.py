@@ -0,0 +1,270 @@
+"""
+Lookup of the memory mappings guest addresses were executed from
+
+afl-qemu-trace dumps the whole guest memory map whenever it changes, so the mapping
+an address belongs to depends on when it was executed. `MapIndex` keeps each
+snapshot in `TraceResult.maps` as sorted arrays of mapping bounds, and answers
+queries for a whole address array at once by binary searching each run of addresses
+executed under the same snapshot against that snapshot's bounds.
+
+Logs do not name the files mappings come from, so mappings are what addresses are
+classified by and rebased to. The main binary is the mapping containing
+`TraceResult.start_code` in each snapshot, which need not be the same mapping in all
+of them (for example once the loader changes the protection of part of it).
+"""
+
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from pyafl_qemu_trace.parse import vectorized
+from pyafl_qemu_trace.parse.addrs import InternedAddrs
+from pyafl_qemu_trace.parse.parse import MMap, TraceResult
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+# Typecode of mapping IDs, where -1 is an address outside of every mapping
+MAPPING_TYPECODE = "i"
+
+# Number of addresses classified at once with NumPy, which bounds the size of the
+# temporary arrays
+PIECE_LENGTH = 1 << 22
+
+Addrs = Union[array, InternedAddrs, memoryview]
+
+
+class _Classifier(Dict[int, int]):
+    """
+    Mapping of addresses to the IDs of the mappings containing them in one snapshot,
+    which looks up each address only the first time it is seen
+    """
+
+    def __init__(self, starts: array, ends: array, ids: array) -> None:
+        """
+        Initialize the classifier
+
+        :param starts: The sorted start addresses of the mappings of the snapshot
+        :param ends: The end addresses of the mappings
+        :param ids: The IDs of the mappings
+        """
+        super().__init__()
+        self.starts = starts
+        self.ends = ends
+        self.ids = ids
+
+    def __missing__(self, addr: int) -> int:
+        """
+        Find the mapping of a new address
+        """
+        pos = bisect_right(self.starts, addr) - 1
+        ident = self[addr] = self.ids[pos] if pos >= 0 and addr < self.ends[pos] else -1
+        return ident
+
+
+class MapIndex:
+    """
+    Index of the memory mappings of a trace over time
+    """
+
+    def __init__(self, maps: Dict[int, Set[MMap]]) -> None:
+        """
+        Initialize the index
+
+        :param maps: Memory map snapshots keyed by the index of the last address
+            executed before them, as in `TraceResult.maps`
+        """
+        # Every distinct mapping of the trace, by ID
+        self.mappings: List[MMap] = []
+        # ID of each mapping
+        self.ids: Dict[MMap, int] = {}
+        # Index of the first address each snapshot applies to
+        self._firsts: List[int] = []
+        # Sorted start and end addresses and IDs of the mappings of each snapshot
+        self._snapshots: List[Tuple[array, array, array]] = []
+
+        for key in sorted(maps):
+            snapshot = sorted(maps[key], key=lambda mmap: mmap.start)
+            for mmap in snapshot:
+                if mmap not in self.ids:
+                    self.ids[mmap] = len(self.mappings)
+                    self.mappings.append(mmap)
+            self._firsts.append(key + 1)
+            self._snapshots.append(
+                (
+                    array("Q", (mmap.start for mmap in snapshot)),
+                    array("Q", (mmap.end for mmap in snapshot)),
+                    array(MAPPING_TYPECODE, (self.ids[mmap] for mmap in snapshot)),
+                )
+            )
+
+    @classmethod
+    def from_result(cls, res: TraceResult) -> "MapIndex":
+        """
+        Create the index of the memory mappings of a trace
+
+        :param res: The trace
+        """
+        return cls(res.maps)
+
+    def find(self, addr: int, index: Optional[int] = None) -> Optional[MMap]:
+        """
+        Find the mapping containing an address
+
+        :param addr: The address
+        :param index: The index in the trace the address was executed at. By
+            default the last snapshot of the trace is searched.
+        :return: The mapping, or None if the address was not mapped
+        """
+        if index is None:
+            snap = len(self._snapshots) - 1
+        else:
+            snap = bisect_right(self._firsts, index) - 1
+        if snap < 0:
+            return None
+        ident = _Classifier(*self._snapshots[snap])[addr]
+        return self.mappings[ident] if ident >= 0 else None
+
+    def containing(self, addr: int) -> Set[int]:
+        """
+        Find the mappings containing an address in any snapshot, such as those of
+        the main binary from `TraceResult.start_code`
+
+        :param addr: The address
+        :return: The IDs in `mappings` of the mappings
+        """
+        ids = {_Classifier(*snapshot)[addr] for snapshot in self._snapshots}
+        ids.discard(-1)
+        return ids
+
+    def classify(self, addrs: Addrs, vectorize: Optional[bool] = None) -> array:
+        """
+        Find the mapping each address of a trace was executed from
+
+        :param addrs: The addresses of the trace, such as `TraceResult.addrs`
+        :param vectorize: Whether to classify with NumPy, by default if it is
+            installed
+        :return: An array of the IDs in `mappings` of the mapping of each address,
+            which are -1 for addresses that were not mapped when they executed
+        """
+        vectorize = _backend(vectorize)
+        res = array(MAPPING_TYPECODE)
+        for first, last, snapshot in self._runs(len(addrs)):
+            if snapshot is None:
+                res.extend([-1] * (last - first))
+            elif vectorize:
+                res.frombytes(self._classify_vectorized(addrs, first, last, snapshot))
+            else:
+                res.extend(map(_Classifier(*snapshot).__getitem__, addrs[first:last]))
+        return res
+
+    def rebase(
+        self, addrs: Addrs, vectorize: Optional[bool] = None
+    ) -> Tuple[array, array]:
+        """
+        Rebase the addresses of a trace to offsets into their mappings
+
+        :param addrs: The addresses of the trace, such as `TraceResult.addrs`
+        :param vectorize: Whether to rebase with NumPy, by default if it is installed
+        :return: The IDs of the mappings of the addresses as returned by `classify`,
+            and the offset of each address from the start of its mapping, which is
+            the address itself for addresses that were not mapped
+        """
+        vectorize = _backend(vectorize)
+        ids = self.classify(addrs, vectorize)
+        bases = array("Q", (mmap.start for mmap in self.mappings))
+        # Offsets of unmapped addresses, whose ID is -1, are from 0
+        bases.append(0)
+
+        if not vectorize:
+            return ids, array("Q", map(int.__sub__, addrs, map(bases.__getitem__, ids)))
+
+        offsets = array("Q")
+        bases_np, ids_np = np.asarray(bases), np.asarray(ids)
+        for pos in range(0, len(addrs), PIECE_LENGTH):
+            end = min(pos + PIECE_LENGTH, len(addrs))
+            values = _values(addrs, pos, end) - bases_np[ids_np[pos:end]]
+            offsets.frombytes(values.tobytes())
+        return ids, offsets
+
+    def counts(self, addrs: Addrs, vectorize: Optional[bool] = None) -> Dict[int, int]:
+        """
+        Count the addresses of a trace executed from each mapping
+
+        :param addrs: The addresses of the trace
+        :param vectorize: Whether to count with NumPy, by default if it is installed
+        :return: The number of addresses by mapping ID, including -1 for addresses
+            that were not mapped
+        """
+        vectorize = _backend(vectorize)
+        ids = self.classify(addrs, vectorize)
+        if vectorize:
+            values, counts = np.unique(np.asarray(ids), return_counts=True)
+            return dict(zip(values.tolist(), counts.tolist()))
+        return dict(Counter(ids))
+
+    def _runs(
+        self, length: int
+    ) -> Iterable[Tuple[int, int, Optional[Tuple[array, array, array]]]]:
+        """
+        Split a trace into runs of addresses executed under the same snapshot
+
+        :param length: The number of addresses in the trace
+        :return: The first and end index of each run and its snapshot, or None for
+            the addresses executed before the first snapshot
+        """
+        prev = 0
+        snapshot = None
+        for first, nxt in zip(self._firsts, self._snapshots):
+            first = min(max(first, 0), length)
+            if first > prev:
+                yield prev, first, snapshot
+            prev, snapshot = first, nxt
+        if length > prev:
+            yield prev, length, snapshot
+
+    @staticmethod
+    def _classify_vectorized(
+        addrs: Addrs, first: int, last: int, snapshot: Tuple[array, array, array]
+    ) -> bytes:
+        """
+        Classify a run of addresses executed under one snapshot with NumPy
+        """
+        starts, ends, ids = map(np.asarray, snapshot)
+        ends = np.append(ends, 0).astype(np.uint64)
+        ids = np.append(ids, -1).astype(MAPPING_TYPECODE)
+        out = []
+        for pos in range(first, last, PIECE_LENGTH):
+            values = _values(addrs, pos, min(pos + PIECE_LENGTH, last))
+            # Index of the last mapping starting at or before each address, or the
+            # sentinel past the end for addresses below every mapping
+            found = np.searchsorted(starts, values, side="right") - 1
+            found[found < 0] = len(starts)
+            found[values >= ends[found]] = len(starts)
+            out.append(ids[found].tobytes())
+        return b"".join(out)
+
+
+def _backend(vectorize: Optional[bool]) -> bool:
+    """
+    Resolve whether to use the NumPy backend
+    """
+    if vectorize is None:
+        return vectorized.available()
+    if vectorize and not vectorized.available():
+        raise ValueError("The vectorized backend requires NumPy to be installed")
+    return vectorize
+
+
+def _values(addrs: Addrs, first: int, last: int) -> "np.ndarray":
+    """
+    Get a run of addresses as a NumPy array of 64 bit values
+    """
+    if isinstance(addrs, InternedAddrs):
+        table = np.asarray(addrs.table, dtype=np.uint64)
+        values: "np.ndarray" = table[np.asarray(addrs.ids)[first:last]]
+        return values
+    return np.asarray(addrs[first:last]).astype(np.uint64, copy=False)
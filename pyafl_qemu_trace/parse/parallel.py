@@ -0,0 +1,163 @@
+"""
+Parsing one large afl qemu trace log on several processes
+
+The log is shared with the worker processes through a memory-mapped file (the log
+itself when parsing a file, otherwise a copy of it in `/dev/shm`), split into pieces
+at the starts of trace lines. No record spans a trace line (a syscall that never
+returns does not extend past one, and memory mapping dumps and mapping information
+are never interrupted by one), so every piece parses exactly as it would as part of
+the whole log. Each worker parses its piece with indices relative to the piece, and
+the results are shifted and merged in log order.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from mmap import ACCESS_READ, mmap
+from os.path import isdir
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import List, Optional, Tuple, Union
+
+from pyafl_qemu_trace.parse.parse import TraceParser, TraceResult
+from pyafl_qemu_trace.parse.regs import MAPPING_RES, Records
+from pyafl_qemu_trace.parse.source import Log, log_bytes
+
+# Smallest piece of a log worth parsing on its own process
+MIN_PIECE_SIZE = 1 << 22
+
+# Directory to share logs that are not already files through
+SHM_DIR = "/dev/shm"
+
+
+def split(buf: Union[bytes, mmap], pieces: int) -> List[Tuple[int, int]]:
+    """
+    Split a log into at most `pieces` pieces of similar size at trace line starts
+
+    :param buf: The log
+    :param pieces: The number of pieces to aim for
+    :return: The (start, end) offsets of each piece
+    """
+    cuts = [0]
+    for i in range(1, pieces):
+        cut = buf.find(b"\nTrace ", max(len(buf) * i // pieces, cuts[-1])) + 1
+        if cut <= cuts[-1]:
+            break
+        cuts.append(cut)
+    cuts.append(len(buf))
+    return list(zip(cuts, cuts[1:]))
+
+
+def parse_piece(
+    path: str,
+    start: int,
+    end: int,
+    vectorize: Optional[bool],
+    platform: Optional[str],
+    records: Records = Records.DEFAULT,
+) -> Tuple[TraceResult, int]:
+    """
+    Parse a piece of a log file, with indices relative to the start of the piece
+
+    :param path: The log file
+    :param start: The start offset of the piece
+    :param end: The end offset of the piece
+    :param vectorize: Whether to use the NumPy backend
+    :param platform: The platform the log was traced on
+    :param records: The kinds of records to parse
+    :return: The result of the piece and its number of trace lines
+    """
+    with open(path, "rb") as fil:
+        buf = mmap(fil.fileno(), 0, access=ACCESS_READ)
+
+    res = TraceParser.result(platform)
+    with memoryview(buf) as view:
+        count = TraceParser.scan(view[start:end], res, 0, vectorize, records)
+    buf.close()
+    return res, count
+
+
+def stitch(
+    parts: List[Tuple[TraceResult, int]], platform: Optional[str], compact: bool
+) -> TraceResult:
+    """
+    Merge the results of consecutive pieces of a log into the result for the whole
+
+    :param parts: The results of the pieces and their numbers of trace lines, in log
+        order
+    :param platform: The platform the log was traced on
+    :param compact: Store the addresses as `InternedAddrs`
+    """
+    res = TraceParser.result(platform, compact)
+    addrs = res.growable_addrs()
+    base = 0
+
+    for part, count in parts:
+        # Records before the first address of a piece follow the last address of
+        # the previous piece, which is index -1 relative to the piece
+        addrs.extend(part.addrs)
+        for index, maps in part.maps.items():
+            res.maps[base + index].update(maps)
+        for index, syscall in part.syscalls.items():
+            res.syscalls[base + index] = syscall
+        for guest_addr, tbs in part.tbs.items():
+            res.tbs.setdefault(guest_addr, set()).update(tbs)
+        for name in MAPPING_RES:
+            if getattr(res, name) is None:
+                setattr(res, name, getattr(part, name))
+        base += count
+
+    return res
+
+
+def parse(
+    log: Log,
+    workers: int,
+    vectorize: Optional[bool] = None,
+    platform: Optional[str] = None,
+    compact: bool = False,
+    records: Records = Records.DEFAULT,
+) -> TraceResult:
+    """
+    Parse a log on up to `workers` processes, giving the same result as
+    `TraceParser.parse`
+
+    :param log: The log file, or its contents as any bytes-like object
+    :param workers: The maximum number of worker processes
+    :param vectorize: Whether to use the NumPy backend
+    :param platform: The platform the log was traced on
+    :param compact: Store the addresses as `InternedAddrs`
+    :param records: The kinds of records to parse
+    """
+    with NamedTemporaryFile(dir=SHM_DIR if isdir(SHM_DIR) else None) as tmp:
+        if isinstance(log, Path):
+            path = str(log)
+        else:
+            tmp.write(log_bytes(log))
+            tmp.flush()
+            path = tmp.name
+
+        with open(path, "rb") as fil:
+            size = fil.seek(0, 2)
+            if size == 0:
+                return TraceParser.result(platform, compact)
+            with mmap(fil.fileno(), 0, access=ACCESS_READ) as buf:
+                pieces = split(buf, max(min(workers, size // MIN_PIECE_SIZE), 1))
+
+        starts, ends = zip(*pieces)
+        if len(pieces) == 1:
+            parts = [parse_piece(path, 0, size, vectorize, platform, records)]
+        else:
+            with ProcessPoolExecutor(len(pieces)) as executor:
+                parts = list(
+                    executor.map(
+                        parse_piece,
+                        repeat(path),
+                        starts,
+                        ends,
+                        repeat(vectorize),
+                        repeat(platform),
+                        repeat(records),
+                    )
+                )
+
+    return stitch(parts, platform, compact)
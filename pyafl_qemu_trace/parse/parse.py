@@ -6,10 +6,13 @@ from array import array
 from collections import defaultdict
 from functools import partial
 from json import dumps
+from mmap import mmap
 from pathlib import Path
-from re import Match, finditer
+from re import Match
 from typing import (
+    TYPE_CHECKING,
     Any,
+    BinaryIO,
     Dict,
     Iterable,
     List,
@@ -17,23 +20,40 @@ from typing import (
     Set,
     Tuple,
     Union,
-    TypeVar,
-    Callable,
     Iterator,
     cast,
 )
 from attr import asdict, define, field
 
-from pyafl_qemu_trace.parse.regs import (
-    TRACE_RE,
-    MMAP_RE,
-    MMAP_LINE_RE,
-    STRACE_RE,
-    MAPPING_RES,
-)
+from pyafl_qemu_trace import addr_typecode
+from pyafl_qemu_trace.parse import vectorized
+from pyafl_qemu_trace.parse.addrs import InternedAddrs
+from pyafl_qemu_trace.parse.compressed import is_compressed
+from pyafl_qemu_trace.parse.lazy import LazyRecords
+from pyafl_qemu_trace.parse.regs import ADDR_RE, MMAP_LINE_RE, Records, record_re
+from pyafl_qemu_trace.parse.source import Log, feed_log, log_buffer, log_contents
+
+if TYPE_CHECKING:
+    from pyafl_qemu_trace.parse.coverage import CoverageMap
+    from pyafl_qemu_trace.parse.stream import TraceEvent
+    from pyafl_qemu_trace.parse.tail import TraceTail
 
 base16 = partial(int, base=16)
 
+# Size of the pieces a log is parsed in when interning addresses
+COMPACT_PIECE_SIZE = 1 << 24
+
+# Size of the pieces a log is parsed in when keeping only its end, which bounds the
+# memory used while parsing
+TAIL_PIECE_SIZE = 1 << 20
+
+
+def hex_int(value: Union[int, str, bytes]) -> int:
+    """
+    Convert a hex string to an integer, passing integers through unchanged
+    """
+    return value if isinstance(value, int) else int(value, base=16)
+
 
 @define(frozen=True, slots=True)
 class MMap:  # pylint: disable=too-few-public-methods
@@ -41,9 +61,9 @@ class MMap:  # pylint: disable=too-few-public-methods
     Memory mapping
     """
 
-    start: int = field(converter=lambda x: int(x, base=16))  # type: ignore
-    end: int = field(converter=lambda x: int(x, base=16))  # type: ignore
-    size: int = field(converter=lambda x: int(x, base=16))  # type: ignore
+    start: int = field(converter=hex_int)
+    end: int = field(converter=hex_int)
+    size: int = field(converter=hex_int)
     prot: str
 
 
@@ -62,18 +82,79 @@ class Syscall:  # pylint: disable=too-few-public-methods
     err: Optional[str] = None
 
 
+@define(frozen=True, slots=True)
+class TranslationBlock:  # pylint: disable=too-few-public-methods
+    """
+    Translation block a guest block was executed from
+    """
+
+    host_addr: int = field(converter=hex_int)
+    flags: int = field(converter=hex_int)
+    cflags: int = field(converter=hex_int)
+
+
+def decode_maps(buf: Any, start: int = 0, end: Optional[int] = None) -> Set[MMap]:
+    """
+    Decode the mappings of a memory mapping dump
+
+    :param buf: The buffer containing the dump
+    :param start: The offset of the dump in the buffer
+    :param end: The offset the dump ends at, by default the end of the buffer
+    """
+    return {
+        MMap(
+            mtch.group("start"),
+            mtch.group("end"),
+            mtch.group("size"),
+            mtch.group("prot").decode("utf-8"),
+        )
+        for mtch in MMAP_LINE_RE.finditer(buf, start, len(buf) if end is None else end)
+    }
+
+
+def decode_syscall(mtch: "Match[bytes]") -> Syscall:
+    """
+    Decode a syscall matched by `record_re`
+
+    :param mtch: The match of the syscall
+    """
+    errmsg = mtch.group("syscall_errmsg")
+    return Syscall(
+        mtch.group("syscall_name").decode("utf-8"),
+        mtch.group("syscall_ret"),
+        mtch.group("syscall_args").decode("utf-8").split(","),
+        mtch.group("syscall_errno"),
+        errmsg.decode("utf-8") if errmsg else None,
+    )
+
+
+def decode_syscall_at(buf: Any, start: int, end: int) -> Syscall:
+    """
+    Decode the syscall between two offsets of a log
+
+    :param buf: The log
+    :param start: The offset of the syscall
+    :param end: The offset the syscall ends at
+    """
+    mtch = record_re(Records.SYSCALLS).match(buf, start, end)
+    if mtch is None:
+        raise ValueError(f"No syscall between offsets {start} and {end} of the log")
+    return decode_syscall(mtch)
+
+
 @define(slots=True)
 class TraceResult:  # pylint: disable=too-few-public-methods
     """
     Result of a trace
     """
 
-    # Straight up list of addresses
-    addrs: array
+    # Straight up list of addresses (a read-only memoryview when loaded from a file)
+    addrs: Union[array, InternedAddrs, memoryview]
     # Mapping of index in addrs: list of mmaps in the mapping output at that
-    # last index before the mapping
+    # last index before the mapping (a read-only `LazyRecords` if parsed lazily)
     maps: Dict[int, Set[MMap]]
     # Mapping of the index in addrs: syscall at that last index before the syscall
+    # (a read-only `LazyRecords` if parsed lazily, or a `SyscallTable`)
     syscalls: Dict[int, Syscall]
     # Mapping information
     guest_base: Optional[int] = None
@@ -89,6 +170,59 @@ class TraceResult:  # pylint: disable=too-few-public-methods
     env_start: Optional[int] = None
     auxv_start: Optional[int] = None
     mmap_min: Optional[int] = None
+    # Mapping of guest block address: translation blocks it was executed from, only
+    # parsed if `Records.TBS` are selected
+    tbs: Dict[int, Set[TranslationBlock]] = field(factory=dict)
+    # Whether the trace was cut short by a log budget or a timeout, in which case
+    # it ends at the last whole record before the tracer was killed
+    truncated: bool = False
+
+    def growable_addrs(self) -> Union[array, InternedAddrs]:
+        """
+        Get the addresses to add to, which are read-only if the result was loaded
+        """
+        if isinstance(self.addrs, memoryview):
+            raise TypeError("The addresses of a loaded result are read-only")
+        return self.addrs
+
+    def save(self, where: Union[Path, BinaryIO]) -> None:
+        """
+        Save the trace to a file in the binary trace format, which is much smaller
+        and faster to write and load than `export`
+
+        :param where: The path or binary file object to write to
+        """
+        # pylint: disable=import-outside-toplevel
+        from pyafl_qemu_trace.parse.store import save
+
+        save(self, where)
+
+    @classmethod
+    def load(cls, where: Path, copy: bool = False) -> "TraceResult":
+        """
+        Load a trace saved with `save`. The file is memory mapped and the addresses
+        are read-only views of it unless `copy` is set.
+
+        :param where: The path to load from
+        :param copy: Copy the addresses into arrays instead of mapping them
+        """
+        # pylint: disable=import-outside-toplevel
+        from pyafl_qemu_trace.parse.store import load
+
+        return load(where, copy)
+
+    def coverage(self, code_range: Optional[Tuple[int, int]] = None) -> "CoverageMap":
+        """
+        Get the AFL-style edge coverage of the trace
+
+        :param code_range: Only count blocks with addresses in this half-open range
+        """
+        # pylint: disable=import-outside-toplevel
+        from pyafl_qemu_trace.parse.coverage import EdgeCounter
+
+        counter = EdgeCounter(code_range)
+        counter.update(self.addrs)
+        return counter.coverage()
 
     def export(self, where: Path) -> None:
         """
@@ -116,120 +250,346 @@ class TraceResult:  # pylint: disable=too-few-public-methods
                     "env_start": self.env_start,
                     "auxv_start": self.auxv_start,
                     "mmap_min": self.mmap_min,
+                    "tbs": {k: list(map(asdict, v)) for k, v in self.tbs.items()},
+                    "truncated": self.truncated,
                 }
             )
         )
 
 
-V = TypeVar("V")
-
-
-def interleave_lambda_longest(func: Callable, *args: Iterable[V]) -> Iterator[V]:
+class TraceParser:
     """
-    Interleave from a collection of iterables until all are exhausted
-    by repeatedly calling `f` with the set of non-exhausted iterators to
-    determine the next iterator to iterate.
+    Parse afl qemu trace logs
     """
 
-    iterators = list(map(iter, args))  # type: ignore
+    @classmethod
+    def parse(  # pylint: disable=too-many-arguments
+        cls,
+        log: Log,
+        vectorize: Optional[bool] = None,
+        platform: Optional[str] = None,
+        compact: bool = False,
+        records: Records = Records.DEFAULT,
+        syscall_table: bool = False,
+    ) -> TraceResult:
+        """
+        Parse a log from either a file or a string
 
-    values: List[Optional[V]] = []
+        :param log: The log file, or its contents as any bytes-like object (such as
+            a `memoryview` of a `LogBuffer` passed to `TraceRunner.run`),
+            which is parsed without being copied. Files are memory mapped rather
+            than read into memory, except that files with a `.gz`, `.zst` or
+            `.lz4` suffix are decompressed and parsed piece by piece, and cannot
+            have their translation blocks parsed.
+        :param vectorize: Whether to extract addresses with the NumPy backend. By
+            default it is used if NumPy is installed.
+        :param platform: The platform the log was traced on (e.g. `x86_64`), which
+            determines the size of the stored addresses. By default they are stored
+            as 64 bit values.
+        :param compact: Store the addresses as `InternedAddrs`, which are IDs into a
+            table of unique block addresses, rather than as a plain array
+        :param records: The kinds of records to parse. Records of other kinds are
+            skipped without being decoded, which makes parsing only the addresses
+            (`Records.ADDRS`) several times faster. Maps and syscalls are keyed by
+            the number of trace lines before them whether or not `Records.ADDRS` are
+            selected.
+        :param syscall_table: Store the syscalls of the result as a columnar
+            `SyscallTable` rather than a dict of `Syscall` objects
+        """
+        # pylint: disable=import-outside-toplevel
+        from pyafl_qemu_trace.parse.syscalls import SyscallTable
+
+        if not compact and not (isinstance(log, Path) and is_compressed(log)):
+            res = cls.result(platform)
+            if syscall_table:
+                res.syscalls = SyscallTable()  # type: ignore
+            with log_contents(log) as contents:
+                cls.scan(contents, res, vectorize=vectorize, records=records)
+            return res
+
+        # Intern the addresses or decompress the log piece by piece, so neither the
+        # full plain array nor the whole decompressed log is ever built
+        # pylint: disable=import-outside-toplevel
+        from pyafl_qemu_trace.parse.stream import TraceCollector
+
+        collector = TraceCollector(platform, compact, vectorize, records)
+        feed_log(log, collector, COMPACT_PIECE_SIZE)
+        res = collector.close()
+        if syscall_table:
+            # The syscalls of pieces are decoded separately, so convert them after
+            res.syscalls = SyscallTable.from_syscalls(res.syscalls)  # type: ignore
+        return res
 
-    for i in iterators:
-        try:
-            values.append(next(i))
-        except StopIteration:
-            values.append(None)
+    @classmethod
+    def parse_lazy(
+        cls,
+        log: Log,
+        vectorize: Optional[bool] = None,
+        platform: Optional[str] = None,
+        records: Records = Records.DEFAULT,
+    ) -> TraceResult:
+        """
+        Parse a log, only recording where each memory mapping dump and syscall is in
+        it and decoding them when they are first accessed. `maps` and `syscalls` of
+        the result are read-only `LazyRecords` that keep the log (or its memory
+        mapping) alive.
+
+        :param log: The log file, which cannot be compressed, or its contents as any
+            bytes-like object
+        :param vectorize: Whether to extract addresses with the NumPy backend, by
+            default if available
+        :param platform: The platform the log was traced on, which determines the
+            size of the stored addresses
+        :param records: The kinds of records to parse
+        """
+        # The records are decoded from the mapping later, so it stays open for as
+        # long as they reference it
+        contents: Union[bytes, mmap, memoryview] = log_buffer(log)
+
+        res = cls.result(platform)
+        res.maps = LazyRecords(contents, decode_maps, set.union)  # type: ignore
+        res.syscalls = LazyRecords(contents, decode_syscall_at)  # type: ignore
+        cls.scan(contents, res, vectorize=vectorize, records=records)
+        return res
 
-    while any(map(lambda v: v is not None, values)):
-        idx = func(*values)
+    @classmethod
+    def parse_parallel(  # pylint: disable=too-many-arguments
+        cls,
+        log: Log,
+        workers: int,
+        vectorize: Optional[bool] = None,
+        platform: Optional[str] = None,
+        compact: bool = False,
+        records: Records = Records.DEFAULT,
+        syscall_table: bool = False,
+    ) -> TraceResult:
+        """
+        Parse a large log in pieces on up to `workers` processes, which gives the
+        same result as `parse`. Compressed logs are parsed on one process.
+
+        :param log: The log file, or its contents as any bytes-like object
+        :param workers: The maximum number of worker processes
+        :param vectorize: Whether to extract addresses with the NumPy backend, by
+            default if available
+        :param platform: The platform the log was traced on, which determines the
+            size of the stored addresses
+        :param compact: Store the addresses as `InternedAddrs`
+        :param records: The kinds of records to parse
+        :param syscall_table: Store the syscalls of the result as a `SyscallTable`
+        """
+        # pylint: disable=import-outside-toplevel
+        from pyafl_qemu_trace.parse import parallel
+        from pyafl_qemu_trace.parse.syscalls import SyscallTable
 
-        if values[idx] is not None:
-            yield values[idx]
+        if workers <= 1 or (isinstance(log, Path) and is_compressed(log)):
+            return cls.parse(log, vectorize, platform, compact, records, syscall_table)
 
-        try:
-            values[idx] = next(iterators[idx])
-        except StopIteration:
-            values[idx] = None
+        res = parallel.parse(log, workers, vectorize, platform, compact, records)
+        if syscall_table:
+            res.syscalls = SyscallTable.from_syscalls(res.syscalls)  # type: ignore
+        return res
 
+    @classmethod
+    def coverage(
+        cls,
+        log: Log,
+        code_range: Optional[Tuple[int, int]] = None,
+        vectorize: Optional[bool] = None,
+    ) -> "CoverageMap":
+        """
+        Get the AFL-style edge coverage of a log without building its full address
+        array, which is much cheaper than `parse` for very long traces
+
+        :param log: The log file, which may be compressed, or its contents as any
+            bytes-like object
+        :param code_range: Only count blocks with addresses in this half-open range,
+            like AFL only instruments the main binary. By default every block counts.
+        :param vectorize: Whether to use the NumPy backend, by default if available
+        """
+        # pylint: disable=import-outside-toplevel
+        from pyafl_qemu_trace.parse.coverage import CoverageCollector
 
-def getnext(*args: Optional[Tuple[Any, Match]]) -> int:
-    """
-    Get the next item to take from a collection of matches
+        collector = CoverageCollector(code_range, vectorize)
+        feed_log(log, collector, COMPACT_PIECE_SIZE)
+        return collector.close()
 
-    :param args: The collection of matches to take from.
-    """
-    to_take = 0
-    minstart = -1
-    for i, arg in enumerate(args):
-        if arg is not None and (arg[1].start() < minstart or minstart == -1):
-            minstart = arg[1].start()
-            to_take = i
+    @classmethod
+    def tail(  # pylint: disable=too-many-arguments
+        cls,
+        log: Log,
+        length: int = 4096,
+        syscalls: int = 256,
+        maps: int = 16,
+        platform: Optional[str] = None,
+        vectorize: Optional[bool] = None,
+        records: Records = Records.DEFAULT,
+    ) -> "TraceTail":
+        """
+        Parse only the last blocks of a log and the records around them, in memory
+        that does not grow with the length of the log
+
+        :param log: The log file, which may be compressed, or its contents as any
+            bytes-like object
+        :param length: The number of most recent blocks to keep
+        :param syscalls: The number of most recent syscalls to keep
+        :param maps: The number of most recent memory map dumps to keep
+        :param platform: The platform the log was traced on, which determines the
+            size of the stored addresses
+        :param vectorize: Whether to use the NumPy backend, by default if available
+        :param records: The kinds of records to parse, which cannot include
+            `Records.TBS`
+        """
+        # pylint: disable=import-outside-toplevel
+        from pyafl_qemu_trace.parse.tail import TailCollector
 
-    return to_take
+        collector = TailCollector(length, syscalls, maps, platform, vectorize, records)
+        feed_log(log, collector, TAIL_PIECE_SIZE)
+        return collector.close()
 
+    @classmethod
+    def result(
+        cls, platform: Optional[str] = None, compact: bool = False
+    ) -> TraceResult:
+        """
+        Create an empty result
 
-class TraceParser:
-    """
-    Parse afl qemu trace logs
-    """
+        :param platform: The platform the result is for, which determines the size of
+            the stored addresses
+        :param compact: Store the addresses as `InternedAddrs`
+        """
+        typecode = addr_typecode(platform)
+        return TraceResult(
+            InternedAddrs(typecode) if compact else array(typecode),
+            defaultdict(set),
+            {},
+        )
 
     @classmethod
-    def parse(cls, log: Union[Path, bytes]) -> TraceResult:
+    def stream(
+        cls,
+        source: Union[BinaryIO, Iterable[bytes]],
+        chunk_size: int = 1 << 20,
+        platform: Optional[str] = None,
+    ) -> Iterator["TraceEvent"]:
         """
-        Parse a log from either a file or a string
-
-        :param log: The log file
+        Incrementally parse a log from a file-like object (for example the read end
+        of the fifo `TraceRunner.run` logs to) or an iterable of byte chunks,
+        yielding events as soon as the records they describe are complete
+
+        :param source: A binary file-like object or an iterable of chunks
+        :param chunk_size: The size of reads from a file-like `source`
+        :param platform: The platform the log was traced on, which determines the
+            size of the addresses in the events
         """
+        # pylint: disable=import-outside-toplevel
+        from pyafl_qemu_trace.parse.stream import TraceStream
 
-        if isinstance(log, bytes):
-            contents = log
-        elif isinstance(log, Path):
-            contents = log.read_bytes()
+        if hasattr(source, "read"):
+            chunks: Iterable[bytes] = iter(
+                partial(cast(BinaryIO, source).read, chunk_size), b""
+            )
         else:
-            raise TypeError(f"log must be a string or a Path, got {type(log)}")
-
-        # TODO: Array should be typed according to the platform data size to conserve
-        # space on 32-bit or smaller architectures
-        res = TraceResult(array("Q"), defaultdict(set), {})
-
-        mapping_data = {}
-        for typ, regex in MAPPING_RES.items():
-            mapping_data[typ] = regex.search(contents)
-
-        for typ, mtch in mapping_data.items():
-            if mtch is not None:
-                setattr(res, typ, int(mtch.group(typ), base=16))
-
-        for tmatch in interleave_lambda_longest(
-            getnext,
-            map(lambda m: ("TRACE", m), finditer(TRACE_RE, contents)),
-            map(lambda m: ("MMAP", m), finditer(MMAP_RE, contents)),
-            map(lambda m: ("STRACE", m), finditer(STRACE_RE, contents)),
-        ):
-            typ = tmatch[0]
-            mtch = tmatch[1]
-
-            if typ == "TRACE":
-                res.addrs.append(base16(mtch.group("guest_addr")))
-            elif typ == "MMAP":
-                for submtch in finditer(MMAP_LINE_RE, mtch.group(0)):
-                    res.maps[len(res.addrs) - 1].add(
-                        MMap(
-                            submtch.group("start"),
-                            submtch.group("end"),
-                            submtch.group("size"),
-                            submtch.group("prot").decode("utf-8"),
-                        )
-                    )
-            elif typ == "STRACE":
-                errmsg = mtch.groupdict().get("syscall_errmsg")
-                res.syscalls[len(res.addrs) - 1] = Syscall(
-                    mtch.group("syscall_name").decode("utf-8"),
-                    mtch.group("syscall_ret"),
-                    mtch.group("syscall_args").decode("utf-8").split(","),
-                    mtch.groupdict().get("syscall_errno"),
-                    cast(bytes, errmsg).decode("utf-8") if errmsg else None,
-                )
+            chunks = source
 
-        return res
+        tstream = TraceStream(platform)
+        for chunk in chunks:
+            yield from tstream.feed(chunk)
+        yield from tstream.close()
+
+    @classmethod
+    def scan(  # pylint: disable=too-many-locals
+        cls,
+        contents: Union[bytes, mmap, memoryview],
+        res: TraceResult,
+        offset: int = 0,
+        vectorize: Optional[bool] = None,
+        records: Records = Records.DEFAULT,
+    ) -> int:
+        """
+        Scan a run of complete records and add them to an existing result
+
+        Maps and syscalls are keyed by `offset` plus the index of the last address
+        in `res` before them, so a log can be scanned piecewise either into one
+        result (with `offset` 0) or into per-piece results that only hold the
+        addresses of their own piece. Mapping information already present in `res`
+        is not overwritten.
+
+        :param contents: The log contents, which must not end inside a record
+        :param res: The result to add the records to
+        :param offset: The number of addresses preceding `res.addrs` in the trace
+        :param vectorize: Whether to extract addresses with the NumPy backend. By
+            default it is used if NumPy is installed. Translation blocks are always
+            parsed without it.
+        :param records: The kinds of records to add
+        :return: The number of trace lines scanned, which is the number of addresses
+            added if `Records.ADDRS` are selected
+        """
+        if vectorize is None:
+            vectorize = vectorized.available()
+        elif vectorize and not vectorized.available():
+            raise ValueError("The vectorized backend requires NumPy to be installed")
+
+        if vectorize and not records & Records.TBS:
+            return vectorized.scan(contents, res, offset, records)
+
+        addrs = res.growable_addrs()
+        if records == Records.ADDRS:
+            found = ADDR_RE.findall(contents)
+            addrs.extend(map(base16, found))
+            return len(found)
+
+        append = addrs.append if records & Records.ADDRS else None
+        start = index = offset + len(res.addrs) - 1
+        tbs = set()
+
+        for mtch in record_re(records).finditer(contents):
+            typ = mtch.lastgroup
+
+            if typ == "guest_addr":
+                index += 1
+                if append is not None:
+                    append(int(mtch.group("guest_addr"), base=16))
+            elif typ == "tb_cflags":
+                index += 1
+                if append is not None:
+                    append(int(mtch.group("guest_addr"), base=16))
+                tbs.add(mtch.group("guest_addr", "tb_host", "tb_flags", "tb_cflags"))
+            else:
+                cls.record(mtch, res, index)
+
+        # Blocks are executed from the same few translations over and over, so only
+        # decode each distinct one once
+        for guest_addr, host_addr, flags, cflags in tbs:
+            res.tbs.setdefault(base16(guest_addr), set()).add(
+                TranslationBlock(host_addr, flags, cflags)
+            )
+
+        return index - start
+
+    @classmethod
+    def record(cls, mtch: Match, res: TraceResult, index: int) -> None:
+        """
+        Add a record other than a trace line matched by `record_re` to a result
+
+        :param mtch: The match of the record
+        :param res: The result to add the record to
+        :param index: The index of the last address before the record
+        """
+        typ = mtch.lastgroup
+
+        if typ == "mmap":
+            if isinstance(res.maps, LazyRecords):
+                res.maps.add(index, mtch.start(), mtch.end())
+            else:
+                res.maps[index].update(decode_maps(mtch.string, *mtch.span()))
+        elif typ == "mapping_value":
+            name = mtch.group("mapping_name").decode("utf-8")
+            if getattr(res, name) is None:
+                setattr(res, name, base16(mtch.group("mapping_value")))
+        elif isinstance(res.syscalls, LazyRecords):
+            res.syscalls.add(index, mtch.start(), mtch.end())
+        elif hasattr(res.syscalls, "add_match"):
+            # A `SyscallTable`
+            res.syscalls.add_match(index, mtch)
+        else:
+            res.syscalls[index] = decode_syscall(mtch)
@@ -0,0 +1,266 @@
+"""
+Lookup of the ranges containing addresses, such as the basic blocks of a binary
+
+`RangeMap` keeps the bounds of non-overlapping half-open ranges in sorted arrays,
+is built from all of its ranges at once, and finds the ranges containing a whole
+array of addresses in one call by binary searching each distinct address once,
+since traces revisit the same blocks over and over. With NumPy the distinct
+addresses are all searched at once.
+"""
+
+from array import array
+from bisect import bisect_right
+from typing import (
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from pyafl_qemu_trace.parse import vectorized
+from pyafl_qemu_trace.parse.addrs import InternedAddrs
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+# Typecode of range indices, where -1 is an address outside of every range
+INDEX_TYPECODE = "q"
+
+# Number of addresses looked up at once with NumPy, which bounds the size of the
+# temporary arrays
+PIECE_LENGTH = 1 << 22
+
+V = TypeVar("V")
+
+
+class _Lookup(Dict[int, int]):
+    """
+    Mapping of addresses to the indices of the ranges containing them, which binary
+    searches each address only the first time it is seen
+    """
+
+    def __init__(self, starts: array, ends: array) -> None:
+        """
+        Initialize the lookup
+
+        :param starts: The sorted start addresses of the ranges
+        :param ends: The end addresses of the ranges
+        """
+        super().__init__()
+        self.starts = starts
+        self.ends = ends
+
+    def __missing__(self, addr: int) -> int:
+        """
+        Find the range of a new address
+        """
+        pos = bisect_right(self.starts, addr) - 1
+        found = self[addr] = pos if pos >= 0 and addr < self.ends[pos] else -1
+        return found
+
+
+class RangeMap(Generic[V]):
+    """
+    Map of non-overlapping half-open ranges of addresses to values
+    """
+
+    def __init__(
+        self, starts: Iterable[int], ends: Iterable[int], values: Iterable[V]
+    ) -> None:
+        """
+        Initialize the map
+
+        :param starts: The start address of each range, in ascending order
+        :param ends: The end address of each range, which is not in the range
+        :param values: The value of each range
+        """
+        self.starts = array("Q", starts)
+        self.ends = array("Q", ends)
+        self.values: List[V] = list(values)
+        if not len(self.starts) == len(self.ends) == len(self.values):
+            raise ValueError("Ranges need a start, an end and a value each")
+        for pos in range(1, len(self.starts)):
+            if self.starts[pos] < self.ends[pos - 1]:
+                raise ValueError(
+                    f"Range {self.starts[pos]:#x}-{self.ends[pos]:#x} overlaps "
+                    f"{self.starts[pos - 1]:#x}-{self.ends[pos - 1]:#x} or is not "
+                    "sorted"
+                )
+
+    @classmethod
+    def from_ranges(
+        cls, ranges: Iterable[Tuple[int, int, V]], strict: bool = True
+    ) -> "RangeMap[V]":
+        """
+        Create a map from ranges in any order
+
+        :param ranges: The start, end and value of each range
+        :param strict: Whether overlapping ranges are an error. Otherwise a range
+            overlapping one that starts before it is left out.
+        """
+        kept: List[Tuple[int, int, V]] = []
+        for rng in sorted(ranges, key=lambda rng: (rng[0], rng[1])):
+            if kept and rng[0] < kept[-1][1]:
+                if strict:
+                    raise ValueError(
+                        f"Range {rng[0]:#x}-{rng[1]:#x} overlaps "
+                        f"{kept[-1][0]:#x}-{kept[-1][1]:#x}"
+                    )
+                continue
+            kept.append(rng)
+        return cls(
+            (rng[0] for rng in kept), (rng[1] for rng in kept), (rng[2] for rng in kept)
+        )
+
+    def index(self, addr: int) -> int:
+        """
+        Find the range containing an address
+
+        :param addr: The address
+        :return: The index of the range, or -1 if no range contains the address
+        """
+        pos = bisect_right(self.starts, addr) - 1
+        return pos if pos >= 0 and addr < self.ends[pos] else -1
+
+    def get(self, addr: int, default: Optional[V] = None) -> Optional[V]:
+        """
+        Get the value of the range containing an address
+
+        :param addr: The address
+        :param default: The value to return if no range contains the address
+        """
+        pos = self.index(addr)
+        return self.values[pos] if pos >= 0 else default
+
+    def lookup_many(
+        self,
+        addrs: Union[Sequence[int], InternedAddrs, memoryview],
+        vectorize: Optional[bool] = None,
+    ) -> array:
+        """
+        Find the ranges containing each of an array of addresses
+
+        :param addrs: The addresses, such as `TraceResult.addrs`
+        :param vectorize: Whether to look up the addresses with NumPy, by default if
+            it is installed
+        :return: The index of the range containing each address, or -1 for
+            addresses outside of every range
+        """
+        if vectorize is None:
+            vectorize = vectorized.available()
+        elif vectorize and not vectorized.available():
+            raise ValueError("The vectorized backend requires NumPy to be installed")
+
+        if isinstance(addrs, InternedAddrs):
+            # Look up each unique block once, then expand them to the trace
+            found = self.lookup_many(addrs.table, vectorize)
+            if not vectorize:
+                return array(INDEX_TYPECODE, map(found.__getitem__, addrs.ids))
+            return array(
+                INDEX_TYPECODE, np.asarray(found)[np.asarray(addrs.ids)].tobytes()
+            )
+
+        if not vectorize:
+            return array(
+                INDEX_TYPECODE, map(_Lookup(self.starts, self.ends).__getitem__, addrs)
+            )
+
+        starts = np.asarray(self.starts)
+        # A sentinel end past the last range for addresses below every range
+        ends = np.append(np.asarray(self.ends), 0).astype(np.uint64)
+        res = array(INDEX_TYPECODE)
+        for pos in range(0, len(addrs), PIECE_LENGTH):
+            values = np.asarray(addrs[pos : pos + PIECE_LENGTH], dtype=np.uint64)
+            # Searching the distinct addresses in sorted order walks the bounds in
+            # order, which is faster than searching every address in trace order
+            values, inverse = np.unique(values, return_inverse=True)
+            indices = np.searchsorted(starts, values, side="right") - 1
+            indices[indices < 0] = len(starts)
+            indices[values >= ends[indices]] = -1
+            res.frombytes(indices[inverse].astype(INDEX_TYPECODE).tobytes())
+        return res
+
+    def visits(
+        self,
+        addrs: Union[Sequence[int], InternedAddrs, memoryview],
+        collapse: bool = True,
+        vectorize: Optional[bool] = None,
+    ) -> array:
+        """
+        Find the ranges a trace passes through, in order, leaving out addresses
+        outside of every range
+
+        Translation blocks can be smaller than the ranges they are in, such as
+        basic blocks, so a trace can have several addresses in a row inside one.
+
+        :param addrs: The addresses, such as `TraceResult.addrs`
+        :param collapse: Whether consecutive addresses in the same range count as
+            one visit of it, unless the later one re-enters the range at its start
+            (like a loop back to the start of a basic block)
+        :param vectorize: Whether to look up the addresses with NumPy, by default if
+            it is installed
+        :return: The index of the range of each visit
+        """
+        if vectorize is None:
+            vectorize = vectorized.available()
+        found = self.lookup_many(addrs, vectorize)
+
+        if vectorize:
+            ids = np.asarray(found)
+            if isinstance(addrs, InternedAddrs):
+                values = np.asarray(addrs.table, dtype=np.uint64)[np.asarray(addrs.ids)]
+            else:
+                values = np.asarray(addrs, dtype=np.uint64)
+            inside = ids >= 0
+            ids, values = ids[inside], values[inside]
+            if collapse and len(ids):
+                keep = np.ones(len(ids), dtype=bool)
+                keep[1:] = (ids[1:] != ids[:-1]) | (
+                    values[1:] == np.asarray(self.starts)[ids[1:]]
+                )
+                ids = ids[keep]
+            return array(INDEX_TYPECODE, ids.tobytes())
+
+        res = array(INDEX_TYPECODE)
+        for addr, ident in zip(addrs, found):
+            if ident < 0:
+                continue
+            if collapse and res and res[-1] == ident and addr != self.starts[ident]:
+                continue
+            res.append(ident)
+        return res
+
+    def __getitem__(self, addr: int) -> V:
+        """
+        Get the value of the range containing an address
+        """
+        pos = self.index(addr)
+        if pos < 0:
+            raise KeyError(addr)
+        return self.values[pos]
+
+    def __contains__(self, addr: object) -> bool:
+        """
+        Check whether a range contains an address
+        """
+        return isinstance(addr, int) and self.index(addr) >= 0
+
+    def __iter__(self) -> Iterator[Tuple[int, int, V]]:
+        """
+        Iterate over the start, end and value of each range, in order
+        """
+        return zip(self.starts, self.ends, self.values)
+
+    def __len__(self) -> int:
+        """
+        Get the number of ranges
+        """
+        return len(self.values)
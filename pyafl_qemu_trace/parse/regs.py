@@ -2,7 +2,9 @@
 Constant regexes for the trace parser
 """
 
-from re import compile  # pylint: disable=redefined-builtin
+from enum import IntFlag
+from functools import lru_cache
+from re import MULTILINE, Pattern, compile  # pylint: disable=redefined-builtin
 
 # Regex to match the lines in an output that contain the traced addresses
 TRACE_RE = compile(
@@ -35,16 +37,112 @@ STRACE_RE = compile(
 )
 
 MAPPING_RES = {
-    "guest_base": compile(rb"guest_base\s+0x(?P<guest_base>[0-9a-fA-F]+)"),
-    "start_brk": compile(rb"start_brk\s+0x(?P<start_brk>[0-9a-fA-F]+)"),
-    "start_code": compile(rb"start_code\s+0x(?P<start_code>[0-9a-fA-F]+)"),
-    "end_code": compile(rb"end_code\s+0x(?P<end_code>[0-9a-fA-F]+)"),
-    "start_data": compile(rb"start_data\s+0x(?P<start_data>[0-9a-fA-F]+)"),
-    "end_data": compile(rb"end_data\s+0x(?P<end_data>[0-9a-fA-F]+)"),
-    "start_stack": compile(rb"start_stack\s+0x(?P<start_stack>[0-9a-fA-F]+)"),
-    "brk": compile(rb"brk\s+0x(?P<brk>[0-9a-fA-F]+)"),
-    "entry": compile(rb"entry\s+0x(?P<entry>[0-9a-fA-F]+)"),
-    "argv_start": compile(rb"argv_start\s+0x(?P<argv_start>[0-9a-fA-F]+)"),
-    "env_start": compile(rb"env_start\s+0x(?P<env_start>[0-9a-fA-F]+)"),
-    "auxv_start": compile(rb"auxv_start\s+0x(?P<auxv_start>[0-9a-fA-F]+)"),
+    "guest_base": compile(rb"\bguest_base\s+0x(?P<guest_base>[0-9a-fA-F]+)"),
+    "start_brk": compile(rb"\bstart_brk\s+0x(?P<start_brk>[0-9a-fA-F]+)"),
+    "start_code": compile(rb"\bstart_code\s+0x(?P<start_code>[0-9a-fA-F]+)"),
+    "end_code": compile(rb"\bend_code\s+0x(?P<end_code>[0-9a-fA-F]+)"),
+    "start_data": compile(rb"\bstart_data\s+0x(?P<start_data>[0-9a-fA-F]+)"),
+    "end_data": compile(rb"\bend_data\s+0x(?P<end_data>[0-9a-fA-F]+)"),
+    "start_stack": compile(rb"\bstart_stack\s+0x(?P<start_stack>[0-9a-fA-F]+)"),
+    "brk": compile(rb"\bbrk\s+0x(?P<brk>[0-9a-fA-F]+)"),
+    "entry": compile(rb"\bentry\s+0x(?P<entry>[0-9a-fA-F]+)"),
+    "argv_start": compile(rb"\bargv_start\s+0x(?P<argv_start>[0-9a-fA-F]+)"),
+    "env_start": compile(rb"\benv_start\s+0x(?P<env_start>[0-9a-fA-F]+)"),
+    "auxv_start": compile(rb"\bauxv_start\s+0x(?P<auxv_start>[0-9a-fA-F]+)"),
 }
+
+
+class Records(IntFlag):
+    """
+    Kinds of records to parse from a log
+    """
+
+    # Guest addresses of executed blocks
+    ADDRS = 1
+    # Memory mapping dumps
+    MAPS = 2
+    # Syscalls
+    SYSCALLS = 4
+    # Mapping information printed at startup
+    MAPPING = 8
+    # Host address and flags of the translation block of each guest block
+    TBS = 16
+
+    DEFAULT = ADDRS | MAPS | SYSCALLS | MAPPING
+    ALL = DEFAULT | TBS
+
+
+# Start of a line that starts a new record: a trace line, a syscall or a memory
+# mapping dump
+RECORD_START = rb"Trace\s|[0-9]+\s+\w+\(|start\s+end\s+size\s+prot\n"
+
+# Alternatives of `record_re` for each kind of record
+RECORD_ALTS = {
+    Records.ADDRS: (
+        rb"Trace\s+[0-9]+:\s+0x[0-9a-fA-F]+\s+"
+        rb"\[[0-9a-fA-F]+\/(?P<guest_addr>[0-9a-fA-F]+)\/0x[0-9a-fA-F]+\]"
+    ),
+    Records.TBS: (
+        rb"Trace\s+[0-9]+:\s+0x(?P<tb_host>[0-9a-fA-F]+)\s+"
+        rb"\[(?P<tb_flags>[0-9a-fA-F]+)\/(?P<guest_addr>[0-9a-fA-F]+)"
+        rb"\/0x(?P<tb_cflags>[0-9a-fA-F]+)\]"
+    ),
+    Records.MAPS: (
+        rb"(?P<mmap>start\s+end\s+size\s+prot\n"
+        rb"(?:[0-9a-fA-F]+-[0-9a-fA-F]+\s+[0-9a-fA-F]+\s+[rwx-]+[\n]?)+)"
+    ),
+    Records.MAPPING: (
+        rb"(?P<mapping_name>"
+        + b"|".join(name.encode("utf-8") for name in MAPPING_RES)
+        + rb")\s+0x(?P<mapping_value>[0-9a-fA-F]+)"
+    ),
+    Records.SYSCALLS: (
+        rb"[0-9]+\s+(?P<syscall_name>\w+)\((?P<syscall_args>[^\)]*)\)"
+        # A syscall that never returns ends at the next record
+        rb"(?:[^=\n]|\n(?!" + RECORD_START + rb"))*=\s*(?P<syscall_ret>[-]?[0-9]+)"
+        rb"(?:\s?errno\s?=\s?(?P<syscall_errno>[-]?[0-9]+)\s?"
+        rb"\((?P<syscall_errmsg>[^\)]+)\))?"
+    ),
+}
+
+
+@lru_cache(maxsize=None)
+def record_re(records: Records) -> "Pattern[bytes]":
+    """
+    Get a regex that matches the selected kinds of records in a single pass,
+    anchored at the start of a line. The record type is given by the `lastgroup` of
+    the match: `guest_addr` (or `tb_cflags` when `TBS` are selected) for a trace
+    line, `mmap` for a memory mapping dump, `mapping_value` for a mapping
+    information line and `syscall_ret` or `syscall_errmsg` for a syscall. Unlike
+    `STRACE_RE`, a syscall that never returns does not swallow the trace lines that
+    follow it.
+
+    Trace lines are always matched, since the other records are keyed by the
+    number of trace lines before them, but their TB fields are only captured if
+    `TBS` are selected. Other kinds that are not selected are not matched at all.
+
+    :param records: The kinds of records to match
+    """
+    kinds = [Records.TBS if records & Records.TBS else Records.ADDRS]
+    kinds.extend(
+        kind
+        for kind in (Records.MAPS, Records.MAPPING, Records.SYSCALLS)
+        if records & kind
+    )
+
+    alts = [RECORD_ALTS[kind] for kind in kinds]
+    return compile(rb"^(?:" + b"|".join(alts) + rb")", MULTILINE)
+
+
+# Regex to match any record in a single pass
+RECORD_RE = record_re(Records.DEFAULT)
+
+# Regex to extract only the guest addresses of trace lines
+ADDR_RE = compile(
+    rb"^Trace\s+[0-9]+:\s+0x[0-9a-fA-F]+\s+"
+    rb"\[[0-9a-fA-F]+\/([0-9a-fA-F]+)\/0x[0-9a-fA-F]+\]",
+    MULTILINE,
+)
+
+# Regex to match the newline before a line that starts a new record
+RECORD_START_RE = compile(rb"\n(?=" + RECORD_START + rb")")
@@ -0,0 +1,115 @@
+"""
+Reading afl qemu trace logs from the places they can be parsed from
+
+Logs are parsed from bytes-like objects without copying them, from files through a
+read-only memory mapping, and from compressed files by decompressing them piece by
+piece.
+"""
+
+from contextlib import contextmanager
+from mmap import ACCESS_READ, mmap
+from pathlib import Path
+from typing import Any, Callable, Iterator, Union
+
+from pyafl_qemu_trace.parse.compressed import is_compressed, read_log
+
+Log = Union[Path, bytes, bytearray, memoryview]
+
+
+def map_log(path: Path) -> Union[bytes, mmap]:
+    """
+    Map a log file into memory read-only, so that it is paged in by the kernel as it
+    is scanned instead of being copied into memory first
+
+    :param path: The log file
+    """
+    with open(path, "rb") as fil:
+        if fil.seek(0, 2) == 0:
+            # Empty files cannot be mapped
+            return b""
+        return mmap(fil.fileno(), 0, access=ACCESS_READ)
+
+
+@contextmanager
+def mapped(path: Path) -> Iterator[Union[bytes, memoryview]]:
+    """
+    Map a log file into memory read-only for the duration of a block
+
+    :param path: The log file
+    """
+    buf = map_log(path)
+    if not isinstance(buf, mmap):
+        yield buf
+        return
+
+    view = memoryview(buf)
+    try:
+        yield view
+    finally:
+        view.release()
+        buf.close()
+
+
+def log_bytes(log: Log) -> Union[bytes, memoryview]:
+    """
+    Get the contents of a log given as a bytes-like object without copying them
+
+    :param log: The log contents
+    :return: The contents as bytes or as a byte-wise memoryview
+    """
+    if isinstance(log, bytes):
+        return log
+    if isinstance(log, (bytearray, memoryview)):
+        return memoryview(log).cast("B")
+    raise TypeError(f"log must be a bytes-like object or a Path, got {type(log)}")
+
+
+def log_buffer(log: Log) -> Union[bytes, mmap, memoryview]:
+    """
+    Get the whole contents of an uncompressed log, memory mapping it if it is a file.
+    Unlike with `log_contents`, the mapping stays open for as long as it is
+    referenced.
+
+    :param log: The log file, or its contents as any bytes-like object
+    """
+    if isinstance(log, Path):
+        if is_compressed(log):
+            raise ValueError(f"{log} is compressed and can only be read in pieces")
+        return map_log(log)
+    return log_bytes(log)
+
+
+@contextmanager
+def log_contents(log: Log) -> Iterator[Union[bytes, memoryview]]:
+    """
+    Get the whole contents of an uncompressed log for the duration of a block,
+    memory mapping it if it is a file
+
+    :param log: The log file, or its contents as any bytes-like object
+    """
+    if isinstance(log, Path):
+        if is_compressed(log):
+            raise ValueError(f"{log} is compressed and can only be read in pieces")
+        with mapped(log) as view:
+            yield view
+    else:
+        yield log_bytes(log)
+
+
+def feed_log(log: Log, sink: Callable[[Any], Any], piece_size: int) -> None:
+    """
+    Pass a log to a sink in consecutive pieces, decompressing it if it is a
+    compressed file
+
+    :param log: The log file, or its contents as any bytes-like object
+    :param sink: Called with each piece in order
+    :param piece_size: The size of the pieces
+    """
+    if isinstance(log, Path) and is_compressed(log):
+        for chunk in read_log(log, piece_size):
+            sink(chunk)
+        return
+
+    with log_contents(log) as contents, memoryview(contents) as view:
+        for pos in range(0, len(view), piece_size):
+            sink(view[pos : pos + piece_size])
@@ -0,0 +1,379 @@
+"""
+Binary, memory-mappable on-disk format for trace results
+
+A file starts with a fixed header holding the format version, the mapping
+information and a table of sections, followed by the sections themselves. Each
+section is aligned to 8 bytes so that the address sections can be memory mapped and
+used in place as arrays:
+
+    header      MAGIC, version, flags (whether the addresses are interned and
+                whether the trace was truncated), mapping presence bits, 13
+                mapping values, section count
+    sections    (kind, item size, offset, length) per section
+    ADDRS       little-endian guest addresses
+    TABLE/IDS   the block table and block IDs of `InternedAddrs` (instead of ADDRS)
+    MAPS        (index, start, end, size, prot) records
+    SYSCALLS    (index, ret, errno, flags, name/args/err lengths) records, each
+                followed by its strings
+    TBS         (guest address, host address, flags, cflags) records, only present
+                if translation blocks were parsed
+
+All integers are little-endian.
+"""
+
+from array import array
+from collections import defaultdict
+from mmap import ACCESS_READ, mmap
+from pathlib import Path
+from struct import Struct
+from sys import byteorder
+from typing import BinaryIO, Dict, List, Literal, Set, Tuple, Union
+
+from pyafl_qemu_trace.parse.addrs import InternedAddrs
+from pyafl_qemu_trace.parse.parse import MMap, Syscall, TraceResult, TranslationBlock
+
+MAGIC = b"PQTRACE\0"
+VERSION = 1
+
+# Mapping information fields, in the order they are stored
+MAPPING_FIELDS = (
+    "guest_base",
+    "start_brk",
+    "start_code",
+    "end_code",
+    "start_data",
+    "end_data",
+    "start_stack",
+    "brk",
+    "entry",
+    "argv_start",
+    "env_start",
+    "auxv_start",
+    "mmap_min",
+)
+
+# Section kinds
+ADDRS = 1
+TABLE = 2
+IDS = 3
+MAPS = 4
+SYSCALLS = 5
+TBS = 6
+
+HEADER = Struct(f"<8sHHI{len(MAPPING_FIELDS)}QI")
+SECTION = Struct("<HHIQQ")
+MAP_RECORD = Struct("<qQQQ4s")
+# Longest protection string a map record holds
+MAX_PROT = 4
+SYSCALL_RECORD = Struct("<qqqBHIH")
+TB_RECORD = Struct("<QQQQ")
+
+SYSCALL_HAS_ERRNO = 1
+SYSCALL_HAS_ERR = 2
+
+FLAG_INTERNED = 1
+FLAG_TRUNCATED = 2
+
+ALIGN = 8
+
+# Typecodes of unsigned integers, from narrowest to widest
+UnsignedTypecode = Literal["B", "H", "I", "L", "Q"]
+UNSIGNED_TYPECODES: Tuple[UnsignedTypecode, ...] = ("B", "H", "I", "L", "Q")
+
+# Sections of a file by kind, as (item size, contents)
+Sections = Dict[int, Tuple[int, memoryview]]
+
+
+def _pad(length: int) -> int:
+    """
+    Get the padding needed after `length` bytes to reach the next aligned offset
+    """
+    return -length % ALIGN
+
+
+def _le(arr: Union[array, memoryview]) -> bytes:
+    """
+    Get the contents of an array or array view as little-endian bytes
+    """
+    if byteorder != "little":
+        arr = array(arr.format if isinstance(arr, memoryview) else arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _addr_sections(res: TraceResult) -> List[Tuple[int, int, bytes]]:
+    """
+    Get the (kind, item size, contents) of the address sections of a result
+    """
+    addrs = res.addrs
+    if isinstance(addrs, InternedAddrs):
+        return [
+            (TABLE, addrs.table.itemsize, _le(addrs.table)),
+            (IDS, addrs.ids.itemsize, _le(addrs.ids)),
+        ]
+
+    return [(ADDRS, addrs.itemsize, _le(addrs))]
+
+
+def _maps_section(maps: Dict[int, Set[MMap]]) -> bytes:
+    """
+    Encode the memory mapping dumps of a result
+
+    :raises ValueError: If a protection string is too long for a map record
+    """
+    parts = []
+    for index in sorted(maps):
+        for mp in sorted(maps[index], key=lambda m: (m.start, m.end)):
+            prot = mp.prot.encode("utf-8")
+            if len(prot) > MAX_PROT:
+                raise ValueError(
+                    f"Protection {mp.prot!r} is longer than {MAX_PROT} characters"
+                )
+            parts.append(MAP_RECORD.pack(index, mp.start, mp.end, mp.size, prot))
+    return b"".join(parts)
+
+
+def _syscalls_section(syscalls: Dict[int, Syscall]) -> bytes:
+    """
+    Encode the syscalls of a result
+    """
+    parts = []
+    for index in sorted(syscalls):
+        sysc = syscalls[index]
+        name = sysc.name.encode("utf-8")
+        args = ",".join(sysc.args).encode("utf-8")
+        err = sysc.err.encode("utf-8") if sysc.err is not None else b""
+        flags = (SYSCALL_HAS_ERRNO if sysc.errno is not None else 0) | (
+            SYSCALL_HAS_ERR if sysc.err is not None else 0
+        )
+        parts.append(
+            SYSCALL_RECORD.pack(
+                index,
+                sysc.ret,
+                sysc.errno or 0,
+                flags,
+                len(name),
+                len(args),
+                len(err),
+            )
+        )
+        parts.extend((name, args, err))
+    return b"".join(parts)
+
+
+def _tbs_section(tbs: Dict[int, Set[TranslationBlock]]) -> bytes:
+    """
+    Encode the translation blocks of a result
+    """
+    return b"".join(
+        TB_RECORD.pack(guest_addr, tb.host_addr, tb.flags, tb.cflags)
+        for guest_addr in sorted(tbs)
+        for tb in sorted(tbs[guest_addr], key=lambda t: (t.host_addr, t.flags))
+    )
+
+
+def save(res: TraceResult, where: Union[Path, BinaryIO]) -> None:
+    """
+    Save a result in the binary format
+
+    :param res: The result to save
+    :param where: The path or binary file object to write to
+    """
+    sections = _addr_sections(res)
+    sections.append((MAPS, MAP_RECORD.size, _maps_section(res.maps)))
+    sections.append((SYSCALLS, 1, _syscalls_section(res.syscalls)))
+    if res.tbs:
+        sections.append((TBS, TB_RECORD.size, _tbs_section(res.tbs)))
+
+    present = 0
+    values = []
+    for bit, name in enumerate(MAPPING_FIELDS):
+        value = getattr(res, name)
+        if value is not None:
+            present |= 1 << bit
+        values.append(value or 0)
+
+    flags = FLAG_INTERNED if isinstance(res.addrs, InternedAddrs) else 0
+    if res.truncated:
+        flags |= FLAG_TRUNCATED
+    header = HEADER.pack(MAGIC, VERSION, flags, present, *values, len(sections))
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    offset += _pad(offset)
+    table = []
+    for kind, itemsize, contents in sections:
+        table.append(SECTION.pack(kind, itemsize, 0, offset, len(contents)))
+        offset += len(contents) + _pad(len(contents))
+
+    if isinstance(where, Path):
+        with where.open("wb") as fil:
+            _write(fil, header, table, sections)
+    else:
+        _write(where, header, table, sections)
+
+
+def _write(
+    fil: BinaryIO,
+    header: bytes,
+    table: List[bytes],
+    sections: List[Tuple[int, int, bytes]],
+) -> None:
+    """
+    Write an encoded result to a file
+    """
+    head = header + b"".join(table)
+    fil.write(head + bytes(_pad(len(head))))
+    for _, _, contents in sections:
+        fil.write(contents)
+        fil.write(bytes(_pad(len(contents))))
+
+
+def _typecode(itemsize: int) -> UnsignedTypecode:
+    """
+    Get the unsigned typecode of the given size
+    """
+    for typecode in UNSIGNED_TYPECODES:
+        if array(typecode).itemsize == itemsize:
+            return typecode
+    raise ValueError(f"No typecode with item size {itemsize}")
+
+
+def _map(where: Path) -> memoryview:
+    """
+    Map a saved result into memory read-only
+    """
+    with where.open("rb") as fil:
+        if fil.seek(0, 2) == 0:
+            raise ValueError(f"{where} is empty")
+        return memoryview(mmap(fil.fileno(), 0, access=ACCESS_READ))
+
+
+def _read_header(where: Path, buf: memoryview) -> Tuple[int, int, List[int], Sections]:
+    """
+    Read the header and section table of a saved result
+
+    :return: The flags, the mapping presence bits, the mapping values and the
+        sections
+    """
+    if len(buf) < HEADER.size:
+        raise ValueError(f"{where} is not a trace file")
+
+    magic, version, flags, present, *rest = HEADER.unpack_from(buf)
+    values, count = rest[:-1], rest[-1]
+
+    if magic != MAGIC:
+        raise ValueError(f"{where} is not a trace file")
+    if version > VERSION:
+        raise ValueError(f"{where} has unsupported version {version}")
+
+    sections = {}
+    for i in range(count):
+        kind, itemsize, _, offset, length = SECTION.unpack_from(
+            buf, HEADER.size + i * SECTION.size
+        )
+        sections[kind] = (itemsize, buf[offset : offset + length])
+
+    return flags, present, values, sections
+
+
+def _addrs(sections: Sections, kind: int, copy: bool) -> Union[array, memoryview]:
+    """
+    Get the contents of an address section
+
+    :param sections: The sections of the file
+    :param kind: The kind of the section
+    :param copy: Copy the contents into an array instead of viewing them
+    """
+    itemsize, contents = sections[kind]
+    view = contents.cast(_typecode(itemsize))
+    if copy or byteorder != "little":
+        arr = array(view.format, view)
+        if byteorder != "little":
+            arr.byteswap()
+        return arr
+    return view
+
+
+def _load_maps(contents: memoryview, maps: Dict[int, Set[MMap]]) -> None:
+    """
+    Decode the memory mapping dumps of a result
+    """
+    for index, start, end, size, prot in MAP_RECORD.iter_unpack(contents):
+        maps[index].add(MMap(start, end, size, prot.rstrip(b"\0").decode("utf-8")))
+
+
+def _load_syscalls(contents: memoryview, syscalls: Dict[int, Syscall]) -> None:
+    """
+    Decode the syscalls of a result
+    """
+
+    def string(pos: int, length: int) -> str:
+        """
+        Decode a string following a record
+        """
+        return bytes(contents[pos : pos + length]).decode("utf-8")
+
+    pos = 0
+    while pos < len(contents):
+        index, ret, errno, flags, nlen, alen, elen = SYSCALL_RECORD.unpack_from(
+            contents, pos
+        )
+        pos += SYSCALL_RECORD.size
+        name, args, err = (
+            string(pos, nlen),
+            string(pos + nlen, alen),
+            string(pos + nlen + alen, elen),
+        )
+        pos += nlen + alen + elen
+        syscalls[index] = Syscall(
+            name,
+            ret,
+            args.split(","),
+            errno if flags & SYSCALL_HAS_ERRNO else None,
+            err if flags & SYSCALL_HAS_ERR else None,
+        )
+
+
+def _load_tbs(contents: memoryview, tbs: Dict[int, Set[TranslationBlock]]) -> None:
+    """
+    Decode the translation blocks of a result
+    """
+    for guest_addr, host_addr, flags, cflags in TB_RECORD.iter_unpack(contents):
+        tbs.setdefault(guest_addr, set()).add(
+            TranslationBlock(host_addr, flags, cflags)
+        )
+
+
+def load(where: Path, copy: bool = False) -> TraceResult:
+    """
+    Load a result saved in the binary format
+
+    By default the file is memory mapped and the addresses of the result are
+    read-only `memoryview`s of the mapping, so loading takes constant time and pages
+    of the trace are only read when they are accessed.
+
+    :param where: The path to load from
+    :param copy: Copy the addresses into arrays instead of mapping them
+    """
+    flags, present, values, sections = _read_header(where, _map(where))
+
+    addrs: Union[array, InternedAddrs, memoryview]
+    if flags & FLAG_INTERNED:
+        addrs = InternedAddrs.from_parts(
+            _addrs(sections, TABLE, copy), _addrs(sections, IDS, copy)
+        )
+    else:
+        addrs = _addrs(sections, ADDRS, copy)
+    res = TraceResult(addrs, defaultdict(set), {})
+
+    res.truncated = bool(flags & FLAG_TRUNCATED)
+    for bit, name in enumerate(MAPPING_FIELDS):
+        if present & (1 << bit):
+            setattr(res, name, values[bit])
+
+    _load_maps(sections[MAPS][1], res.maps)
+    _load_syscalls(sections[SYSCALLS][1], res.syscalls)
+    if TBS in sections:
+        _load_tbs(sections[TBS][1], res.tbs)
+
+    return res
@@ -0,0 +1,288 @@
+"""
+Incremental parsing of afl qemu trace logs as they are produced
+"""
+
+from array import array
+from collections import defaultdict
+from typing import FrozenSet, Iterable, List, Optional, Set, Tuple, Union
+
+from attr import define
+
+from pyafl_qemu_trace import addr_typecode
+from pyafl_qemu_trace.parse.parse import MMap, Syscall, TraceParser, TraceResult
+from pyafl_qemu_trace.parse.regs import MAPPING_RES, RECORD_START_RE, Records
+
+# Amount of log data to hold back while waiting for a record boundary, beyond which
+# the complete lines held back are parsed as they are and a line that is still
+# incomplete is dropped
+MAX_PENDING = 1 << 22
+
+
+@define(frozen=True, slots=True)
+class AddrsEvent:  # pylint: disable=too-few-public-methods
+    """
+    A run of consecutive guest addresses
+    """
+
+    # Index in the full trace of the first address in the run
+    start: int
+    addrs: array
+
+
+@define(frozen=True, slots=True)
+class MapsEvent:  # pylint: disable=too-few-public-methods
+    """
+    A memory mapping dump
+    """
+
+    # Index of the last address before the dump
+    index: int
+    maps: FrozenSet[MMap]
+
+
+@define(frozen=True, slots=True)
+class SyscallEvent:  # pylint: disable=too-few-public-methods
+    """
+    A syscall
+    """
+
+    # Index of the last address before the syscall
+    index: int
+    syscall: Syscall
+
+
+@define(frozen=True, slots=True)
+class MappingEvent:  # pylint: disable=too-few-public-methods
+    """
+    A field of the mapping information printed at startup
+    """
+
+    name: str
+    value: int
+
+
+TraceEvent = Union[AddrsEvent, MapsEvent, SyscallEvent, MappingEvent]
+
+
+class TraceStream:
+    """
+    Incremental parser for afl qemu trace logs
+
+    Chunks of the log are passed to `feed` in order, split anywhere, and the events
+    for every record completed so far are returned. Only the trailing incomplete
+    record is buffered, up to `MAX_PENDING` bytes, and only the new part of it is
+    searched for the start of the next record, so memory use does not grow with the
+    length of the log and feeding takes time linear in it.
+    """
+
+    def __init__(
+        self,
+        platform: Optional[str] = None,
+        vectorize: Optional[bool] = None,
+        records: Records = Records.DEFAULT,
+    ) -> None:
+        """
+        Initialize the stream
+
+        :param platform: The platform the log was traced on, which determines the
+            size of the addresses in the events
+        :param vectorize: Whether to use the NumPy backend, by default if available
+        :param records: The kinds of records to produce events for, which cannot
+            include `Records.TBS`
+        """
+        if records & Records.TBS:
+            raise ValueError("Translation blocks cannot be parsed incrementally")
+
+        self._platform = platform
+        self._vectorize = vectorize
+        self._records = records
+        self._pending = bytearray()
+        # Position in `_pending` of the newline that the search for the next record
+        # resumes at, since the line after it may still be incomplete
+        self._scanned = 0
+        # Whether the rest of an overlong line is being dropped
+        self._dropping = False
+        self._count = 0
+        self._mapping: Set[str] = set()
+
+    @property
+    def count(self) -> int:
+        """
+        The number of trace lines parsed so far
+        """
+        return self._count
+
+    def feed(self, chunk: bytes) -> List[TraceEvent]:
+        """
+        Feed the next chunk of the log to the parser
+
+        :param chunk: The next chunk of the log
+        :return: The events for records completed by this chunk
+        """
+        if self._dropping:
+            end = chunk.find(b"\n")
+            if end < 0:
+                return []
+            self._dropping = False
+            chunk = chunk[end:]
+
+        self._pending += chunk
+        cut = self._cut()
+        if cut <= 0 and len(self._pending) > MAX_PENDING:
+            # No record starts in too long a stretch of log, so rather than hold on
+            # to it, the complete lines are parsed as they are
+            cut = self._pending.rfind(b"\n") + 1
+            if cut <= 0:
+                self._pending.clear()
+                self._scanned = 0
+                self._dropping = True
+                return []
+
+        if cut <= 0:
+            return []
+
+        contents = bytes(self._pending[:cut])
+        del self._pending[:cut]
+        self._scanned = max(self._scanned - cut, 0)
+        return self._events(contents)
+
+    def close(self) -> List[TraceEvent]:
+        """
+        Signal the end of the log
+
+        :return: The events for any records still buffered
+        """
+        contents = bytes(self._pending)
+        self._pending.clear()
+        self._scanned = 0
+        self._dropping = False
+        return self._events(contents) if contents else []
+
+    def _cut(self) -> int:
+        """
+        Find the position in the buffered log up to which every record is complete,
+        which is the start of the last line that begins a new record, searching only
+        what was added since the last search
+
+        :return: The cut position, or 0 if there is none yet
+        """
+        start = self._scanned
+        # Trace lines are by far the most common record, so avoid the regex if
+        # possible
+        cut = self._pending.rfind(b"\nTrace ", start) + 1
+        if cut <= 0:
+            for mtch in RECORD_START_RE.finditer(self._pending, start):
+                cut = mtch.end()
+        self._scanned = max(self._pending.rfind(b"\n", start), start)
+        return cut
+
+    def _events(self, contents: bytes) -> List[TraceEvent]:
+        """
+        Parse a run of complete records into events
+
+        :param contents: The records to parse
+        """
+        offset = self._count
+        addrs = array(addr_typecode(self._platform))
+        res = TraceResult(addrs, defaultdict(set), {})
+        self._count += TraceParser.scan(
+            contents, res, offset, self._vectorize, self._records
+        )
+
+        events: List[TraceEvent] = []
+
+        for name in MAPPING_RES:
+            value = getattr(res, name)
+            if value is not None and name not in self._mapping:
+                self._mapping.add(name)
+                events.append(MappingEvent(name, value))
+
+        records: List[Tuple[int, Union[MapsEvent, SyscallEvent]]] = []
+        records.extend((i, MapsEvent(i, frozenset(m))) for i, m in res.maps.items())
+        records.extend((i, SyscallEvent(i, s)) for i, s in res.syscalls.items())
+        records.sort(key=lambda r: r[0])
+
+        # Split the addresses around the other records so the events stay in order
+        taken = 0
+        for index, event in records:
+            until = min(index - offset + 1, len(addrs))
+            if until > taken:
+                events.append(AddrsEvent(offset + taken, addrs[taken:until]))
+                taken = until
+            events.append(event)
+
+        if taken < len(addrs):
+            events.append(AddrsEvent(offset + taken, addrs[taken:]))
+
+        return events
+
+
+class TraceCollector:
+    """
+    Log sink that incrementally parses chunks of a log into a single result, for use
+    as the `log_sink` of `TraceRunner.run` to parse a trace while it is running
+    """
+
+    def __init__(
+        self,
+        platform: Optional[str] = None,
+        compact: bool = False,
+        vectorize: Optional[bool] = None,
+        records: Records = Records.DEFAULT,
+    ) -> None:
+        """
+        Initialize the collector
+
+        :param platform: The platform the log was traced on, which determines the
+            size of the stored addresses
+        :param compact: Store the addresses as `InternedAddrs`
+        :param vectorize: Whether to use the NumPy backend, by default if available
+        :param records: The kinds of records to parse, which cannot include
+            `Records.TBS`
+        """
+        self._stream = TraceStream(platform, vectorize, records)
+        self._result = TraceParser.result(platform, compact)
+
+    def __call__(self, chunk: bytes) -> None:
+        """
+        Parse the next chunk of the log
+
+        :param chunk: The next chunk of the log
+        """
+        self.apply(self._stream.feed(chunk))
+
+    def close(self) -> TraceResult:
+        """
+        Parse any remaining records and return the result
+        """
+        self.apply(self._stream.close())
+        return self._result
+
+    def apply(self, events: Iterable[TraceEvent]) -> None:
+        """
+        Add events to the result
+
+        :param events: The events to add
+        """
+        res = self._result
+        addrs = res.growable_addrs()
+        for event in events:
+            if isinstance(event, AddrsEvent):
+                addrs.extend(event.addrs)
+            elif isinstance(event, MapsEvent):
+                res.maps[event.index].update(event.maps)
+            elif isinstance(event, SyscallEvent):
+                res.syscalls[event.index] = event.syscall
+            elif isinstance(event, MappingEvent):
+                setattr(res, event.name, event.value)
+
+
+def collect(events: Iterable[TraceEvent]) -> TraceResult:
+    """
+    Build a result from a sequence of events, such as those from `TraceParser.stream`
+
+    :param events: The events to collect
+    """
+    collector = TraceCollector()
+    collector.apply(events)
+    return collector.close()
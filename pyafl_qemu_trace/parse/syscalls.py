@@ -0,0 +1,259 @@
+"""
+Columnar storage of the syscalls of a trace
+
+A `Syscall` per record, each with a list of argument strings, is several hundred
+bytes per syscall and slow to query in bulk. `SyscallTable` keeps one array per
+field instead: the index each syscall was logged after, an ID into a table of
+syscall names, the return value, the errno and an ID into a table of error
+messages, with the arguments of all syscalls concatenated into one buffer. Queries
+such as finding every failing `open` or counting syscalls by name run over the
+arrays, with NumPy if it is installed.
+"""
+
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from re import Match
+from typing import Dict, Iterator, List, Mapping, Optional
+
+from pyafl_qemu_trace.parse import vectorized
+from pyafl_qemu_trace.parse.parse import Syscall
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+# Errno of syscalls that did not log one
+NO_ERRNO = -(1 << 63)
+
+
+class SyscallTable(Mapping[int, Syscall]):
+    """
+    Syscalls of a trace stored as columns, which is a read-only mapping of index in
+    the trace to `Syscall` like `TraceResult.syscalls`
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize an empty table
+        """
+        # Index of the last address before each syscall, in the order logged
+        self.indices = array("q")
+        # ID in `names` of the name of each syscall
+        self.name_ids = array("I")
+        self.names: List[str] = []
+        self.rets = array("q")
+        # Errno of each syscall, or `NO_ERRNO`
+        self.errnos = array("q")
+        # ID in `errs` of the error message of each syscall, or -1
+        self.err_ids = array("i")
+        self.errs: List[str] = []
+        # Comma separated arguments of all syscalls, and where those of each end
+        self.args = bytearray()
+        self.arg_ends = array("Q")
+        self._name_ids: Dict[bytes, int] = {}
+        self._err_ids: Dict[bytes, int] = {}
+
+    @classmethod
+    def from_syscalls(cls, syscalls: Mapping[int, Syscall]) -> "SyscallTable":
+        """
+        Create a table from `Syscall` objects
+
+        :param syscalls: The syscalls by index, such as `TraceResult.syscalls`
+        """
+        table = cls()
+        for index in sorted(syscalls):
+            sysc = syscalls[index]
+            table.add(
+                index,
+                sysc.name.encode("utf-8"),
+                sysc.ret,
+                ",".join(sysc.args).encode("utf-8"),
+                NO_ERRNO if sysc.errno is None else sysc.errno,
+                None if sysc.err is None else sysc.err.encode("utf-8"),
+            )
+        return table
+
+    def to_syscalls(self) -> Dict[int, Syscall]:
+        """
+        Convert the table to `Syscall` objects by index
+        """
+        return {self.indices[row]: self.syscall(row) for row in range(len(self))}
+
+    def add(  # pylint: disable=too-many-arguments
+        self,
+        index: int,
+        name: bytes,
+        ret: int,
+        args: bytes,
+        errno: int = NO_ERRNO,
+        err: Optional[bytes] = None,
+    ) -> None:
+        """
+        Add a syscall, which must not be logged before any syscall already added. A
+        syscall logged after the same index as the last one replaces it, like
+        assigning to `TraceResult.syscalls` does.
+
+        :param index: The index of the last address before the syscall
+        :param name: The name of the syscall
+        :param ret: The return value
+        :param args: The comma separated arguments
+        :param errno: The errno, or `NO_ERRNO`
+        :param err: The error message
+        """
+        if self.indices and index <= self.indices[-1]:
+            if index < self.indices[-1]:
+                raise ValueError("Syscalls must be added in the order they are logged")
+            self._pop()
+
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name.decode("utf-8"))
+        err_id = -1
+        if err is not None:
+            err_id = self._err_ids.get(err, -1)
+            if err_id < 0:
+                err_id = self._err_ids[err] = len(self.errs)
+                self.errs.append(err.decode("utf-8"))
+
+        self.indices.append(index)
+        self.name_ids.append(name_id)
+        self.rets.append(ret)
+        self.errnos.append(errno)
+        self.err_ids.append(err_id)
+        self.args += args
+        self.arg_ends.append(len(self.args))
+
+    def add_match(self, index: int, mtch: Match) -> None:
+        """
+        Add a syscall matched by `record_re`
+
+        :param index: The index of the last address before the syscall
+        :param mtch: The match of the syscall
+        """
+        name, args, ret, errno, err = mtch.group(
+            "syscall_name",
+            "syscall_args",
+            "syscall_ret",
+            "syscall_errno",
+            "syscall_errmsg",
+        )
+        self.add(index, name, int(ret), args, int(errno) if errno else NO_ERRNO, err)
+
+    def syscall(self, row: int) -> Syscall:
+        """
+        Get the syscall in a row of the table
+
+        :param row: The row, which is the position of the syscall in the trace
+        """
+        start = self.arg_ends[row - 1] if row > 0 else 0
+        errno = self.errnos[row]
+        err_id = self.err_ids[row]
+        return Syscall(
+            self.names[self.name_ids[row]],
+            self.rets[row],
+            self.args[start : self.arg_ends[row]].decode("utf-8").split(","),
+            None if errno == NO_ERRNO else errno,
+            None if err_id < 0 else self.errs[err_id],
+        )
+
+    def where(
+        self,
+        name: Optional[str] = None,
+        failed: Optional[bool] = None,
+        vectorize: Optional[bool] = None,
+    ) -> array:
+        """
+        Find the rows of the syscalls matching all of the given conditions
+
+        :param name: Only syscalls with this name
+        :param failed: Only syscalls that failed (returned a negative value) if True,
+            or that did not if False
+        :param vectorize: Whether to search with NumPy, by default if it is installed
+        :return: The rows, in the order the syscalls were logged
+        """
+        if vectorize is None:
+            vectorize = vectorized.available()
+        elif vectorize and not vectorized.available():
+            raise ValueError("The vectorized backend requires NumPy to be installed")
+
+        name_id = -1
+        if name is not None:
+            name_id = self._name_ids.get(name.encode("utf-8"), -1)
+            if name_id < 0:
+                return array("Q")
+
+        if vectorize:
+            mask = np.ones(len(self), dtype=bool)
+            if name is not None:
+                mask &= np.asarray(self.name_ids) == name_id
+            if failed is not None:
+                mask &= (np.asarray(self.rets) < 0) == failed
+            return array("Q", np.flatnonzero(mask).astype(np.uint64).tobytes())
+
+        return array(
+            "Q",
+            (
+                row
+                for row, (ident, ret) in enumerate(zip(self.name_ids, self.rets))
+                if (name is None or ident == name_id)
+                and (failed is None or (ret < 0) == failed)
+            ),
+        )
+
+    def histogram(self) -> Dict[str, int]:
+        """
+        Count the syscalls by name
+        """
+        if vectorized.available():
+            bins = np.bincount(np.asarray(self.name_ids), minlength=len(self.names))
+            return dict(zip(self.names, bins.tolist()))
+        counter = Counter(self.name_ids)
+        return {name: counter[ident] for ident, name in enumerate(self.names)}
+
+    def __getitem__(self, index: int) -> Syscall:
+        """
+        Get the syscall logged after an index
+        """
+        row = bisect_right(self.indices, index) - 1
+        if row < 0 or self.indices[row] != index:
+            raise KeyError(index)
+        return self.syscall(row)
+
+    def __contains__(self, index: object) -> bool:
+        """
+        Check whether a syscall was logged after an index
+        """
+        if not isinstance(index, int):
+            return False
+        row = bisect_right(self.indices, index) - 1
+        return row >= 0 and self.indices[row] == index
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Iterate over the indices syscalls were logged after, in order
+        """
+        return iter(self.indices)
+
+    def __len__(self) -> int:
+        """
+        Get the number of syscalls
+        """
+        return len(self.indices)
+
+    def _pop(self) -> None:
+        """
+        Remove the last syscall
+        """
+        for column in (
+            self.indices,
+            self.name_ids,
+            self.rets,
+            self.errnos,
+            self.err_ids,
+            self.arg_ends,
+        ):
+            column.pop()
+        del self.args[self.arg_ends[-1] if self.arg_ends else 0 :]
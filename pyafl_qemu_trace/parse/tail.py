@@ -0,0 +1,168 @@
+"""
+Parsing only the end of a trace, such as the blocks leading up to a crash
+
+`TailCollector` parses a log as it is produced like `TraceCollector`, but keeps the
+most recent addresses in a fixed-size ring buffer and only the most recent syscall
+and memory map records, so its memory use does not grow with the length of the
+trace.
+"""
+
+from array import array
+from collections import defaultdict, deque
+from typing import DefaultDict, Deque, Iterable, Optional, Set, Tuple
+
+from attr import define
+
+from pyafl_qemu_trace import addr_typecode
+from pyafl_qemu_trace.parse.parse import MMap, Syscall, TraceParser, TraceResult
+from pyafl_qemu_trace.parse.regs import Records
+from pyafl_qemu_trace.parse.stream import (
+    AddrsEvent,
+    MappingEvent,
+    MapsEvent,
+    SyscallEvent,
+    TraceEvent,
+    TraceStream,
+)
+
+
+@define(slots=True)
+class TraceTail:  # pylint: disable=too-few-public-methods
+    """
+    The end of a trace
+    """
+
+    # The last blocks of the trace as a trace of their own, where the indices of
+    # records are relative to the first block of the tail. The last memory map dump
+    # from before the tail is kept at index -1.
+    result: TraceResult
+    # The number of blocks in the whole trace
+    blocks: int
+
+    @property
+    def start(self) -> int:
+        """
+        The index in the whole trace of the first block of the tail
+        """
+        return self.blocks - len(self.result.addrs)
+
+
+class TailCollector:
+    """
+    Log sink that incrementally parses chunks of a log, keeping only its end, for
+    use as the `log_sink` of `TraceRunner.run`
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        length: int = 4096,
+        syscalls: int = 256,
+        maps: int = 16,
+        platform: Optional[str] = None,
+        vectorize: Optional[bool] = None,
+        records: Records = Records.DEFAULT,
+    ) -> None:
+        """
+        Initialize the collector
+
+        :param length: The number of most recent blocks to keep
+        :param syscalls: The number of most recent syscalls to keep
+        :param maps: The number of most recent memory map dumps to keep
+        :param platform: The platform the log was traced on, which determines the
+            size of the stored addresses
+        :param vectorize: Whether to use the NumPy backend, by default if available
+        :param records: The kinds of records to parse, which cannot include
+            `Records.TBS`
+        """
+        if length <= 0:
+            raise ValueError("The tail must keep at least one block")
+
+        self._stream = TraceStream(platform, vectorize, records)
+        self._result = TraceParser.result(platform)
+        typecode = addr_typecode(platform)
+        self._ring = array(typecode, bytes(array(typecode).itemsize * length))
+        # Position in the ring of the oldest block once it is full
+        self._pos = 0
+        self._blocks = 0
+        self._syscalls: Deque[Tuple[int, Syscall]] = deque(maxlen=syscalls)
+        self._maps: Deque[Tuple[int, Set[MMap]]] = deque(maxlen=maps)
+
+    @property
+    def blocks(self) -> int:
+        """
+        The number of blocks parsed so far
+        """
+        return self._blocks
+
+    def __call__(self, chunk: bytes) -> None:
+        """
+        Parse the next chunk of the log
+
+        :param chunk: The next chunk of the log
+        """
+        self.apply(self._stream.feed(chunk))
+
+    def close(self) -> TraceTail:
+        """
+        Parse any remaining records and return the end of the trace
+        """
+        self.apply(self._stream.close())
+
+        res = self._result
+        if self._blocks < len(self._ring):
+            res.addrs = self._ring[: self._blocks]
+        else:
+            res.addrs = self._ring[self._pos :] + self._ring[: self._pos]
+        start = self._blocks - len(res.addrs)
+
+        # Records from before the tail are left out, except for the last memory map
+        # dump, which still describes the memory the tail ran in
+        for index, syscall in self._syscalls:
+            if index >= start - 1:
+                res.syscalls[index - start] = syscall
+        maps: DefaultDict[int, Set[MMap]] = defaultdict(set)
+        before: Optional[Set[MMap]] = None
+        for index, mmaps in self._maps:
+            if index >= start - 1:
+                maps[index - start].update(mmaps)
+            else:
+                before = mmaps
+        if before is not None and -1 not in maps:
+            maps[-1] = before
+        res.maps = maps
+
+        return TraceTail(res, self._blocks)
+
+    def apply(self, events: Iterable[TraceEvent]) -> None:
+        """
+        Add events to the tail, dropping what falls out of it
+
+        :param events: The events to add
+        """
+        for event in events:
+            if isinstance(event, AddrsEvent):
+                self._push(event.addrs)
+            elif isinstance(event, MapsEvent):
+                self._maps.append((event.index, set(event.maps)))
+            elif isinstance(event, SyscallEvent):
+                self._syscalls.append((event.index, event.syscall))
+            elif isinstance(event, MappingEvent):
+                setattr(self._result, event.name, event.value)
+
+    def _push(self, addrs: array) -> None:
+        """
+        Add addresses to the ring, overwriting the oldest ones
+        """
+        ring = self._ring
+        count = len(addrs)
+        self._blocks += count
+        if count >= len(ring):
+            ring[:] = addrs[count - len(ring) :]
+            self._pos = 0
+            return
+
+        # Up to the end of the ring, then wrapping around to its start
+        first = min(count, len(ring) - self._pos)
+        ring[self._pos : self._pos + first] = addrs[:first]
+        ring[: count - first] = addrs[first:]
+        self._pos = (self._pos + count) % len(ring)
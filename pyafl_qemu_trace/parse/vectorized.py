@@ -0,0 +1,350 @@
+"""
+Vectorized extraction of guest addresses from afl qemu trace logs with NumPy
+
+This backend is optional and is only used when NumPy is installed (for example with
+`pip install pyafl-qemu-trace[numpy]`). Trace lines are located and hex-decoded with
+whole-buffer array operations, and only the comparatively rare mapping and syscall
+records are matched with `record_re`.
+"""
+
+from array import array
+from mmap import mmap
+from re import Match, Pattern, compile  # pylint: disable=redefined-builtin
+from typing import TYPE_CHECKING, Any, Tuple, Union
+
+from pyafl_qemu_trace.parse.regs import ADDR_RE, Records, record_re
+
+if TYPE_CHECKING:
+    from pyafl_qemu_trace.parse.addrs import InternedAddrs
+    from pyafl_qemu_trace.parse.parse import TraceResult
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+# Size of the pieces of log the vectorized operations work on at once, which bounds
+# the size of the temporary arrays
+PIECE_SIZE = 1 << 24
+
+# Widest guest address that fits in 64 bits
+MAX_DIGITS = 16
+
+TRACE_PREFIX = b"Trace "
+
+# Trace lines as the tracer prints them, with fields of at most `MAX_DIGITS` digits
+TRACE_LAYOUT_RE = compile(
+    rb"Trace (?P<number>[0-9]{1,16}): 0x(?P<host>[0-9a-fA-F]{1,16}) "
+    rb"\[(?P<flags>[0-9a-fA-F]{1,16})/(?P<guest>[0-9a-fA-F]{1,16})"
+    rb"/0x(?P<cflags>[0-9a-fA-F]{1,16})\]"
+)
+
+# Number of different layouts of trace lines in a piece of a log that are checked
+# with array operations, beyond which lines are matched one by one
+MAX_LAYOUTS = 8
+
+# Eight `True` bytes read as one word
+WORD_OF_TRUES = int.from_bytes(b"\x01" * 8, "little")
+
+if np is not None:
+    # Value of each byte as a hex digit, or 0xff for bytes that are not hex digits
+    HEX_LUT = np.full(256, 0xFF, dtype=np.uint8)
+    for _digit, _char in enumerate(b"0123456789abcdef"):
+        HEX_LUT[_char] = _digit
+        HEX_LUT[bytes([_char]).upper()[0]] = _digit
+    # Whether each byte is whitespace as matched by `\s`
+    IS_SPACE = np.zeros(256, dtype=bool)
+    IS_SPACE[list(b" \t\n\r\x0b\x0c")] = True
+
+
+def available() -> bool:
+    """
+    Check whether the vectorized backend can be used
+    """
+    return np is not None
+
+
+def decode_addrs(buf: Any, starts: Any, ends: Any) -> Tuple[Any, Any]:
+    """
+    Decode hex fields of a buffer into integers
+
+    :param buf: The buffer as a `uint8` array
+    :param starts: The start offset of each field
+    :param ends: The end offset of each field
+    :return: The values as a `uint64` array and a mask of the fields that are valid
+        hex numbers of at most 64 bits
+    """
+    widths = ends - starts
+    valid = (widths > 0) & (widths <= MAX_DIGITS)
+    width = int(widths[valid].max()) if valid.any() else 1
+
+    if not (widths[valid] == width).all():
+        # Decode one column of right-aligned digits at a time, treating the columns
+        # left of shorter fields as zeros
+        values = np.zeros(len(starts), dtype=np.uint64)
+        for col in range(width, 0, -1):
+            pos = ends - col
+            digits = HEX_LUT[buf[np.maximum(pos, 0)]]
+            digits[pos < starts] = 0
+            valid &= digits != 0xFF
+            values <<= np.uint64(4)
+            values |= digits
+        return values, valid
+
+    # Addresses are printed zero-padded to the target word size, so the fields are
+    # nearly always the same width and can be gathered as rows of a window view
+    # and packed pairwise into big-endian words
+    rows = np.lib.stride_tricks.sliding_window_view(buf, width)[
+        np.minimum(starts, len(buf) - width)
+    ]
+    digits = HEX_LUT[rows]
+    valid &= ~(digits == 0xFF).any(axis=1)
+
+    size = 8 if width > 8 else 4
+    padded = np.zeros((len(starts), size * 2), dtype=np.uint8)
+    padded[:, size * 2 - width :] = digits
+    packed = (padded[:, 0::2] << 4) | padded[:, 1::2]
+    values = packed.view(f">u{size}").ravel().astype(np.uint64)
+
+    return values, valid
+
+
+def last_line_end(buf: Any, start: int, end: int) -> int:
+    """
+    Find the end of the last complete line in part of a buffer
+
+    :param buf: The buffer as a `uint8` array
+    :param start: The start of the part to search
+    :param end: The end of the part to search
+    :return: The offset just past the last newline, or 0 if there is none
+    """
+    # Lines are short, so look at the end of the part first
+    for size in (1 << 12, end - start):
+        newlines = np.flatnonzero(buf[max(end - size, start) : end] == ord("\n"))
+        if len(newlines):
+            return max(end - size, start) + int(newlines[-1]) + 1
+    return 0
+
+
+def is_hex(block: Any) -> Any:
+    """
+    Check which bytes of a `uint8` array are hex digits, with arithmetic that wraps
+    around rather than a table lookup
+    """
+    return ((block - ord("0")) < 10) | (((block | 0x20) - ord("a")) < 6)
+
+
+def is_dec(block: Any) -> Any:
+    """
+    Check which bytes of a `uint8` array are decimal digits
+    """
+    return (block - ord("0")) < 10
+
+
+def same_layout(buf: Any, starts: Any, ends: Any, mtch: "Match[bytes]") -> Any:
+    """
+    Check which lines are trace lines laid out like one matched by `TRACE_LAYOUT_RE`,
+    with the same text between fields of the same widths
+
+    :param buf: The buffer as a `uint8` array
+    :param starts: The start offset of each line
+    :param ends: The end offset of each line
+    :param mtch: The match of a line
+    :return: A mask of the lines with the same layout
+    """
+    base, width = mtch.start(), mtch.end() - mtch.start()
+    # Rows are padded to whole words so they can be checked a word at a time
+    padded = -(-width // 8) * 8
+    if padded > len(buf):
+        return np.zeros(len(starts), dtype=bool)
+    rows = np.lib.stride_tricks.sliding_window_view(buf, padded)[
+        np.minimum(starts, len(buf) - padded)
+    ]
+
+    good = rows == np.append(buf[base : base + width], [0] * (padded - width))
+    good[:, width:] = True
+    for group in TRACE_LAYOUT_RE.groupindex:
+        lo, hi = (offset - base for offset in mtch.span(group))
+        good[:, lo:hi] = (is_dec if group == "number" else is_hex)(rows[:, lo:hi])
+
+    same = (good.view(np.uint64) == WORD_OF_TRUES).all(axis=1)
+    return same & (starts + width <= ends) & (starts <= len(buf) - padded)
+
+
+def trace_lines(buf: Any) -> Tuple[Any, Any, Any]:
+    """
+    Find the lines of a piece of a log and those that start like a trace line
+
+    :param buf: The piece as a `uint8` array, which must start at a line start and
+        end at a line end
+    :return: The offsets of the starts of all lines, and of the starts and ends of
+        the lines that start like a trace line
+    """
+    newlines = np.flatnonzero(buf == ord("\n"))
+    starts = np.concatenate(([0], newlines + 1))
+    starts = starts[starts < len(buf)]
+    ends = np.append(newlines, len(buf))[: len(starts)]
+
+    maybe = starts + len(TRACE_PREFIX) <= ends
+    for i, char in enumerate(TRACE_PREFIX[:-1]):
+        maybe[maybe] &= buf[starts[maybe] + i] == char
+    maybe[maybe] &= IS_SPACE[buf[starts[maybe] + len(TRACE_PREFIX) - 1]]
+
+    return starts, starts[maybe], ends[maybe]
+
+
+def trace_fields(buf: Any, base: int) -> Tuple[Any, Any, Any]:
+    """
+    Find the trace lines in a piece of a log and decode their guest addresses
+
+    Lines are trace lines exactly when `ADDR_RE` matches them. Trace lines are nearly
+    always printed the same way, so the first few layouts matched by
+    `TRACE_LAYOUT_RE` are checked against all lines at once, and only the rest are
+    matched with `ADDR_RE` one by one.
+
+    :param buf: The piece as a `uint8` array, which must start at a line start and
+        end at a line end
+    :param base: The offset of the piece in the log
+    :return: The offsets in the log of the starts of all lines, of the trace lines and
+        the guest addresses of the trace lines
+    """
+    starts, tstarts, tends = trace_lines(buf)
+    ok = np.zeros(len(tstarts), dtype=bool)
+    values = np.zeros(len(tstarts), dtype=np.uint64)
+
+    pending = np.arange(len(tstarts))
+    layouts = 0
+    while len(pending):
+        line = int(pending[0])
+        mtch = None
+        if layouts < MAX_LAYOUTS:
+            mtch = TRACE_LAYOUT_RE.match(buf, tstarts[line], tends[line])
+
+        if mtch is None:
+            mtch = ADDR_RE.match(buf, tstarts[line], tends[line])
+            if mtch is not None:
+                ok[line] = True
+                values[line] = int(mtch.group(1), base=16)
+            pending = pending[1:]
+            continue
+
+        layouts += 1
+        same = same_layout(buf, tstarts[pending], tends[pending], mtch)
+        if not same[0]:
+            # The line is too close to the end of the piece to check as a row
+            same[0] = True
+        lines = pending[same]
+        lo, hi = (offset - mtch.start() for offset in mtch.span("guest"))
+        ok[lines] = True
+        values[lines] = decode_addrs(buf, tstarts[lines] + lo, tstarts[lines] + hi)[0]
+        pending = pending[~same]
+
+    return starts + base, tstarts[ok] + base, values[ok]
+
+
+def add_addrs(addrs: Union[array, "InternedAddrs"], values: Any) -> None:
+    """
+    Add decoded guest addresses to the addresses of a result
+
+    :param addrs: The addresses of the result
+    :param values: The guest addresses as a `uint64` array
+    :raises OverflowError: If an address is too wide for the typecode of `addrs`,
+        like when adding it to an array
+    """
+    bits = 8 * array(addrs.typecode).itemsize
+    if bits < 64 and len(values) and int(values.max()) >> bits:
+        raise OverflowError(
+            f"Guest address {int(values.max()):#x} does not fit in {bits} bits"
+        )
+
+    values = values.astype(addrs.typecode, copy=False)
+    if isinstance(addrs, array):
+        addrs.frombytes(memoryview(values).cast("B"))
+    else:
+        addrs.extend(values.tolist())
+
+
+def add_records(
+    contents: Union[bytes, mmap, memoryview],
+    res: "TraceResult",
+    regex: "Pattern[bytes]",
+    starts: Any,
+    indices: Any,
+    covered: int,
+) -> int:
+    """
+    Match the records other than trace lines that start at some lines of a log
+
+    :param contents: The log contents
+    :param res: The result to add the records to
+    :param regex: The regex matching the kinds of records to add
+    :param starts: The offsets of the lines as an array
+    :param indices: The index in the trace of the address each line follows
+    :param covered: The end of the last record matched so far
+    :return: The end of the last record matched
+    """
+    # pylint: disable=import-outside-toplevel
+    from pyafl_qemu_trace.parse.parse import TraceParser
+
+    for start, index in zip(starts.tolist(), indices.tolist()):
+        if start < covered:
+            continue
+        mtch = regex.match(contents, start)
+        if mtch is not None:
+            covered = mtch.end()
+            TraceParser.record(mtch, res, index)
+    return covered
+
+
+def scan(
+    contents: Union[bytes, mmap, memoryview],
+    res: "TraceResult",
+    offset: int = 0,
+    records: Records = Records.DEFAULT,
+) -> int:
+    """
+    Vectorized equivalent of `TraceParser.scan`, except that translation blocks are
+    not parsed
+
+    :param contents: The log contents, which must not end inside a record
+    :param res: The result to add the records to
+    :param offset: The number of addresses preceding `res.addrs` in the trace
+    :param records: The kinds of records to add
+    :return: The number of trace lines scanned
+    """
+    regex = record_re(records)
+    buf = np.frombuffer(contents, dtype=np.uint8)
+    addrs = res.growable_addrs() if records & Records.ADDRS else None
+    count = start_count = len(res.addrs)
+    # Records other than trace lines may span pieces, so track where the last one
+    # ended to skip the lines it covers
+    covered = 0
+    pos = 0
+
+    while pos < len(contents):
+        end = len(contents)
+        if end - pos > PIECE_SIZE:
+            end = last_line_end(buf, pos, pos + PIECE_SIZE) or end
+
+        starts, tstarts, values = trace_fields(buf[pos:end], pos)
+
+        if records & (Records.MAPS | Records.MAPPING | Records.SYSCALLS):
+            others = starts[buf[starts] != ord("T")]
+            others = others[others >= covered]
+            # Each record follows the last address before it
+            covered = add_records(
+                contents,
+                res,
+                regex,
+                others,
+                offset + count + np.searchsorted(tstarts, others) - 1,
+                covered,
+            )
+
+        count += len(values)
+        pos = end
+
+        if addrs is not None:
+            add_addrs(addrs, values)
+
+    return count - start_count
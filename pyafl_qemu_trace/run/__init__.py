@@ -3,4 +3,8 @@ Tools for running afl-qemu-trace programmatically from
 python.
 """
 
+from pyafl_qemu_trace.run.process import LogBuffer, LogBudget, LogFile
 from pyafl_qemu_trace.run.run import TraceRunner
+from pyafl_qemu_trace.run.pool import ForkServer, TracerPool
+from pyafl_qemu_trace.run.batch import BatchTracer, CoverageSink, TraceDirSink
+from pyafl_qemu_trace.run.cache import TraceCache
@@ -0,0 +1,408 @@
+"""
+Tracing and parsing whole corpora of inputs
+
+Inputs are traced on a pool of threads (each of which waits on a tracer process) and
+their logs are reduced to results, such as parsed traces or coverage maps, on a pool
+of processes. The number of inputs in flight is bounded, so a slow reducer holds up
+tracing instead of letting raw logs pile up in memory. Results are passed to a sink
+on the calling thread in the order they complete, and the names of finished inputs
+are appended to a journal so an interrupted batch can be resumed where it stopped.
+"""
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import ExitStack
+from functools import partial
+from itertools import islice
+from multiprocessing import get_all_start_methods, get_context
+from multiprocessing.context import BaseContext
+from os import cpu_count, replace
+from pathlib import Path
+from time import monotonic
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from attr import define, field
+
+from pyafl_qemu_trace import QEMUEvent
+from pyafl_qemu_trace.parse import CoverageMap, Records, TraceParser
+from pyafl_qemu_trace.parse.coverage import NOTHING_NEW
+from pyafl_qemu_trace.run.pool import TracerPool
+from pyafl_qemu_trace.run.run import TraceRunner
+
+# An input, as a file or a (name, contents) pair
+BatchInput = Union[Path, Tuple[str, bytes]]
+
+
+@define(frozen=True, slots=True)
+class BatchItem:  # pylint: disable=too-few-public-methods
+    """
+    The outcome of tracing one input
+    """
+
+    name: str
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+    # What the sink's reducer made of the log
+    result: Any
+
+
+@define(slots=True)
+class BatchStats:
+    """
+    Progress of a batch
+    """
+
+    # Inputs traced and passed to the sink
+    done: int = 0
+    # Inputs skipped because the journal lists them as done
+    skipped: int = 0
+    # Names of inputs that could not be traced or reduced, and why
+    failed: List[Tuple[str, BaseException]] = field(factory=list)
+    started: float = field(factory=monotonic)
+
+    @property
+    def inputs_per_sec(self) -> float:
+        """
+        The number of inputs finished per second since the batch started
+        """
+        return (self.done + len(self.failed)) / max(monotonic() - self.started, 1e-9)
+
+
+class TraceDirSink:
+    """
+    Sink that saves the parsed trace of every input to a directory in the binary
+    trace format, as `<name>.pqt`
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        platform: Optional[str] = None,
+        compact: bool = False,
+        records: Records = Records.DEFAULT,
+    ) -> None:
+        """
+        Initialize the sink
+
+        :param directory: The directory to save the traces in, which is created if
+            needed
+        :param platform: The platform the logs are traced on
+        :param compact: Store the addresses as `InternedAddrs`
+        :param records: The kinds of records to parse
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+        self.reducer = partial(
+            TraceParser.parse, platform=platform, compact=compact, records=records
+        )
+
+    def __call__(self, item: BatchItem) -> None:
+        """
+        Save the trace of an input
+        """
+        item.result.save(self.directory / f"{item.name}.pqt")
+
+
+class CoverageSink:
+    """
+    Sink that merges the edge coverage of every input and records which inputs
+    found new coverage, like a fuzzer's queue
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        code_range: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        """
+        Initialize the sink
+
+        :param path: A file to keep the merged coverage map in, so it survives
+            resuming the batch. It is loaded if it exists and rewritten whenever the
+            coverage grows.
+        :param code_range: Only count blocks with addresses in this half-open range
+        """
+        self.path = path
+        self.coverage = (
+            CoverageMap(path.read_bytes())
+            if path is not None and path.is_file()
+            else CoverageMap.empty()
+        )
+        self.interesting: List[str] = []
+        self.reducer = partial(TraceParser.coverage, code_range=code_range)
+
+    def __call__(self, item: BatchItem) -> None:
+        """
+        Merge the coverage of an input
+        """
+        if item.result.new(self.coverage) == NOTHING_NEW:
+            return
+
+        self.coverage |= item.result
+        self.interesting.append(item.name)
+        if self.path is not None:
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_bytes(self.coverage.data)
+            replace(tmp, self.path)
+
+
+def _reducer_context() -> BaseContext:
+    """
+    Get the multiprocessing context to start reducer processes with. They are
+    started while tracers are being started on other threads, and a plain fork would
+    copy the pipes `Popen` uses to wait for a tracer to start into the reducer,
+    blocking the tracing thread for as long as the reducer lives.
+    """
+    methods = get_all_start_methods()
+    return get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class BatchTracer:
+    """
+    Trace a binary on many inputs, reducing each log with a sink's `reducer` (which
+    must be picklable, such as a `functools.partial` of a module level function) and
+    passing the results to the sink
+
+    Reducer processes are not forked from the calling process, so like with the
+    `spawn` start method of `multiprocessing`, a script using a `BatchTracer` must
+    guard its entry point with `if __name__ == "__main__":`.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        platform: str,
+        binary: str,
+        argv: Optional[List[str]] = None,
+        envp: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        timeout: Optional[float] = None,
+        base_addr: Optional[int] = None,
+        record_events: Optional[List[QEMUEvent]] = None,
+        ld_preloads: Optional[List[str]] = None,
+        ld_library_paths: Optional[List[str]] = None,
+        tracers: Optional[int] = None,
+        reducers: Optional[int] = None,
+        fork_server: bool = True,
+        journal: Optional[Path] = None,
+        progress: Optional[Callable[[BatchStats], Any]] = None,
+    ) -> None:
+        """
+        Initialize the batch
+
+        :param platform: The platform to run the binary on
+        :param binary: The binary to run
+        :param argv: The arguments to the binary
+        :param envp: The environment of the binary
+        :param cwd: The working directory of the binary
+        :param timeout: The timeout (in seconds) of each trace
+        :param base_addr: The base address to load the binary at
+        :param record_events: The events to record, `DEFAULT_EVENTS` if not given
+        :param ld_preloads: Libraries to preload
+        :param ld_library_paths: Library search paths
+        :param tracers: The number of inputs to trace at once, by default the CPU
+            count
+        :param reducers: The number of processes to reduce logs on, by default the
+            CPU count. With 0, logs are reduced on the tracing threads.
+        :param fork_server: Trace with warm fork servers from a `TracerPool` rather
+            than starting the tracer for every input
+        :param journal: A file to append the name of every finished input to. Inputs
+            it already lists are skipped, so an interrupted batch resumes where it
+            stopped when run again with the same journal.
+        :param progress: Called with the statistics after every input
+        """
+        self.options: Dict[str, Any] = {
+            "platform": platform,
+            "binary": binary,
+            "argv": argv,
+            "envp": envp,
+            "cwd": cwd,
+            "timeout": timeout,
+            "base_addr": base_addr,
+            "record_events": record_events,
+            "ld_preloads": ld_preloads,
+            "ld_library_paths": ld_library_paths,
+        }
+        self.tracers = tracers or cpu_count() or 1
+        self.reducers = (cpu_count() or 1) if reducers is None else reducers
+        self.fork_server = fork_server
+        self.journal = journal
+        self.progress = progress
+        self.stats = BatchStats()
+
+    def run(
+        self,
+        inputs: Union[Path, Iterable[BatchInput]],
+        sink: Callable[[BatchItem], Any],
+    ) -> BatchStats:
+        """
+        Trace every input and pass the results to a sink
+
+        :param inputs: A directory of input files, or an iterable of input files and
+            (name, contents) pairs. Names must be unique.
+        :param sink: Called with each `BatchItem` on the calling thread. Its
+            `reducer` attribute, if any, is called with each log to make the result,
+            which is otherwise the log itself.
+        """
+        if isinstance(inputs, Path):
+            inputs = sorted(path for path in inputs.iterdir() if path.is_file())
+
+        done = set()
+        if self.journal is not None and self.journal.is_file():
+            done = set(self.journal.read_text().splitlines())
+
+        self.stats = BatchStats()
+        reducer = getattr(sink, "reducer", None)
+        # Without a reducer process pool, logs are reduced (if at all) right after
+        # they are traced
+        inline = reducer is None or not self.reducers
+
+        with ExitStack() as stack:
+            tracers = stack.enter_context(ThreadPoolExecutor(self.tracers))
+            reducers = (
+                None
+                if inline
+                else stack.enter_context(
+                    ProcessPoolExecutor(self.reducers, mp_context=_reducer_context())
+                )
+            )
+            journal = (
+                stack.enter_context(self.journal.open("a"))
+                if self.journal is not None
+                else None
+            )
+            if self.fork_server:
+                run: Callable[..., Any] = stack.enter_context(
+                    TracerPool(self.tracers)
+                ).run
+            else:
+                run = TraceRunner.run
+
+            self._schedule(
+                self._pending(inputs, done),
+                partial(self._trace, run, self.options, reducer if inline else None),
+                tracers,
+                reducers,
+                reducer,
+                partial(self._done, sink, journal),
+            )
+
+        return self.stats
+
+    def _pending(
+        self, inputs: Iterable[BatchInput], done: Set[str]
+    ) -> Iterator[Tuple[str, BatchInput]]:
+        """
+        Get the inputs that are not done yet, with their names
+        """
+        for inp in inputs:
+            name = inp.name if isinstance(inp, Path) else inp[0]
+            if name in done:
+                self.stats.skipped += 1
+            else:
+                yield name, inp
+
+    def _schedule(  # pylint: disable=too-many-arguments
+        self,
+        inputs: Iterator[Tuple[str, BatchInput]],
+        trace: Callable[[BatchInput], Tuple[int, bytes, bytes, Any]],
+        tracers: Executor,
+        reducers: Optional[Executor],
+        reducer: Optional[Callable[[Any], Any]],
+        done: Callable[[BatchItem], None],
+    ) -> None:
+        """
+        Trace and reduce inputs, with at most as many in flight as there are tracer
+        threads and reducer processes so that finished logs wait for a reducer for
+        at most as long as it takes to reduce one
+        """
+        limit = self.tracers + (self.reducers if reducers is not None else 0)
+        traces: Dict[Future, str] = {}
+        reductions: Dict[Future, Tuple[str, int, bytes, bytes]] = {}
+
+        while True:
+            for name, inp in islice(inputs, limit - len(traces) - len(reductions)):
+                traces[tracers.submit(trace, inp)] = name
+
+            if not traces and not reductions:
+                return
+
+            finished, _ = wait([*traces, *reductions], return_when=FIRST_COMPLETED)
+            for fut in finished:
+                if fut in traces:
+                    name = traces.pop(fut)
+                    if fut.exception() is not None:
+                        self._failed(name, fut.exception())  # type: ignore
+                    elif reducers is None:
+                        done(BatchItem(name, *fut.result()))
+                    else:
+                        returncode, stdout, stderr, log = fut.result()
+                        reductions[reducers.submit(reducer, log)] = (  # type: ignore
+                            name,
+                            returncode,
+                            stdout,
+                            stderr,
+                        )
+                else:
+                    name, returncode, stdout, stderr = reductions.pop(fut)
+                    if fut.exception() is not None:
+                        self._failed(name, fut.exception())  # type: ignore
+                    else:
+                        done(BatchItem(name, returncode, stdout, stderr, fut.result()))
+
+    def _done(
+        self,
+        sink: Callable[[BatchItem], Any],
+        journal: Optional[IO[str]],
+        item: BatchItem,
+    ) -> None:
+        """
+        Pass a finished input to the sink and record it in the journal
+        """
+        sink(item)
+        if journal is not None:
+            journal.write(f"{item.name}\n")
+            journal.flush()
+        self.stats.done += 1
+        if self.progress is not None:
+            self.progress(self.stats)
+
+    def _failed(self, name: str, exc: BaseException) -> None:
+        """
+        Record an input that failed, which is retried when the batch is resumed
+        """
+        self.stats.failed.append((name, exc))
+        if self.progress is not None:
+            self.progress(self.stats)
+
+    @staticmethod
+    def _trace(
+        run: Callable[..., Tuple[int, bytes, bytes, Any]],
+        options: Dict[str, Any],
+        reducer: Optional[Callable[[Any], Any]],
+        inp: BatchInput,
+    ) -> Tuple[int, bytes, bytes, Any]:
+        """
+        Trace one input, reducing its log if a reducer is given
+        """
+        data = inp.read_bytes() if isinstance(inp, Path) else inp[1]
+        returncode, stdout, stderr, log = run(input_data=data, **options)
+        return returncode, stdout, stderr, reducer(log) if reducer else log
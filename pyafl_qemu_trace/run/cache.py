@@ -0,0 +1,317 @@
+"""
+On-disk cache of parsed traces
+
+Tracing is deterministic for a given tracer, binary, command line, environment and
+input, so a parsed trace can be reused whenever all of them are the same. Entries are
+keyed by a SHA-256 hash of the contents of the tracer and the binary, the full tracer
+command line (arguments, environment, events, base address and library paths), the
+working directory, the input and the parse options. Each entry is the parsed result
+in the binary trace format, which loads by memory mapping it, next to the return code
+and output of the traced process.
+
+The least recently used entries are evicted once the cache grows beyond its maximum
+size. Recency is kept in the modification times of the entries and the directory is
+counted again before evicting, so several processes can share a cache directory.
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps
+from os import replace, utime
+from pathlib import Path
+from struct import Struct
+from struct import error as StructError
+from tempfile import mkstemp
+from threading import Lock
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+
+from pyafl_qemu_trace import QEMUEvent
+from pyafl_qemu_trace.parse import Records
+from pyafl_qemu_trace.parse.parse import TraceResult
+from pyafl_qemu_trace.run.run import DEFAULT_EVENTS, TraceRunner
+
+# Return code and output lengths of the traced process
+OUTPUT_HEADER = Struct("<qQQ")
+
+# Size of the reads used to hash files
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def _inputs(input_data: Optional[Union[bytes, Dict[str, bytes]]]) -> Dict[str, bytes]:
+    """
+    Get the inputs of a trace by name
+    """
+    if isinstance(input_data, dict):
+        return input_data
+    return {"stdin": input_data or b""}
+
+
+class TraceCache:
+    """
+    Cache of parsed traces in a directory, in front of `TraceRunner.trace`
+    """
+
+    def __init__(self, directory: Path, max_size: int = 1 << 30) -> None:
+        """
+        Initialize the cache
+
+        :param directory: The directory to keep entries in, which is created if needed
+        :param max_size: The size in bytes above which least recently used entries
+            are evicted
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        # Digests of files by (path, size, modification time)
+        self._digests: Dict[Tuple[str, int, int], bytes] = {}
+        # Size of each entry, from least to most recently used
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._scan()
+
+    def run(  # pylint: disable=too-many-arguments,too-many-locals
+        self,
+        platform: str,
+        binary: str,
+        argv: Optional[List[str]] = None,
+        envp: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        input_data: Optional[Union[bytes, Dict[str, bytes]]] = None,
+        timeout: Optional[float] = None,
+        base_addr: Optional[int] = None,
+        record_events: Optional[List[QEMUEvent]] = None,
+        ld_preloads: Optional[List[str]] = None,
+        ld_library_paths: Optional[List[str]] = None,
+        compact: bool = False,
+        records: Records = Records.DEFAULT,
+        runner: Callable[
+            ..., Tuple[int, bytes, bytes, TraceResult]
+        ] = TraceRunner.trace,
+    ) -> Tuple[int, bytes, bytes, TraceResult]:
+        """
+        Trace and parse, or get the result of an identical earlier trace from the
+        cache. Takes the same arguments as `TraceRunner.run` and the parse options
+        of `TraceRunner.trace`, and returns (returncode, stdout, stderr, result).
+        Truncated traces, such as those that time out, are not cached.
+
+        :param compact: Store the addresses as `InternedAddrs`
+        :param records: The kinds of records to parse, which cannot include
+            `Records.TBS`
+        :param runner: What to trace with on a miss, such as `TracerPool.trace`
+        """
+        if record_events is None:
+            record_events = DEFAULT_EVENTS
+        command = TraceRunner.command(
+            platform,
+            binary,
+            "-",
+            argv or [],
+            dict(sorted((envp or {}).items())),
+            base_addr,
+            record_events,
+            ld_preloads,
+            ld_library_paths,
+        )
+        key = self.key(command, binary, cwd, input_data, platform, compact, records)
+
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        returncode, stdout, stderr, result = runner(
+            platform,
+            binary,
+            argv=argv,
+            envp=envp,
+            cwd=cwd,
+            input_data=input_data,
+            timeout=timeout,
+            base_addr=base_addr,
+            record_events=record_events,
+            ld_preloads=ld_preloads,
+            ld_library_paths=ld_library_paths,
+            compact=compact,
+            records=records,
+        )
+        if not result.truncated:
+            self.put(key, returncode, stdout, stderr, result)
+        return returncode, stdout, stderr, result
+
+    def key(  # pylint: disable=too-many-arguments
+        self,
+        command: List[str],
+        binary: str,
+        cwd: Optional[str],
+        input_data: Optional[Union[bytes, Dict[str, bytes]]],
+        platform: str,
+        compact: bool,
+        records: Records,
+    ) -> str:
+        """
+        Get the cache key of a trace
+
+        :param command: The tracer command line from `TraceRunner.command`, whose
+            first element is the tracer
+        :param binary: The binary being traced
+        :param cwd: The working directory of the trace
+        :param input_data: The input of the trace
+        :param platform: The platform the result is parsed for
+        :param compact: Whether the result stores `InternedAddrs`
+        :param records: The kinds of records parsed
+        """
+        digest = sha256()
+        digest.update(
+            dumps([command, cwd, platform, compact, int(records)]).encode("utf-8")
+        )
+        digest.update(self._digest(command[0]))
+        digest.update(self._digest(binary))
+        for name, data in sorted(_inputs(input_data).items()):
+            digest.update(f"{name}:{len(data)}:".encode("utf-8"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[int, bytes, bytes, TraceResult]]:
+        """
+        Get a cached trace
+
+        :param key: The key of the trace
+        :return: The (returncode, stdout, stderr, result) of the trace, or None if
+            it is not cached
+        """
+        path = self.directory / f"{key}.pqt"
+        try:
+            output = path.with_suffix(".out").read_bytes()
+            returncode, nout, nerr = OUTPUT_HEADER.unpack_from(output)
+            result = TraceResult.load(path)
+            utime(path)
+        except (FileNotFoundError, ValueError, StructError) as exc:
+            with self._lock:
+                self.misses += 1
+                self._size -= self._entries.pop(key, 0)
+            # A corrupt entry would fail again every time, so it is dropped
+            if not isinstance(exc, FileNotFoundError):
+                self._remove(key)
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+        stdout = output[OUTPUT_HEADER.size : OUTPUT_HEADER.size + nout]
+        stderr = output[OUTPUT_HEADER.size + nout : OUTPUT_HEADER.size + nout + nerr]
+        return returncode, stdout, stderr, result
+
+    def put(  # pylint: disable=too-many-arguments
+        self,
+        key: str,
+        returncode: int,
+        stdout: bytes,
+        stderr: bytes,
+        result: TraceResult,
+    ) -> None:
+        """
+        Add a trace to the cache, evicting least recently used traces if it grows
+        too large
+
+        :param key: The key of the trace
+        :param returncode: The return code of the traced process
+        :param stdout: The output of the traced process
+        :param stderr: The error output of the traced process
+        :param result: The parsed trace
+        """
+        path = self.directory / f"{key}.pqt"
+        # Write the output first, since an entry counts as present once its trace is
+        self._replace(
+            path.with_suffix(".out"),
+            lambda fil: fil.write(
+                OUTPUT_HEADER.pack(returncode, len(stdout), len(stderr))
+                + stdout
+                + stderr
+            ),
+        )
+        self._replace(path, result.save)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = 0
+            # Other processes sharing the directory may have added or evicted
+            # entries since it was last counted
+            self._scan()
+            evicted = []
+            while self._size > self.max_size and len(self._entries) > 1:
+                old, old_size = self._entries.popitem(last=False)
+                self._size -= old_size
+                evicted.append(old)
+
+        for old in evicted:
+            self._remove(old)
+
+    def _scan(self) -> None:
+        """
+        Count the entries in the directory, from least to most recently used
+        """
+        # Modification times are only as fine as the kernel clock, so entries used
+        # at the same time keep the order they are known to have been used in
+        known = {key: rank for rank, key in enumerate(self._entries)}
+        entries = []
+        for path in self.directory.glob("*.pqt"):
+            try:
+                stat = path.stat()
+                size = stat.st_size + path.with_suffix(".out").stat().st_size
+            except FileNotFoundError:
+                continue
+            entries.append(
+                (stat.st_mtime_ns, known.get(path.stem, -1), path.stem, size)
+            )
+        self._entries = OrderedDict((key, size) for *_, key, size in sorted(entries))
+        self._size = sum(self._entries.values())
+
+    def _remove(self, key: str) -> None:
+        """
+        Delete the files of an entry
+        """
+        for suffix in (".pqt", ".out"):
+            (self.directory / f"{key}{suffix}").unlink(missing_ok=True)
+
+    def _replace(self, path: Path, write: Callable[[BinaryIO], Any]) -> None:
+        """
+        Replace a file atomically by writing it to a unique temporary file first, so
+        that readers and other writers of the same entry never see a partial file
+
+        :param path: The file to replace
+        :param write: Called with the temporary file to write the contents
+        """
+        fd, tmp = mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=self.directory)
+        try:
+            with open(fd, "wb") as fil:
+                write(fil)
+            replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    @property
+    def size(self) -> int:
+        """
+        The total size in bytes of the cached traces
+        """
+        return self._size
+
+    def _digest(self, path: str) -> bytes:
+        """
+        Get the SHA-256 digest of the contents of a file, which is only computed
+        again when the file changes
+        """
+        stat = Path(path).stat()
+        ident = (path, stat.st_size, stat.st_mtime_ns)
+        if ident not in self._digests:
+            digest = sha256()
+            with open(path, "rb") as fil:
+                for chunk in iter(lambda: fil.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            self._digests[ident] = digest.digest()
+        return self._digests[ident]
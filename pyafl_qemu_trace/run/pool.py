@@ -0,0 +1,562 @@
+"""
+Warm afl-qemu-trace processes that trace one input after another
+
+afl-qemu-trace speaks AFL's fork server protocol: when the guest reaches its entry
+point, after QEMU has started and the dynamic loader has run, the tracer reports
+itself on `FORKSRV_FD + 1` and then forks a fresh copy of the guest for every request
+written to `FORKSRV_FD`. Starting a tracer once and tracing each input in a forked
+copy avoids paying for QEMU startup and dynamic loading on every input.
+
+A fork server writes its log to a single fifo for its whole life, so the log of each
+execution is the part of the fifo between the start of the execution and the report
+of its exit status, preceded by the log the tracer wrote before it started forking.
+"""
+
+from os import (
+    O_NONBLOCK,
+    O_RDONLY,
+    SEEK_SET,
+    WEXITSTATUS,
+    WIFSIGNALED,
+    WTERMSIG,
+    close,
+    cpu_count,
+    dup2,
+    fstat,
+    ftruncate,
+    kill,
+    lseek,
+    mkfifo,
+    open as os_open,
+    pipe,
+    pread,
+    pwrite,
+    read,
+    write,
+)
+from os.path import join
+from selectors import EVENT_READ, DefaultSelector
+from signal import SIGKILL
+from struct import Struct
+from subprocess import Popen, TimeoutExpired
+from tempfile import TemporaryDirectory, TemporaryFile
+from threading import Condition, Lock
+from time import monotonic
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
+
+from pyafl_qemu_trace import QEMUEvent
+from pyafl_qemu_trace.parse.parse import TraceResult
+from pyafl_qemu_trace.parse.regs import Records
+from pyafl_qemu_trace.parse.stream import TraceCollector
+from pyafl_qemu_trace.run.process import grow_pipe
+from pyafl_qemu_trace.run.run import TraceRunner
+
+# File descriptor the fork server reads requests from, it reports on the next one
+FORKSRV_FD = 198
+
+# Requests, child PIDs and statuses are all 32 bit native integers
+MESSAGE = Struct("=I")
+
+
+def _hashable(value: Any) -> Hashable:
+    """
+    Turn an option of `TraceRunner.command` into part of a fork server's key
+
+    :param value: The option, either a dictionary, a list or a hashable value
+    :return: A hashable value equal between equal options
+    """
+    if isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    if isinstance(value, list):
+        return tuple(value)
+    return cast(Hashable, value)
+
+
+class ForkServer:
+    """
+    A warm afl-qemu-trace process for one binary and set of options, which traces
+    one input at a time in a forked copy of the guest
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-locals
+        self,
+        platform: str,
+        binary: str,
+        argv: Optional[List[str]] = None,
+        envp: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        base_addr: Optional[int] = None,
+        record_events: Optional[List[QEMUEvent]] = None,
+        ld_preloads: Optional[List[str]] = None,
+        ld_library_paths: Optional[List[str]] = None,
+        shm_dir: str = "/dev/shm",
+        chunk_size: int = 1 << 20,
+        startup_timeout: Optional[float] = 30.0,
+    ) -> None:
+        """
+        Start the tracer and wait until it is ready to fork
+
+        :param platform: A platform identifier (e.g. `x86_64`)
+        :param binary: The absolute path to the binary to run
+        :param argv: The arguments to pass to the binary
+        :param envp: The environment variables to pass to the binary
+        :param cwd: The working directory to run the binary in
+        :param base_addr: The guest base address to load the binary at
+        :param record_events: The events to record in the log, `DEFAULT_EVENTS` if
+            not given
+        :param ld_preloads: Libraries to preload into the binary
+        :param ld_library_paths: Library search paths for the binary
+        :param shm_dir: The directory to create the log fifo and input files in
+        :param chunk_size: The maximum size of the chunks the log is read in
+        :param startup_timeout: The timeout (in seconds) to wait for the tracer to
+            reach the entry point of the binary
+        """
+        self.executions = 0
+        self._chunk_size = chunk_size
+        self._lock = Lock()
+        self._was_killed = 0
+
+        # The directory outlives this call, it is removed by `close`
+        self._tmpdir = TemporaryDirectory(  # pylint: disable=consider-using-with
+            dir=shm_dir
+        )
+        fifo = join(self._tmpdir.name, "pipe")
+        mkfifo(fifo)
+        # Opening the read end without blocking lets the tracer open the write end,
+        # and keeping it open keeps the fifo alive across executions
+        self._log = os_open(fifo, O_RDONLY | O_NONBLOCK)
+        grow_pipe(self._log)
+
+        # The guest shares the offsets of these files with us, so rewinding them
+        # between executions is enough to give each execution its own input and output
+        self._stdio: Tuple[IO[bytes], IO[bytes], IO[bytes]] = (
+            TemporaryFile(dir=self._tmpdir.name),
+            TemporaryFile(dir=self._tmpdir.name),
+            TemporaryFile(dir=self._tmpdir.name),
+        )
+
+        ctl_read, self._ctl = pipe()
+        self._status, st_write = pipe()
+
+        def setup() -> None:
+            """
+            Move the fork server pipes to the descriptors the tracer expects
+            """
+            dup2(ctl_read, FORKSRV_FD)
+            dup2(st_write, FORKSRV_FD + 1)
+
+        args = TraceRunner.command(
+            platform,
+            binary,
+            fifo,
+            argv,
+            envp,
+            base_addr,
+            record_events,
+            ld_preloads,
+            ld_library_paths,
+        )
+
+        try:
+            # The pipes are not inheritable, so only the descriptors moved into
+            # place by `setup` are passed on (`pass_fds` would close them)
+            self._proc = Popen(  # pylint: disable=subprocess-popen-preexec-fn,consider-using-with
+                args,
+                stdin=self._stdio[0],
+                stdout=self._stdio[1],
+                stderr=self._stdio[2],
+                cwd=cwd,
+                close_fds=False,
+                preexec_fn=setup,
+            )
+        except BaseException:
+            close(self._ctl)
+            close(self._status)
+            self._cleanup()
+            raise
+        finally:
+            close(ctl_read)
+            close(st_write)
+
+        self._selector = DefaultSelector()
+        self._selector.register(self._log, EVENT_READ)
+        self._selector.register(self._status, EVENT_READ)
+
+        preamble: List[bytes] = []
+        try:
+            if self._wait(preamble.append, startup_timeout) is None:
+                raise TimeoutError(
+                    f"{binary} did not reach its entry point in {startup_timeout}s"
+                )
+        except BaseException:
+            self.close()
+            raise
+
+        # Everything logged before the first fork (the memory map and mapping
+        # information, and the dynamic loader) is part of every execution's log
+        self.preamble = b"".join(preamble)
+
+    def run(
+        self,
+        input_data: Optional[Union[bytes, Dict[str, bytes]]] = None,
+        timeout: Optional[float] = None,
+        log_sink: Optional[Callable[[bytes], Any]] = None,
+    ) -> Tuple[int, bytes, bytes, bytes]:
+        """
+        Trace the binary on one input
+
+        :param input_data: The input to pass to the binary on stdin, either as bytes
+            or as the `stdin` entry of a dictionary like `TraceRunner.run` takes
+        :param timeout: The timeout (in seconds) to wait for the binary to exit
+        :param log_sink: If provided, each chunk of the log is passed to this callable
+            as soon as it is read instead of being collected, and the returned log is
+            empty
+        :return: A tuple containing (returncode, stdout, stderr, log), where the
+            returncode is -1 if the binary timed out
+        """
+        returncode, stdout, stderr, log, timed_out = self.execute(
+            input_data, timeout, log_sink
+        )
+        return (-1 if timed_out else returncode, stdout, stderr, log)
+
+    def execute(
+        self,
+        input_data: Optional[Union[bytes, Dict[str, bytes]]] = None,
+        timeout: Optional[float] = None,
+        log_sink: Optional[Callable[[bytes], Any]] = None,
+    ) -> Tuple[int, bytes, bytes, bytes, bool]:
+        """
+        Trace the binary on one input, taking the same arguments as `run`
+
+        :return: A tuple containing (returncode, stdout, stderr, log, timed_out),
+            where the returncode is the guest's own (-9 if it was killed)
+        """
+        if isinstance(input_data, dict):
+            input_data = input_data.get("stdin")
+
+        with self._lock:
+            for fil, contents in zip(self._stdio, (input_data or b"", b"", b"")):
+                ftruncate(fil.fileno(), 0)
+                pwrite(fil.fileno(), contents, 0)
+                lseek(fil.fileno(), 0, SEEK_SET)
+
+            chunks: List[bytes] = []
+            sink = log_sink if log_sink is not None else chunks.append
+            sink(self.preamble)
+
+            write(self._ctl, MESSAGE.pack(self._was_killed))
+            self._was_killed = 0
+            pid = self._wait(sink, None)
+
+            status = self._wait(sink, timeout)
+            if status is None:
+                try:
+                    kill(pid, SIGKILL)  # type: ignore
+                except ProcessLookupError:
+                    pass
+                self._was_killed = 1
+                status = self._wait(sink, None)
+
+            self.executions += 1
+            if WIFSIGNALED(status):  # type: ignore
+                returncode = -WTERMSIG(status)  # type: ignore
+            else:
+                returncode = WEXITSTATUS(status)  # type: ignore
+
+            return (
+                returncode,
+                self._contents(self._stdio[1]),
+                self._contents(self._stdio[2]),
+                b"".join(chunks),
+                bool(self._was_killed),
+            )
+
+    def close(self) -> None:
+        """
+        Stop the tracer and remove its files
+        """
+        self._selector.close()
+        close(self._ctl)
+        close(self._status)
+        self._proc.kill()
+        try:
+            self._proc.wait(5)
+        except TimeoutExpired:  # pragma: no cover
+            pass
+        self._cleanup()
+
+    def __enter__(self) -> "ForkServer":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def _cleanup(self) -> None:
+        """
+        Close the log and input files and remove their directory
+        """
+        close(self._log)
+        for fil in self._stdio:
+            fil.close()
+        self._tmpdir.cleanup()
+
+    def _wait(
+        self, sink: Callable[[bytes], Any], timeout: Optional[float]
+    ) -> Optional[int]:
+        """
+        Pass the log to `sink` until the tracer sends a message
+
+        :param sink: Callable to pass chunks of the log to
+        :param timeout: The timeout (in seconds) to wait for the message
+        :return: The message, or None if the timeout expired
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+
+        while True:
+            wait = None if deadline is None else deadline - monotonic()
+            if wait is not None and wait <= 0:
+                return None
+
+            ready = [key.fd for key, _ in self._selector.select(wait)]
+            if self._log in ready:
+                self._drain(sink)
+            if self._status in ready:
+                message = read(self._status, MESSAGE.size)
+                if len(message) != MESSAGE.size:
+                    raise RuntimeError(
+                        f"afl-qemu-trace exited with {self._proc.wait()} "
+                        "instead of forking"
+                    )
+                # Everything the guest logged was written before the message, so
+                # whatever is in the fifo now belongs with it
+                self._drain(sink)
+                return int(MESSAGE.unpack(message)[0])
+
+    def _drain(self, sink: Callable[[bytes], Any]) -> None:
+        """
+        Pass everything currently in the log fifo to `sink`
+        """
+        while True:
+            try:
+                chunk = read(self._log, self._chunk_size)
+            except BlockingIOError:
+                return
+            if not chunk:
+                return
+            sink(chunk)
+
+    @staticmethod
+    def _contents(fil: IO[bytes]) -> bytes:
+        """
+        Get the contents of a file without moving its shared offset
+        """
+        return pread(fil.fileno(), fstat(fil.fileno()).st_size, 0)
+
+
+class TracerPool:
+    """
+    Thread-safe pool of warm fork servers, kept per binary and set of options
+
+    At most `size` fork servers run at once. Executions for a binary that has an idle
+    fork server reuse it, and otherwise a new one is started, replacing an idle one
+    for a different binary if the pool is full.
+    """
+
+    def __init__(self, size: Optional[int] = None, shm_dir: str = "/dev/shm") -> None:
+        """
+        Initialize the pool
+
+        :param size: The maximum number of fork servers, by default the CPU count
+        :param shm_dir: The directory to create the log fifos and input files in
+        """
+        self.size = size or cpu_count() or 1
+        self.executions = 0
+        self._shm_dir = shm_dir
+        self._started = monotonic()
+        self._running = 0
+        self._idle: Dict[Hashable, List[ForkServer]] = {}
+        self._cond = Condition()
+
+    @property
+    def execs_per_sec(self) -> float:
+        """
+        The number of executions per second since the pool was created
+        """
+        return self.executions / max(monotonic() - self._started, 1e-9)
+
+    def run(  # pylint: disable=too-many-arguments,too-many-locals
+        self,
+        platform: str,
+        binary: str,
+        argv: Optional[List[str]] = None,
+        envp: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        input_data: Optional[Union[bytes, Dict[str, bytes]]] = None,
+        timeout: Optional[float] = None,
+        base_addr: Optional[int] = None,
+        record_events: Optional[List[QEMUEvent]] = None,
+        ld_preloads: Optional[List[str]] = None,
+        ld_library_paths: Optional[List[str]] = None,
+        log_sink: Optional[Callable[[bytes], Any]] = None,
+    ) -> Tuple[int, bytes, bytes, bytes]:
+        """
+        Trace a binary on one input with a warm fork server, taking the same
+        arguments as `TraceRunner.run` and returning the same tuple of
+        (returncode, stdout, stderr, log)
+        """
+        options = {
+            "platform": platform,
+            "binary": binary,
+            "argv": argv,
+            "envp": envp,
+            "cwd": cwd,
+            "base_addr": base_addr,
+            "record_events": record_events,
+            "ld_preloads": ld_preloads,
+            "ld_library_paths": ld_library_paths,
+        }
+        returncode, stdout, stderr, log, timed_out = self._execute(
+            options, input_data, timeout, log_sink
+        )
+        return (-1 if timed_out else returncode, stdout, stderr, log)
+
+    def trace(  # pylint: disable=too-many-arguments,too-many-locals
+        self,
+        platform: str,
+        binary: str,
+        argv: Optional[List[str]] = None,
+        envp: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        input_data: Optional[Union[bytes, Dict[str, bytes]]] = None,
+        timeout: Optional[float] = None,
+        base_addr: Optional[int] = None,
+        record_events: Optional[List[QEMUEvent]] = None,
+        ld_preloads: Optional[List[str]] = None,
+        ld_library_paths: Optional[List[str]] = None,
+        compact: bool = False,
+        vectorize: Optional[bool] = None,
+        records: Records = Records.DEFAULT,
+    ) -> Tuple[int, bytes, bytes, TraceResult]:
+        """
+        Trace a binary on one input with a warm fork server and parse the log while
+        it runs, taking the same arguments as `run` and the parse options of
+        `TraceRunner.trace`
+
+        :return: A tuple containing (returncode, stdout, stderr, result), where the
+            returncode is the guest's own (-9 if it was killed) and the result is
+            `truncated` if the binary timed out
+        """
+        options = {
+            "platform": platform,
+            "binary": binary,
+            "argv": argv,
+            "envp": envp,
+            "cwd": cwd,
+            "base_addr": base_addr,
+            "record_events": record_events,
+            "ld_preloads": ld_preloads,
+            "ld_library_paths": ld_library_paths,
+        }
+        collector = TraceCollector(platform, compact, vectorize, records)
+        returncode, stdout, stderr, _, timed_out = self._execute(
+            options, input_data, timeout, collector
+        )
+        result = collector.close()
+        result.truncated = timed_out
+        return returncode, stdout, stderr, result
+
+    def close(self) -> None:
+        """
+        Stop all idle fork servers
+        """
+        with self._cond:
+            servers = [s for idle in self._idle.values() for s in idle]
+            self._idle.clear()
+            self._running -= len(servers)
+            self._cond.notify_all()
+
+        for server in servers:
+            server.close()
+
+    def __enter__(self) -> "TracerPool":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def _execute(
+        self,
+        options: Dict[str, Any],
+        input_data: Optional[Union[bytes, Dict[str, bytes]]],
+        timeout: Optional[float],
+        log_sink: Optional[Callable[[bytes], Any]],
+    ) -> Tuple[int, bytes, bytes, bytes, bool]:
+        """
+        Trace one input with a fork server for `options`, as `ForkServer.execute`
+        """
+        key: Hashable = tuple(_hashable(value) for value in options.values())
+        server = self._acquire(key, options)
+        ok = False
+        try:
+            res = server.execute(input_data, timeout, log_sink)
+            ok = True
+            return res
+        finally:
+            self._release(key, server, ok)
+
+    def _acquire(self, key: Hashable, options: Dict[str, Any]) -> ForkServer:
+        """
+        Take an idle fork server for `key`, or start one
+        """
+        victim = None
+        with self._cond:
+            while True:
+                if self._idle.get(key):
+                    return self._idle[key].pop()
+                if self._running < self.size:
+                    break
+                victim = next(
+                    (idle.pop() for idle in self._idle.values() if idle), None
+                )
+                if victim is not None:
+                    break
+                self._cond.wait()
+            if victim is None:
+                self._running += 1
+
+        if victim is not None:
+            victim.close()
+
+        try:
+            return ForkServer(**options, shm_dir=self._shm_dir)
+        except BaseException:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, key: Hashable, server: ForkServer, ok: bool) -> None:
+        """
+        Return a fork server to the pool, or stop it if it failed
+        """
+        with self._cond:
+            if ok:
+                self.executions += 1
+                self._idle.setdefault(key, []).append(server)
+            else:
+                self._running -= 1
+            self._cond.notify()
+
+        if not ok:
+            server.close()
@@ -0,0 +1,564 @@
+"""
+Process and fifo handling for running afl-qemu-trace: the fifos the tracer logs to,
+the destinations the log is read into and the loop that feeds a running tracer its
+input and collects its output and log
+"""
+
+from contextlib import ExitStack, contextmanager
+from os import (
+    O_NONBLOCK,
+    O_RDONLY,
+    O_WRONLY,
+    close,
+    killpg,
+    mkfifo,
+    open as os_open,
+    read,
+    set_blocking,
+    unlink,
+    write,
+)
+from os.path import join
+from pathlib import Path
+from select import PIPE_BUF
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector, SelectorKey
+from shutil import rmtree
+from signal import SIGKILL
+from subprocess import Popen, TimeoutExpired
+from sys import platform as platform_name
+from tempfile import TemporaryDirectory, mkstemp
+from time import monotonic
+from types import TracebackType
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Type, Union
+import fcntl
+
+from attr import define
+
+from pyafl_qemu_trace.parse.compressed import LogWriter, is_compressed
+
+
+@contextmanager
+def TemporaryFifo(  # pylint: disable=invalid-name
+    name: str, tempdir_name: str = "/dev/shm"
+) -> Iterator[str]:
+    """
+    Create a temporary fifo and return its path
+
+    :param name: Name of the fifo
+    :param dir: Directory to create the fifo in
+    """
+
+    tmpdir = TemporaryDirectory(dir=tempdir_name)
+    filename = join(tmpdir.name, name)
+    mkfifo(filename)
+    try:
+        yield filename
+    finally:
+        unlink(filename)
+        rmtree(tmpdir.name)
+
+
+# Size to grow log fifos to, so the log is read in fewer, larger pieces
+PIPE_SIZE = 1 << 20
+
+# Linux only, and not exposed by `fcntl` before Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+
+def grow_pipe(fd: int, size: int = PIPE_SIZE) -> None:
+    """
+    Grow the buffer of a pipe or fifo where the platform allows it, which is a
+    best-effort optimization
+
+    :param fd: A descriptor of the pipe
+    :param size: The buffer size to ask for
+    """
+    if not platform_name.startswith("linux"):
+        return
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        # Sizes over /proc/sys/fs/pipe-max-size need privileges
+        pass
+
+
+class LogBuffer:
+    """
+    Buffer that a log is read into chunk by chunk, which is also a log sink
+
+    Each read goes straight into a new chunk and the chunks are joined once at the
+    end, so collecting a log takes time linear in its size and copies it only once.
+    (Growing a single `bytearray` instead costs more on large logs, since every
+    growth zero-fills and may move the buffer.)
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize the buffer
+        """
+        self._chunks: List[bytes] = []
+        self._len = 0
+
+    def __len__(self) -> int:
+        """
+        Get the number of bytes read so far
+        """
+        return self._len
+
+    def __call__(self, chunk: bytes) -> None:
+        """
+        Add the next chunk of the log, as a log sink
+
+        :param chunk: The next chunk of the log
+        """
+        self.append(chunk)
+
+    def readfrom(self, fd: int, size: int) -> int:
+        """
+        Read up to `size` bytes from a file descriptor into the buffer
+
+        :param fd: The file descriptor
+        :param size: The maximum number of bytes to read
+        :return: The number of bytes read, 0 at end of file
+        """
+        chunk = read(fd, size)
+        if chunk:
+            self._chunks.append(chunk)
+            self._len += len(chunk)
+        return len(chunk)
+
+    def append(self, chunk: bytes) -> None:
+        """
+        Add a chunk that has already been read to the buffer
+
+        :param chunk: The chunk
+        """
+        self._chunks.append(chunk)
+        self._len += len(chunk)
+
+    def getvalue(self, view: bool = False) -> Union[bytes, memoryview]:
+        """
+        Get the contents of the buffer
+
+        :param view: Return a read-only `memoryview` of the contents, which can be
+            sliced without copying (for example to parse pieces of the log
+            separately)
+        """
+        if len(self._chunks) > 1:
+            self._chunks = [b"".join(self._chunks)]
+        contents = self._chunks[0] if self._chunks else b""
+        return memoryview(contents) if view else contents
+
+
+# Start of the line of each executed block in a log
+TRACE_LINE = b"Trace "
+
+
+class LogBudget:
+    """
+    Log sink that passes a log on to another sink line by line until a size or
+    block budget is spent, and drops the rest of the log after that
+
+    Only whole lines are passed on, so the log seen by the other sink always ends
+    at the end of a record and parses into a well-formed (if partial) result.
+    `TraceRunner.run` and `TraceRunner.arun` kill the tracer as soon as a budget
+    they are given as their `log_sink` is exhausted, which bounds both the memory
+    and the time spent on runaway targets.
+    """
+
+    def __init__(
+        self,
+        sink: Callable[[bytes], Any],
+        max_size: Optional[int] = None,
+        max_blocks: Optional[int] = None,
+    ) -> None:
+        """
+        Initialize the budget
+
+        :param sink: The sink to pass the log on to, such as a `TraceCollector`
+        :param max_size: The maximum number of bytes of the log to pass on
+        :param max_blocks: The maximum number of executed blocks to pass on
+        """
+        self.sink = sink
+        self.max_size = max_size
+        self.max_blocks = max_blocks
+        # Bytes and blocks passed on so far
+        self.size = 0
+        self.blocks = 0
+        # Whether the budget is spent and the rest of the log is being dropped
+        self.exhausted = False
+        self._partial = b""
+
+    def __call__(self, chunk: bytes) -> None:
+        """
+        Pass on the whole lines of the next chunk of the log that fit the budget
+
+        :param chunk: The next chunk of the log
+        """
+        if self.exhausted:
+            return
+        data = self._partial + chunk if self._partial else chunk
+        end = data.rfind(b"\n") + 1
+        self._partial = data[end:]
+        self._pass(data, end)
+        # A line longer than the rest of the budget can never be passed on, so it
+        # is not held on to while it grows
+        if self.max_size is not None and len(self._partial) > self.max_size - self.size:
+            self.exhausted = True
+            self._partial = b""
+
+    def flush(self) -> None:
+        """
+        Pass on the last line of the log if it has no newline, once the log is
+        complete
+        """
+        data, self._partial = self._partial, b""
+        if data and not self.exhausted:
+            self._pass(data, len(data))
+
+    def _pass(self, data: bytes, end: int) -> None:
+        """
+        Pass on the lines in `data[:end]` that fit the budget
+        """
+        if self.max_size is not None and self.size + end > self.max_size:
+            end = data.rfind(b"\n", 0, self.max_size - self.size) + 1
+            self.exhausted = True
+
+        blocks = data.count(b"\n" + TRACE_LINE, 0, end) + data.startswith(
+            TRACE_LINE, 0, end
+        )
+        if self.max_blocks is not None and self.blocks + blocks > self.max_blocks:
+            # Cut before the first block over the budget
+            blocks = self.max_blocks - self.blocks
+            end = self._line_start(data, blocks)
+            self.exhausted = True
+
+        if end:
+            self.sink(data[:end] if end < len(data) else data)
+        self.size += end
+        self.blocks += blocks
+        if self.exhausted:
+            self._partial = b""
+
+    @staticmethod
+    def _line_start(data: bytes, nth: int) -> int:
+        """
+        Find the start of the line of the nth (from 0) block in `data`
+        """
+        if data.startswith(TRACE_LINE):
+            if not nth:
+                return 0
+            nth -= 1
+        pos = -1
+        for _ in range(nth + 1):
+            pos = data.find(b"\n" + TRACE_LINE, pos + 1)
+        return pos + 1
+
+
+@define(frozen=True, slots=True)
+class LogFile:  # pylint: disable=too-few-public-methods
+    """
+    Log destination that writes the log to a file, for the `log_sink` of
+    `TraceRunner.run`, which then returns the path of the file instead of the log
+
+    Uncompressed files are written by the tracer itself, without the log passing
+    through Python. Files with a `.gz`, `.zst` or `.lz4` suffix are compressed by a
+    `LogWriter` as the log is read. Without a path the tracer writes the log to a
+    new file in the `shm_dir` of the trace, and the caller deletes it when done.
+    """
+
+    path: Optional[Path] = None
+
+    @property
+    def direct(self) -> bool:
+        """
+        Whether the tracer writes the file itself
+        """
+        return self.path is None or not is_compressed(self.path)
+
+    def create(self, directory: str) -> Path:
+        """
+        Create the file, or empty it since the tracer only truncates it once it
+        opens its log
+
+        :param directory: The directory to create a new file in
+        """
+        if self.path is None:
+            fd, name = mkstemp(suffix=".log", dir=directory)
+            close(fd)
+            return Path(name)
+        if self.direct:
+            self.path.write_bytes(b"")
+        return self.path
+
+
+# Where `TraceRunner.run` sends a log: a sink each chunk of the log is passed to
+# (such as a `LogBuffer`, `LogBudget`, `TraceCollector` or `LogWriter`) or a file
+LogTarget = Union[Callable[[bytes], Any], LogFile]
+
+
+class LogChannel:
+    """
+    The way a log takes from the tracer to its destination: either a fifo whose read
+    end is drained into a sink, or a file the tracer writes itself
+
+    The read end of the fifo is opened without blocking, which lets the tracer open
+    the fifo whenever it gets to it, and a write end is held open until the tracer
+    has exited, which keeps the fifo from reading as closed before then.
+    """
+
+    def __init__(self, target: Optional[LogTarget], shm_dir: str) -> None:
+        """
+        Initialize the channel, which is opened by entering it
+
+        :param target: Where to send the log, by default into a `LogBuffer`
+        :param shm_dir: The directory to create fifos and new log files in
+        """
+        self.shm_dir = shm_dir
+        # The path the tracer logs to, once the channel is open
+        self.path = ""
+        # The file the log ends up in, if any
+        self.file: Optional[Path] = None
+        # The non-blocking read end of the fifo and the write end held open, if
+        # the log passes through a fifo
+        self.fd: Optional[int] = None
+        self.hold_fd: Optional[int] = None
+        self.sink: Optional[Callable[[bytes], Any]] = None
+        self._target = target
+        self._stack = ExitStack()
+
+    def __enter__(self) -> "LogChannel":
+        """
+        Create the log file or fifo and open the fifo
+        """
+        with ExitStack() as stack:
+            target = LogBuffer() if self._target is None else self._target
+            if isinstance(target, LogFile):
+                self.file = target.create(self.shm_dir)
+                if target.direct:
+                    self.path = str(self.file)
+                    self._stack = stack.pop_all()
+                    return self
+                target = LogWriter(self.file)
+                stack.callback(target.close)
+            self.sink = target
+
+            self.path = stack.enter_context(TemporaryFifo("pipe", self.shm_dir))
+            self.fd = os_open(self.path, O_RDONLY | O_NONBLOCK)
+            stack.callback(close, self.fd)
+            self.hold_fd = os_open(self.path, O_WRONLY | O_NONBLOCK)
+            stack.callback(self.release)
+            grow_pipe(self.fd)
+            self._stack = stack.pop_all()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        """
+        Close the fifo and finish writing any compressed log file
+        """
+        self._stack.close()
+
+    @property
+    def exhausted(self) -> bool:
+        """
+        Whether the log is sent to a `LogBudget` that is spent
+        """
+        return isinstance(self.sink, LogBudget) and self.sink.exhausted
+
+    def release(self) -> None:
+        """
+        Close the write end of the fifo held open, once the tracer has exited, so
+        the read end reads as closed once it is drained
+        """
+        if self.hold_fd is not None:
+            close(self.hold_fd)
+            self.hold_fd = None
+
+    def drain(self, chunk_size: int, deadline: Optional[float] = None) -> None:
+        """
+        Read everything currently in the fifo into the sink, stopping early at the
+        deadline or once a `LogBudget` is exhausted, since a tracer logging as fast
+        as it is read would otherwise keep the fifo from ever running dry
+
+        :param chunk_size: The maximum size of the chunks the log is read in
+        :param deadline: The `monotonic` time to stop at
+        """
+        if self.fd is None or self.sink is None:
+            return
+        while deadline is None or monotonic() < deadline:
+            if self.exhausted:
+                return
+            try:
+                if isinstance(self.sink, LogBuffer):
+                    if not self.sink.readfrom(self.fd, chunk_size):
+                        return
+                else:
+                    chunk = read(self.fd, chunk_size)
+                    if not chunk:
+                        return
+                    self.sink(chunk)
+            except BlockingIOError:
+                return
+
+    def log(self) -> Union[bytes, memoryview, Path]:
+        """
+        Get the log as `TraceRunner.run` returns it: the path of the log file, the
+        contents of the default `LogBuffer`, or nothing if the log went to a sink
+        """
+        if self.file is not None:
+            return self.file
+        if self._target is None and isinstance(self.sink, LogBuffer):
+            return self.sink.getvalue()
+        return b""
+
+
+class Communication:
+    """
+    Feeds a running tracer its input and collects its output and log until it exits
+    or times out
+    """
+
+    def __init__(
+        self,
+        proc: Popen,
+        channel: LogChannel,
+        timeout: Optional[float],
+        chunk_size: int,
+    ) -> None:
+        """
+        Initialize the communication
+
+        :param proc: The tracer process, started with pipes for stdout and stderr
+            and in its own process group
+        :param channel: The open channel the tracer logs through
+        :param timeout: The timeout (in seconds) to wait for the tracer to exit
+        :param chunk_size: The maximum size of the chunks the log is read in
+        """
+        self.proc = proc
+        self.channel = channel
+        self.chunk_size = chunk_size
+        self.deadline = None if timeout is None else monotonic() + timeout
+        self.outputs: Dict[int, List[bytes]] = {
+            proc.stdout.fileno(): [],  # type: ignore
+            proc.stderr.fileno(): [],  # type: ignore
+        }
+        self.timed_out = False
+        self._pending = memoryview(b"")
+
+    @property
+    def truncated(self) -> bool:
+        """
+        Whether the log was cut off, because the tracer timed out or the budget of
+        its log was spent (possibly only after the tracer exited)
+        """
+        return self.timed_out or self.channel.exhausted
+
+    def run(self, input_data: Optional[bytes]) -> Tuple[int, bytes, bytes]:
+        """
+        Communicate with the tracer until it exits, times out or spends the budget
+        of its log, killing it and anything it started in the last two cases
+
+        :param input_data: The input to pass to the tracer on stdin
+        :return: A tuple containing (returncode, stdout, stderr) of the tracer, where
+            the outputs are incomplete if it was killed
+        """
+        self._pending = memoryview(input_data or b"")
+        with DefaultSelector() as selector:
+            self._register(selector)
+            # stdout and stderr are closed when the tracer exits
+            while not self.channel.exhausted and any(
+                output in selector.get_map() for output in self.outputs
+            ):
+                wait = None if self.deadline is None else self.deadline - monotonic()
+                if wait is not None and wait <= 0:
+                    self.timed_out = True
+                    break
+                for key, _ in selector.select(wait):
+                    self._ready(selector, key)
+
+        killed = self._wait()
+        self.channel.release()
+        # The rest of the log is only read if it is wanted
+        if not self.channel.exhausted:
+            self.channel.drain(self.chunk_size)
+        # The last line of a killed tracer's log may be cut off, so it is left out
+        if isinstance(self.channel.sink, LogBudget) and not killed:
+            self.channel.sink.flush()
+
+        stdout, stderr = (b"".join(chunks) for chunks in self.outputs.values())
+        # Try and return the output anyway even if it's incomplete
+        return (self.proc.returncode, stdout, stderr)
+
+    def _register(self, selector: DefaultSelector) -> None:
+        """
+        Register the log fifo, stdout, stderr and stdin (if there is input left to
+        write) with the selector
+        """
+        if self.channel.fd is not None:
+            selector.register(self.channel.fd, EVENT_READ)
+        for output in self.outputs:
+            set_blocking(output, False)
+            selector.register(output, EVENT_READ)
+        stdin = self.proc.stdin
+        if stdin is not None and self._pending:
+            set_blocking(stdin.fileno(), False)
+            selector.register(stdin.fileno(), EVENT_WRITE)
+        elif stdin is not None:
+            stdin.close()
+
+    def _ready(self, selector: DefaultSelector, key: SelectorKey) -> None:
+        """
+        Handle a descriptor the selector found ready
+        """
+        if key.fd == self.channel.fd:
+            self.channel.drain(self.chunk_size, self.deadline)
+        elif key.events & EVENT_WRITE:
+            try:
+                self._pending = self._pending[write(key.fd, self._pending[:PIPE_BUF]) :]
+            except BrokenPipeError:
+                self._pending = self._pending[:0]
+            except BlockingIOError:
+                return
+            if not self._pending:
+                selector.unregister(key.fd)
+                self.proc.stdin.close()  # type: ignore
+        else:
+            try:
+                chunk = read(key.fd, self.chunk_size)
+            except BlockingIOError:
+                return
+            if chunk:
+                self.outputs[key.fd].append(chunk)
+            else:
+                selector.unregister(key.fd)
+
+    def _wait(self) -> bool:
+        """
+        Wait for the tracer to exit, killing it and its process group if it times
+        out or its log budget is spent
+
+        :return: Whether the tracer was killed
+        """
+        killed = self.timed_out or self.channel.exhausted
+        if not killed:
+            try:
+                self.proc.wait(
+                    None
+                    if self.deadline is None
+                    else max(self.deadline - monotonic(), 0)
+                )
+            except TimeoutExpired:
+                self.timed_out = killed = True
+
+        if killed:
+            try:
+                killpg(self.proc.pid, SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.proc.wait()
+        return killed
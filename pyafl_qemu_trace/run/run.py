@@ -2,62 +2,122 @@
 Run utilities for afl-qemu-trace
 """
 
-from shutil import rmtree
-from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
-from subprocess import CompletedProcess, TimeoutExpired, run
-from tempfile import TemporaryDirectory
-from os import mkfifo, unlink
-from os.path import join
-from contextlib import contextmanager
-from multiprocessing import Process, Queue
+from asyncio import (
+    AbstractEventLoop,
+    Semaphore,
+    StreamReader,
+    StreamReaderProtocol,
+    create_subprocess_exec,
+    ensure_future,
+    gather,
+    get_running_loop,
+    wait,
+)
+from asyncio.subprocess import Process
+from contextlib import AsyncExitStack
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from weakref import WeakKeyDictionary
+from subprocess import PIPE, Popen
+from os import cpu_count, killpg
+from signal import SIGKILL
+
+from pathlib import Path
 
 from pyafl_qemu_trace import qemu_path, QEMUEvent
+from pyafl_qemu_trace.parse.parse import TraceResult
+from pyafl_qemu_trace.parse.regs import Records
+from pyafl_qemu_trace.parse.stream import TraceCollector
+from pyafl_qemu_trace.parse.tail import TailCollector, TraceTail
+from pyafl_qemu_trace.run.process import (
+    Communication,
+    LogBudget,
+    LogChannel,
+    LogTarget,
+)
+
+
+# Number of traces `TraceRunner.arun` runs at once per event loop by default
+ASYNC_CONCURRENCY = cpu_count() or 1
+
+# Events recorded by default, which are the ones `TraceParser` understands
+DEFAULT_EVENTS = [
+    QEMUEvent.NOCHAIN,
+    QEMUEvent.EXEC,
+    QEMUEvent.PAGE,
+    QEMUEvent.STRACE,
+]
 
 
-@contextmanager
-def TemporaryFifo(  # pylint: disable=invalid-name
-    name: str, tempdir_name: str = "/dev/shm"
-) -> Iterator[str]:
+class TraceRunner:  # pylint: disable=too-few-public-methods
     """
-    Create a temporary fifo and return its path
-
-    :param name: Name of the fifo
-    :param dir: Directory to create the fifo in
+    Run utilities for afl-qemu-trace
     """
 
-    tmpdir = TemporaryDirectory(dir=tempdir_name)
-    filename = join(tmpdir.name, name)
-    mkfifo(filename)
-    try:
-        yield filename
-    finally:
-        unlink(filename)
-        rmtree(tmpdir.name)
+    # Semaphores bounding the concurrent traces of `arun`, per event loop
+    _semaphores: "WeakKeyDictionary[AbstractEventLoop, Semaphore]" = WeakKeyDictionary()
 
+    @classmethod
+    def command(  # pylint: disable=too-many-arguments
+        cls,
+        platform: str,
+        binary: str,
+        log: str,
+        argv: Optional[List[str]] = None,
+        envp: Optional[Dict[str, str]] = None,
+        base_addr: Optional[int] = None,
+        record_events: Optional[List[QEMUEvent]] = None,
+        ld_preloads: Optional[List[str]] = None,
+        ld_library_paths: Optional[List[str]] = None,
+    ) -> List[str]:
+        """
+        Build the afl-qemu-trace command line to trace a binary
 
-def run_wrapper(q: Queue, args: Any, **kwargs: Any) -> None:
-    """
-    Wrapper for running subprocess.run in a multiprocess and
-    passing the result to the queue
+        :param platform: A platform identifier (e.g. `x86_64`)
+        :param binary: The absolute path to the binary to run
+        :param log: The path the tracer should write the log to
+        :param argv: The arguments to pass to the binary
+        :param envp: The environment variables to pass to the binary
+        :param base_addr: The guest base address to load the binary at
+        :param record_events: The events to record in the log, `DEFAULT_EVENTS` if
+            not given
+        :param ld_preloads: Libraries to preload into the binary
+        :param ld_library_paths: Library search paths for the binary
+        """
+        if record_events is None:
+            record_events = DEFAULT_EVENTS
 
-    :param q: Queue to pass the result to
-    :param args: Arguments to pass to subprocess.run
-    :param kwargs: Keyword arguments to pass to subprocess.run
-    """
-    try:
-        res = run(args, **kwargs)  # pylint: disable=subprocess-run-check
-        q.put(res)
-    except TimeoutExpired as e:
-        q.put(e)
+        args = [qemu_path(platform)]
+        args.extend(["-E", "LD_BIND_NOW=1"])
 
+        if ld_preloads:
+            args.extend(["-E", f"LD_PRELOAD={':'.join(ld_preloads)}"])
 
-class TraceRunner:  # pylint: disable=too-few-public-methods
-    """
-    Run utilities for afl-qemu-trace
-    """
+        if ld_library_paths:
+            args.extend(["-E", f"LD_LIBRARY_PATH={':'.join(ld_library_paths)}"])
+
+        if envp is not None:
+            for envvar, envval in envp.items():
+                args.extend(["-E", f"{envvar}={envval}"])
+
+        if record_events:
+            args.append("-d")
+            args.append(",".join(map(lambda e: str(e.value), record_events)))
+
+            args.append("-D")
+            args.append(log)
+
+        if base_addr is not None:
+            args.append("-B")
+            args.append(f"{base_addr:#0x}")
+
+        args.append(binary)
+        if argv is not None:
+            args.extend(argv)
+
+        return args
 
     @classmethod
-    def run(
+    def run(  # pylint: disable=too-many-arguments,too-many-locals
         cls,
         platform: str,
         binary: str,
@@ -65,19 +125,16 @@ class TraceRunner:  # pylint: disable=too-few-public-methods
         envp: Optional[Dict[str, str]] = None,
         cwd: Optional[str] = None,
         input_data: Optional[Union[bytes, Dict[str, bytes]]] = None,
-        timeout: Optional[int] = None,
+        timeout: Optional[float] = None,
         input_placeholder: Optional[str] = None,  # pylint: disable=unused-argument
         base_addr: Optional[int] = None,
-        record_events: List[QEMUEvent] = [
-            QEMUEvent.NOCHAIN,
-            QEMUEvent.EXEC,
-            QEMUEvent.PAGE,
-            QEMUEvent.STRACE,
-        ],
+        record_events: Optional[List[QEMUEvent]] = None,
         ld_preloads: Optional[List[str]] = None,
         ld_library_paths: Optional[List[str]] = None,
         shm_dir: str = "/dev/shm",
-    ) -> Tuple[int, bytes, bytes, bytes]:
+        log_sink: Optional[LogTarget] = None,
+        chunk_size: int = 1 << 20,
+    ) -> Tuple[int, bytes, bytes, Union[bytes, memoryview, Path]]:
         """
         Run a binary with afl-qemu-trace and return the raw log output
         (note: this output may be very large!)
@@ -95,94 +152,396 @@ class TraceRunner:  # pylint: disable=too-few-public-methods
             file(s), *or* a dictionary of input placeholder file names to input
             data bytes objects, with `stdin` being the input data to pass to stdin,
             if any.
-        :param timeout: The timeout (in seconds) to wait for the binary to exit
+        :param timeout: The timeout (in seconds) to wait for the binary to exit, after
+            which the tracer and any processes it started are killed
         :param input_placeholder: The placeholder to use for the input
             if provided, any occurrences of the placeholder in `args` will be
             replaced with a path to a file containing the contents of `stdin`.
             Multiple input_placeholders can be provided as a list, and will
             be replaced by the associated input contents provided in `input`
-        :return: A tuple containing (returncode, stdout, stderr, log)
+        :param log_sink: Where to send the log instead of returning it. Each chunk
+            of the log is passed to a callable as soon as it is read, for example a
+            `TraceCollector` to parse the log while the binary is still running, a
+            `LogBuffer` to collect it (and get it as a `memoryview`) or a
+            `LogBudget` to stop the tracer after a number of bytes or blocks. The
+            returned log is empty in this case. With a `LogFile`, the log is
+            written to a file and its path is returned instead.
+        :param chunk_size: The maximum size of the chunks passed to `log_sink`
+        :return: A tuple containing (returncode, stdout, stderr, log), where the
+            returncode is -1 and the outputs are incomplete if the binary timed out
+            or the log budget was spent
         """
+        returncode, stdout, stderr, log, truncated = cls._run(
+            platform,
+            binary,
+            argv,
+            envp,
+            cwd,
+            input_data,
+            timeout,
+            base_addr,
+            record_events,
+            ld_preloads,
+            ld_library_paths,
+            shm_dir,
+            log_sink,
+            chunk_size,
+        )
+        return (-1 if truncated else returncode, stdout, stderr, log)
 
-        run_args: Dict[str, Any] = {}
-        qemu_bin = qemu_path(platform)
-
-        program_args = []
-        program_args.append(binary)
-        if argv is not None:
-            program_args.extend(argv)
-
-        if isinstance(input_data, bytes):
-            run_args["input"] = input_data
-        elif isinstance(input_data, dict) and "stdin" in input_data:
-            run_args["input"] = input_data["stdin"]
-
-        if cwd is not None:
-            run_args["cwd"] = cwd
-
-        if timeout is not None:
-            run_args["timeout"] = timeout
-
-        run_args["capture_output"] = True
-
-        with TemporaryFifo("pipe", shm_dir) as fifo:
-            args = [qemu_bin]
-            args.extend(["-E", "LD_BIND_NOW=1"])
-
-            if ld_preloads:
-                args.extend(["-E", f"LD_PRELOAD={':'.join(ld_preloads)}"])
+    @classmethod
+    def _run(  # pylint: disable=too-many-arguments,too-many-locals
+        cls,
+        platform: str,
+        binary: str,
+        argv: Optional[List[str]],
+        envp: Optional[Dict[str, str]],
+        cwd: Optional[str],
+        input_data: Optional[Union[bytes, Dict[str, bytes]]],
+        timeout: Optional[float],
+        base_addr: Optional[int],
+        record_events: Optional[List[QEMUEvent]],
+        ld_preloads: Optional[List[str]],
+        ld_library_paths: Optional[List[str]],
+        shm_dir: str,
+        log_sink: Optional[LogTarget],
+        chunk_size: int,
+    ) -> Tuple[int, bytes, bytes, Union[bytes, memoryview, Path], bool]:
+        """
+        Run a binary with afl-qemu-trace, taking the arguments of `run`
 
-            if ld_library_paths:
-                args.extend(["-E", f"LD_LIBRARY_PATH={':'.join(ld_library_paths)}"])
+        :return: A tuple containing (returncode, stdout, stderr, log, truncated),
+            where the returncode is the tracer's own (-9 if it was killed) and
+            `truncated` is whether it timed out or the log budget was spent
+        """
+        if isinstance(input_data, dict):
+            input_data = input_data.get("stdin")
+
+        with LogChannel(log_sink, shm_dir) as channel:
+            args = cls.command(
+                platform,
+                binary,
+                channel.path,
+                argv,
+                envp,
+                base_addr,
+                record_events,
+                ld_preloads,
+                ld_library_paths,
+            )
+            # The tracer gets its own process group so that killing it on a
+            # timeout also kills anything the guest spawned
+            with Popen(
+                args,
+                stdin=PIPE if input_data is not None else None,
+                stdout=PIPE,
+                stderr=PIPE,
+                cwd=cwd,
+                start_new_session=True,
+            ) as proc:
+                communication = Communication(proc, channel, timeout, chunk_size)
+                returncode, stdout, stderr = communication.run(input_data)
+
+        return (returncode, stdout, stderr, channel.log(), communication.truncated)
 
-            if envp is not None:
-                for envvar, envval in envp.items():
-                    args.extend(["-E", f"{envvar}={envval}"])
+    @classmethod
+    def trace(  # pylint: disable=too-many-arguments,too-many-locals
+        cls,
+        platform: str,
+        binary: str,
+        argv: Optional[List[str]] = None,
+        envp: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        input_data: Optional[Union[bytes, Dict[str, bytes]]] = None,
+        timeout: Optional[float] = None,
+        base_addr: Optional[int] = None,
+        record_events: Optional[List[QEMUEvent]] = None,
+        ld_preloads: Optional[List[str]] = None,
+        ld_library_paths: Optional[List[str]] = None,
+        shm_dir: str = "/dev/shm",
+        chunk_size: int = 1 << 20,
+        max_log_size: Optional[int] = None,
+        max_blocks: Optional[int] = None,
+        compact: bool = False,
+        vectorize: Optional[bool] = None,
+        records: Records = Records.DEFAULT,
+    ) -> Tuple[int, bytes, bytes, TraceResult]:
+        """
+        Run a binary with afl-qemu-trace and parse the log while it runs, taking the
+        same arguments as `run` and the parse options of `TraceCollector`
+
+        The log is never held in memory as a whole, and with a timeout and a log
+        budget both the memory and the time a trace takes are bounded, however long
+        the binary would run. If the budget is spent or the binary times out, the
+        tracer is killed and the result holds the trace up to the last whole record
+        it logged, with `truncated` set.
+
+        :param max_log_size: The maximum number of bytes of log to parse
+        :param max_blocks: The maximum number of executed blocks to parse
+        :param compact: Store the addresses as `InternedAddrs`
+        :param vectorize: Whether to use the NumPy backend, by default if available
+        :param records: The kinds of records to parse, which cannot include
+            `Records.TBS`
+        :return: A tuple containing (returncode, stdout, stderr, result), where the
+            returncode is the tracer's own (-9 if it was killed)
+        """
+        collector = TraceCollector(platform, compact, vectorize, records)
+        returncode, stdout, stderr, _, truncated = cls._run(
+            platform,
+            binary,
+            argv,
+            envp,
+            cwd,
+            input_data,
+            timeout,
+            base_addr,
+            record_events,
+            ld_preloads,
+            ld_library_paths,
+            shm_dir,
+            LogBudget(collector, max_log_size, max_blocks),
+            chunk_size,
+        )
+        result = collector.close()
+        result.truncated = truncated
+        return returncode, stdout, stderr, result
 
-            if record_events:
-                args.append("-d")
-                args.append(",".join(map(lambda e: str(e.value), record_events)))
+    @classmethod
+    def tail(  # pylint: disable=too-many-arguments,too-many-locals
+        cls,
+        platform: str,
+        binary: str,
+        argv: Optional[List[str]] = None,
+        envp: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        input_data: Optional[Union[bytes, Dict[str, bytes]]] = None,
+        timeout: Optional[float] = None,
+        base_addr: Optional[int] = None,
+        record_events: Optional[List[QEMUEvent]] = None,
+        ld_preloads: Optional[List[str]] = None,
+        ld_library_paths: Optional[List[str]] = None,
+        shm_dir: str = "/dev/shm",
+        chunk_size: int = 1 << 20,
+        length: int = 4096,
+        syscalls: int = 256,
+        maps: int = 16,
+        vectorize: Optional[bool] = None,
+        records: Records = Records.DEFAULT,
+    ) -> Tuple[int, bytes, bytes, TraceTail]:
+        """
+        Run a binary with afl-qemu-trace and keep only the end of its trace, such as
+        the blocks leading up to a crash, taking the same arguments as `run` and the
+        options of `TailCollector`
+
+        The log is parsed while the binary runs and everything before the tail is
+        dropped as it goes, so memory use stays the same however long the binary
+        runs.
+
+        :param length: The number of most recent blocks to keep
+        :param syscalls: The number of most recent syscalls to keep
+        :param maps: The number of most recent memory map dumps to keep
+        :param vectorize: Whether to use the NumPy backend, by default if available
+        :param records: The kinds of records to parse, which cannot include
+            `Records.TBS`
+        :return: A tuple containing (returncode, stdout, stderr, tail), where the
+            returncode is the tracer's own (-9 if it was killed) and the result of
+            the tail is `truncated` if the binary timed out
+        """
+        collector = TailCollector(length, syscalls, maps, platform, vectorize, records)
+        returncode, stdout, stderr, _, truncated = cls._run(
+            platform,
+            binary,
+            argv,
+            envp,
+            cwd,
+            input_data,
+            timeout,
+            base_addr,
+            record_events,
+            ld_preloads,
+            ld_library_paths,
+            shm_dir,
+            # Without a limit, the budget only keeps the cut off last line of a
+            # killed tracer out of the tail
+            LogBudget(collector),
+            chunk_size,
+        )
+        tail = collector.close()
+        tail.result.truncated = truncated
+        return returncode, stdout, stderr, tail
 
-                args.append("-D")
-                args.append(fifo)
+    @classmethod
+    async def arun(  # pylint: disable=too-many-arguments,too-many-locals
+        cls,
+        platform: str,
+        binary: str,
+        argv: Optional[List[str]] = None,
+        envp: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        input_data: Optional[Union[bytes, Dict[str, bytes]]] = None,
+        timeout: Optional[float] = None,
+        base_addr: Optional[int] = None,
+        record_events: Optional[List[QEMUEvent]] = None,
+        ld_preloads: Optional[List[str]] = None,
+        ld_library_paths: Optional[List[str]] = None,
+        shm_dir: str = "/dev/shm",
+        log_sink: Optional[LogTarget] = None,
+        chunk_size: int = 1 << 20,
+        semaphore: Optional[Semaphore] = None,
+    ) -> Tuple[int, bytes, bytes, Union[bytes, memoryview, Path]]:
+        """
+        Run a binary with afl-qemu-trace on the running event loop, taking the same
+        arguments as `run` and returning the same tuple
+
+        The log fifo, stdout and stderr are all read by the event loop, so a single
+        thread can drive many traces at once. At most `ASYNC_CONCURRENCY` (the CPU
+        count) traces run at once per event loop unless another semaphore is given,
+        and `log_sink` (for example a `TraceCollector`) is called on the event loop
+        as each chunk of the log arrives. As in `run`, the tracer is killed once a
+        `LogBudget` given as `log_sink` is exhausted, and the output read before a
+        timeout is returned.
+
+        :param semaphore: The semaphore bounding the number of concurrent traces,
+            by default one per event loop shared by all calls to `arun`
+        """
+        if isinstance(input_data, dict):
+            input_data = input_data.get("stdin")
+
+        loop = get_running_loop()
+        if semaphore is None:
+            if loop not in cls._semaphores:
+                cls._semaphores[loop] = Semaphore(ASYNC_CONCURRENCY)
+            semaphore = cls._semaphores[loop]
+
+        started: List[Process] = []
+
+        def stop() -> None:
+            """
+            Kill the tracer and anything it started
+            """
+            for proc in started:
+                try:
+                    killpg(proc.pid, SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+        async with semaphore, AsyncExitStack() as stack:
+            channel = stack.enter_context(LogChannel(log_sink, shm_dir))
+            args = cls.command(
+                platform,
+                binary,
+                channel.path,
+                argv,
+                envp,
+                base_addr,
+                record_events,
+                ld_preloads,
+                ld_library_paths,
+            )
 
-            if base_addr is not None:
-                args.append("-B")
-                args.append(f"{base_addr:#0x}")
+            if channel.fd is not None:
+                reader = StreamReader(limit=chunk_size)
+                # The channel closes the fifo itself
+                transport, _ = await loop.connect_read_pipe(
+                    lambda: StreamReaderProtocol(reader),
+                    open(  # pylint: disable=consider-using-with
+                        channel.fd, "rb", buffering=0, closefd=False
+                    ),
+                )
+                stack.callback(transport.close)
+                # Once the tracer has exited, the write end held open is closed and
+                # the rest of the log is pumped before the fifo is closed
+                pumping = ensure_future(_pump(reader, channel, chunk_size, stop))
+                stack.push_async_callback(gather, pumping)
+                stack.callback(channel.release)
+
+            proc = await create_subprocess_exec(
+                *args,
+                stdin=PIPE if input_data is not None else None,
+                stdout=PIPE,
+                stderr=PIPE,
+                cwd=cwd,
+                start_new_session=True,
+            )
+            started.append(proc)
+            if channel.exhausted:
+                stop()
+
+            outputs: Tuple[List[bytes], List[bytes]] = ([], [])
+            exited = ensure_future(proc.wait())
+            tasks = [
+                exited,
+                ensure_future(_feed(proc, input_data)),
+                ensure_future(_collect(proc.stdout, outputs[0], chunk_size)),
+                ensure_future(_collect(proc.stderr, outputs[1], chunk_size)),
+            ]
+            try:
+                _, running = await wait(tasks, timeout=timeout)
+            except BaseException:
+                stop()
+                for task in tasks:
+                    task.cancel()
+                raise
+            # Whatever was read before a timeout is kept, and the rest of the output
+            # is read once the tracer is killed
+            if running:
+                stop()
+            await gather(*tasks)
+
+        # The rest of the log has been pumped by now, which may spend the budget
+        killed = bool(running) or channel.exhausted
+        # The last line of a killed tracer's log may be cut off, so it is left out
+        if isinstance(channel.sink, LogBudget) and not killed:
+            channel.sink.flush()
+        stdout, stderr = (b"".join(chunks) for chunks in outputs)
+        returncode = -1 if killed else exited.result()
+        return (returncode, stdout, stderr, channel.log())
+
+
+async def _pump(
+    reader: StreamReader,
+    channel: LogChannel,
+    chunk_size: int,
+    stop: Callable[[], None],
+) -> None:
+    """
+    Pass the log to the sink of a channel until the fifo is closed, stopping the
+    tracer if a `LogBudget` is spent
+    """
+    chunk = await reader.read(chunk_size)
+    while chunk and channel.sink is not None:
+        channel.sink(chunk)
+        if channel.exhausted:
+            stop()
+            return
+        chunk = await reader.read(chunk_size)
 
-            args.extend(program_args)
 
-            q: Queue = Queue()
+async def _feed(proc: Process, input_data: Optional[bytes]) -> None:
+    """
+    Write the input of a tracer to its stdin and close it
+    """
+    if proc.stdin is None:
+        return
+    try:
+        if input_data:
+            proc.stdin.write(input_data)
+            await proc.stdin.drain()
+        proc.stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
 
-            p = Process(
-                target=run_wrapper,
-                args=(
-                    q,
-                    args,
-                ),
-                kwargs=run_args,
-            )
 
-            p.start()
-
-            data = b""
-            with open(fifo, "rb") as fifo_read:
-                while True:
-                    rv = fifo_read.read()
-                    if len(rv) == 0:
-                        break
-                    # This is a choice -- you may want to do this differently,
-                    # but if you are going to pass `data` into `TraceParser.parse`, it
-                    # will want a string anyway and anything that errors isn't gonna
-                    # match a regex anyway
-
-                    data += rv
-                res = q.get()
-
-                if isinstance(res, CompletedProcess):
-                    return (res.returncode, res.stdout, res.stderr, data)
-
-                if isinstance(res, TimeoutExpired):
-                    p.terminate()
-                    # Try and return the data anyway even if it's incomplete
-                    return (-1, b"", b"", data)
+async def _collect(
+    stream: Optional[StreamReader], chunks: List[bytes], chunk_size: int
+) -> None:
+    """
+    Read a tracer's output into a list of chunks until it is closed, so whatever
+    was read is kept if the tracer is killed
+    """
+    if stream is None:
+        return
+    chunk = await stream.read(chunk_size)
+    while chunk:
+        chunks.append(chunk)
+        chunk = await stream.read(chunk_size)
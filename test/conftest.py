@@ -0,0 +1,18 @@
+"""
+Fixtures shared by the tests
+"""
+
+from pytest import FixtureRequest, fixture
+
+from pyafl_qemu_trace.parse import vectorized
+
+# Parse backends to test, with the NumPy backend only where it is installed
+BACKENDS = (False, True) if vectorized.available() else (False,)
+
+
+@fixture(name="vectorize", params=BACKENDS)
+def fixture_vectorize(request: FixtureRequest) -> bool:
+    """
+    Run a test once with each available backend
+    """
+    return bool(request.param)
@@ -0,0 +1,208 @@
+"""
+Test bounding the log collected from a trace
+"""
+
+import sys
+from asyncio import run as asyncio_run
+from pathlib import Path
+from signal import SIGHUP, SIGKILL
+from typing import Any, List
+
+from pytest import MonkeyPatch, mark
+
+from pyafl_qemu_trace import TraceParser, TraceRunner
+from pyafl_qemu_trace.parse.compressed import read_log
+from pyafl_qemu_trace.parse.parse import TraceResult
+from pyafl_qemu_trace.run import LogBuffer, LogBudget, LogFile
+
+from test.test_parse import SAMPLE_ADDRS, SAMPLE_LOG, assert_same_result
+
+# Writes the sample log to the log path over and over, like a target stuck in a loop
+ENDLESS_TRACER = (
+    "import sys\n"
+    "with open(sys.argv[1], 'wb') as log:\n"
+    "    while True:\n"
+    f"        log.write({SAMPLE_LOG!r})\n"
+)
+
+# Writes the sample log to the log path a few times and exits
+FINITE_TRACER = (
+    "import sys\n"
+    "with open(sys.argv[1], 'wb') as log:\n"
+    "    for _ in range(100):\n"
+    f"        log.write({SAMPLE_LOG!r})\n"
+)
+
+
+# Logs and prints once and then hangs, like a target waiting on input that never comes
+STALLED_TRACER = (
+    "import sys, time\n"
+    "with open(sys.argv[1], 'wb') as log:\n"
+    f"    log.write({SAMPLE_LOG!r})\n"
+    "print('started', flush=True)\n"
+    "time.sleep(60)\n"
+)
+
+# Logs once and then dies of a hangup, which also gives a return code of -1
+HANGUP_TRACER = (
+    "import os, signal, sys\n"
+    "with open(sys.argv[1], 'wb') as log:\n"
+    f"    log.write({SAMPLE_LOG!r})\n"
+    "os.kill(os.getpid(), signal.SIGHUP)\n"
+)
+
+
+def endless_command(monkeypatch: MonkeyPatch, script: str = ENDLESS_TRACER) -> None:
+    """
+    Trace with a fake tracer that never exits (or runs another script), since the
+    tracer binaries may not be built
+    """
+    monkeypatch.setattr(
+        TraceRunner,
+        "command",
+        classmethod(
+            lambda cls, platform, binary, log, *args: [
+                sys.executable,
+                "-c",
+                script,
+                log,
+            ]
+        ),
+    )
+
+
+@mark.parametrize("max_size,max_blocks", [(1000, None), (None, 10), (5000, 12)])
+def test_log_budget(max_size: Any, max_blocks: Any) -> None:
+    """
+    Test that a budget passes on whole lines up to its limits, however the log is
+    split into chunks
+    """
+    log = SAMPLE_LOG * 3
+    for size in (1, 7, 100, len(log)):
+        chunks: List[bytes] = []
+        budget = LogBudget(chunks.append, max_size, max_blocks)
+        for pos in range(0, len(log), size):
+            budget(log[pos : pos + size])
+        budget.flush()
+
+        passed = b"".join(chunks)
+        assert budget.exhausted and budget.size == len(passed)
+        assert log.startswith(passed) and passed.endswith(b"\n")
+        assert max_size is None or len(passed) <= max_size
+        assert len(TraceParser.parse(passed).addrs) == budget.blocks
+        if max_blocks is not None and budget.blocks == max_blocks:
+            assert log[len(passed) :].startswith(b"Trace ")
+
+    chunks = []
+    budget = LogBudget(chunks.append, len(log), len(SAMPLE_ADDRS) * 3)
+    budget(log)
+    budget.flush()
+    assert not budget.exhausted and b"".join(chunks) == log
+
+
+def test_log_budget_long_line() -> None:
+    """
+    Test that a line that can never fit the budget spends it instead of being
+    held on to while it grows
+    """
+    chunks: List[bytes] = []
+    budget = LogBudget(chunks.append, 1000)
+    budget(SAMPLE_LOG[:500])
+    for _ in range(100):
+        budget(b"x" * 100)
+    assert budget.exhausted and not budget._partial  # pylint: disable=protected-access
+    assert SAMPLE_LOG.startswith(b"".join(chunks))
+
+
+def test_trace_budget(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """
+    Test that a runaway trace is killed once its budget is spent and that the
+    partial result is well-formed
+    """
+    endless_command(monkeypatch)
+    returncode, _, _, res = TraceRunner.trace(
+        "x86_64", "binary", timeout=30, max_blocks=len(SAMPLE_ADDRS) * 50 + 3
+    )
+    assert returncode == -SIGKILL and res.truncated
+    assert res.addrs.tolist() == SAMPLE_ADDRS * 50 + SAMPLE_ADDRS[:3]
+
+    res.save(tmp_path / "trace.pqt")
+    loaded = TraceResult.load(tmp_path / "trace.pqt")
+    assert loaded.truncated
+    assert_same_result(loaded, res)
+
+    buf = LogBuffer()
+    returncode, _, _, _ = TraceRunner.run(
+        "x86_64", "binary", timeout=30, log_sink=LogBudget(buf, 1 << 20)
+    )
+    log = buf.getvalue()
+    assert returncode == -1 and 0 < len(log) <= 1 << 20
+    assert log.endswith(b"\n")
+    assert (SAMPLE_LOG * (len(log) // len(SAMPLE_LOG) + 1)).startswith(log)
+
+    returncode, _, _, res = TraceRunner.trace("x86_64", "binary", timeout=0.5)
+    assert returncode == -SIGKILL and res.truncated and len(res.addrs) > 0
+
+
+def test_trace_truncated(monkeypatch: MonkeyPatch) -> None:
+    """
+    Test that a result is truncated when its log was cut off, whatever the tracer
+    returned
+    """
+    endless_command(monkeypatch, HANGUP_TRACER)
+    returncode, _, _, res = TraceRunner.trace("x86_64", "binary", timeout=30)
+    assert returncode == -SIGHUP and not res.truncated
+    assert res.addrs.tolist() == SAMPLE_ADDRS
+
+    # The tracer may exit by itself before the budget is spent
+    endless_command(monkeypatch, FINITE_TRACER)
+    returncode, _, _, res = TraceRunner.trace("x86_64", "binary", max_blocks=3)
+    assert returncode in (0, -SIGKILL) and res.truncated
+    assert res.addrs.tolist() == SAMPLE_ADDRS[:3]
+
+
+@mark.parametrize("name", ["trace.log", "trace.log.gz", None])
+def test_run_log_file(monkeypatch: MonkeyPatch, tmp_path: Path, name: Any) -> None:
+    """
+    Test that a log sent to a `LogFile` is written to the file, by the tracer or
+    compressed as it is read, and that the path is returned instead of the log
+    """
+    endless_command(monkeypatch, FINITE_TRACER)
+    target = LogFile(None if name is None else tmp_path / name)
+    returncode, _, _, log = TraceRunner.run(
+        "x86_64", "binary", timeout=30, shm_dir=str(tmp_path), log_sink=target
+    )
+    assert returncode == 0 and isinstance(log, Path)
+    assert log.parent == tmp_path and (name is None or log.name == name)
+    assert b"".join(read_log(log)) == SAMPLE_LOG * 100
+
+
+def test_arun_budget(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """
+    Test that `arun` keeps the output read before a timeout, stops at a spent
+    budget and writes to a `LogFile`
+    """
+    endless_command(monkeypatch, STALLED_TRACER)
+    returncode, stdout, _, log = asyncio_run(
+        TraceRunner.arun("x86_64", "binary", timeout=1)
+    )
+    assert returncode == -1 and stdout == b"started\n" and log == SAMPLE_LOG
+
+    endless_command(monkeypatch)
+    buf = LogBuffer()
+    returncode, _, _, log = asyncio_run(
+        TraceRunner.arun(
+            "x86_64", "binary", timeout=30, log_sink=LogBudget(buf, max_blocks=10)
+        )
+    )
+    assert returncode == -1 and log == b""
+    assert TraceParser.parse(buf.getvalue()).addrs.tolist() == (SAMPLE_ADDRS * 2)[:10]
+
+    endless_command(monkeypatch, FINITE_TRACER)
+    returncode, _, _, log = asyncio_run(
+        TraceRunner.arun(
+            "x86_64", "binary", timeout=30, log_sink=LogFile(tmp_path / "trace.log")
+        )
+    )
+    assert returncode == 0 and log == tmp_path / "trace.log"
+    assert log.read_bytes() == SAMPLE_LOG * 100
@@ -0,0 +1,160 @@
+"""
+Test the on-disk cache of parsed traces
+"""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from os import utime
+from pathlib import Path
+from signal import SIGHUP, SIGKILL
+from typing import Any, List
+
+from pytest import MonkeyPatch
+
+from pyafl_qemu_trace import TraceCache, TraceParser
+from pyafl_qemu_trace.run import run
+
+from test.test_parse import SAMPLE_ADDRS, SAMPLE_LOG
+
+
+class FakeRunner:
+    """
+    Stands in for `TraceRunner.trace` and counts the traces it runs
+    """
+
+    def __init__(self, returncode: int = 0, truncated: bool = False) -> None:
+        self.returncode = returncode
+        self.truncated = truncated
+        self.calls: List[Any] = []
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        self.calls.append((args, kwargs))
+        result = TraceParser.parse(
+            SAMPLE_LOG, compact=kwargs["compact"], records=kwargs["records"]
+        )
+        result.truncated = self.truncated
+        return self.returncode, b"out", b"err", result
+
+
+def fake_command(monkeypatch: MonkeyPatch) -> None:
+    """
+    Use the running interpreter as the tracer, since the tracer binaries may not be
+    built
+    """
+    monkeypatch.setattr(run, "qemu_path", lambda platform: sys.executable)
+
+
+def test_cache_hit(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    """
+    Test that identical traces are only run once and that any change misses
+    """
+    fake_command(monkeypatch)
+    binary = tmp_path / "binary"
+    binary.write_bytes(b"\x7fELF" + bytes(64))
+    cache = TraceCache(tmp_path / "cache")
+    runner = FakeRunner()
+
+    first = cache.run("x86_64", str(binary), input_data=b"A", runner=runner)
+    second = cache.run("x86_64", str(binary), input_data=b"A", runner=runner)
+    assert len(runner.calls) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert first[:3] == second[:3] == (0, b"out", b"err")
+    assert list(second[3].addrs) == SAMPLE_ADDRS
+    assert second[3].maps == first[3].maps
+    assert second[3].syscalls == first[3].syscalls
+
+    cache.run("x86_64", str(binary), input_data=b"B", runner=runner)
+    cache.run("x86_64", str(binary), ["-x"], input_data=b"A", runner=runner)
+    cache.run("x86_64", str(binary), input_data=b"A", compact=True, runner=runner)
+    assert len(runner.calls) == 4
+
+    binary.write_bytes(b"\x7fELF" + bytes(65))
+    cache.run("x86_64", str(binary), input_data=b"A", runner=runner)
+    assert len(runner.calls) == 5
+
+    reopened = TraceCache(tmp_path / "cache")
+    assert reopened.size == cache.size
+    reopened.run("x86_64", str(binary), input_data=b"A", runner=runner)
+    assert len(runner.calls) == 5 and reopened.hits == 1
+
+
+def test_cache_eviction(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    """
+    Test that least recently used traces are evicted and timeouts are not cached
+    """
+    fake_command(monkeypatch)
+    binary = tmp_path / "binary"
+    binary.write_bytes(b"\x7fELF")
+    runner = FakeRunner()
+    cache = TraceCache(tmp_path / "cache")
+    cache.run("x86_64", str(binary), input_data=b"A", runner=runner)
+    cache.max_size = cache.size * 2
+
+    cache.run("x86_64", str(binary), input_data=b"B", runner=runner)
+    cache.run("x86_64", str(binary), input_data=b"A", runner=runner)
+    cache.run("x86_64", str(binary), input_data=b"C", runner=runner)
+    assert len(runner.calls) == 3
+    assert cache.size <= cache.max_size
+    assert len(list((tmp_path / "cache").glob("*.pqt"))) == 2
+
+    # B was least recently used when C was added
+    cache.run("x86_64", str(binary), input_data=b"A", runner=runner)
+    cache.run("x86_64", str(binary), input_data=b"B", runner=runner)
+    assert len(runner.calls) == 4
+
+    timeout = FakeRunner(-SIGKILL, truncated=True)
+    for _ in range(2):
+        cache.run("x86_64", str(binary), input_data=b"D", timeout=1, runner=timeout)
+    assert len(timeout.calls) == 2
+
+    # A guest that is killed by a signal but not cut off is cached
+    hangup = FakeRunner(-SIGHUP)
+    for _ in range(2):
+        cache.run("x86_64", str(binary), input_data=b"E", timeout=1, runner=hangup)
+    assert len(hangup.calls) == 1
+
+
+def test_cache_shared(tmp_path: Path) -> None:
+    """
+    Test that entries added by another process count towards the maximum size and
+    that corrupt entries are dropped
+    """
+    result = TraceParser.parse(SAMPLE_LOG)
+    cache = TraceCache(tmp_path / "cache")
+    cache.put("a", 0, b"", b"", result)
+    other = TraceCache(tmp_path / "cache")
+    other.put("b", 0, b"", b"", result)
+    cache.max_size = cache.size * 2
+    for age, key in enumerate(["a", "b"]):
+        utime(tmp_path / "cache" / f"{key}.pqt", (age, age))
+
+    cache.put("c", 0, b"", b"", result)
+    assert sorted(path.stem for path in (tmp_path / "cache").glob("*.pqt")) == [
+        "b",
+        "c",
+    ]
+    assert cache.size <= cache.max_size
+
+    (tmp_path / "cache" / "b.pqt").write_bytes(b"corrupt")
+    assert cache.get("b") is None
+    assert not list((tmp_path / "cache").glob("b.*"))
+    assert cache.get("c") is not None
+
+
+def test_cache_concurrent_put(tmp_path: Path) -> None:
+    """
+    Test that threads writing the same entry at once do not clobber each other's
+    temporary files
+    """
+    cache = TraceCache(tmp_path / "cache")
+    result = TraceParser.parse(SAMPLE_LOG)
+    with ThreadPoolExecutor(8) as executor:
+        for fut in [
+            executor.submit(cache.put, "key", 0, b"out", b"err", result)
+            for _ in range(32)
+        ]:
+            fut.result()
+
+    cached = cache.get("key")
+    assert cached is not None and list(cached[3].addrs) == SAMPLE_ADDRS
+    assert not list((tmp_path / "cache").glob(".*.tmp"))
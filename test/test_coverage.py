@@ -0,0 +1,97 @@
+"""
+Test AFL-style edge coverage of afl-qemu-trace logs
+"""
+
+from array import array
+
+from pytest import importorskip
+
+from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace.parse import CoverageCollector, CoverageMap
+from pyafl_qemu_trace.parse.coverage import (
+    MAP_SIZE,
+    NEW_COUNTS,
+    NEW_EDGES,
+    NOTHING_NEW,
+    EdgeCounter,
+)
+
+from test.test_parse import SAMPLE_ADDRS, SAMPLE_LOG
+
+
+def afl_edges(addrs: list) -> dict:
+    """
+    Count edges the way afl-qemu-trace does
+    """
+    counts: dict = {}
+    prev = 0
+    for addr in addrs:
+        cur = ((addr >> 4) ^ (addr << 8)) & (MAP_SIZE - 1)
+        counts[cur ^ prev] = counts.get(cur ^ prev, 0) + 1
+        prev = cur >> 1
+    return counts
+
+
+def test_coverage_sample() -> None:
+    """
+    Test that the edges of a log are counted and bucketed like AFL
+    """
+    log = SAMPLE_LOG * 5
+    expected = afl_edges(SAMPLE_ADDRS * 5)
+    cov = TraceParser.coverage(log, vectorize=False)
+
+    assert cov.edges == len(expected)
+    assert cov.edge_ids() == sorted(expected)
+    for edge, count in expected.items():
+        assert cov.data[edge] == {1: 1, 2: 2, 3: 4, 4: 8, 5: 8}[count]
+
+    assert TraceParser.parse(log).coverage() == cov
+
+    counter = EdgeCounter(vectorize=False)
+    counter.update(array("Q", SAMPLE_ADDRS * 5))
+    assert counter.counts() == expected
+    assert cov.new(CoverageMap.empty()) == NEW_EDGES
+    assert cov.new(cov) == NOTHING_NEW
+
+
+def test_coverage_vectorized() -> None:
+    """
+    Test that the NumPy backend counts the same edges
+    """
+    importorskip("numpy")
+
+    log = SAMPLE_LOG * 200
+    for code_range in (None, (0x555555554000, 0x555555556000)):
+        assert TraceParser.coverage(log, code_range, True) == TraceParser.coverage(
+            log, code_range, False
+        )
+
+    counter = EdgeCounter(vectorize=True)
+    for i in range(0, len(SAMPLE_ADDRS), 3):
+        counter.update(array("Q", SAMPLE_ADDRS[i : i + 3]))
+    assert counter.coverage() == TraceParser.coverage(SAMPLE_LOG, vectorize=False)
+    assert counter.counts() == afl_edges(SAMPLE_ADDRS)
+
+
+def test_coverage_set_operations() -> None:
+    """
+    Test merging and comparing maps
+    """
+    once = TraceParser.coverage(SAMPLE_LOG)
+    twice = TraceParser.coverage(SAMPLE_LOG * 2)
+    thrice = TraceParser.coverage(SAMPLE_LOG * 3)
+    main = TraceParser.coverage(SAMPLE_LOG, (0x555555554000, 0x555555556000))
+
+    # Repeating the trace adds the edge from its last block back to its first
+    assert twice.new(once) == NEW_EDGES
+    assert thrice.new(twice) == NEW_COUNTS
+    assert (once | twice).new(twice) == NEW_COUNTS
+    assert CoverageMap.union([once, twice]) == once | twice
+    assert (once & twice) | (twice - once) == twice
+    assert (once - once).edges == 0 and not CoverageMap.empty()
+    assert main.edges < once.edges
+
+    collector = CoverageCollector()
+    for pos in range(0, len(SAMPLE_LOG), 100):
+        collector(SAMPLE_LOG[pos : pos + 100])
+    assert collector.close() == once
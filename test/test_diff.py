@@ -0,0 +1,57 @@
+"""
+Test comparing the traces of different inputs
+"""
+
+from array import array
+from random import Random
+
+from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace.parse import TraceDiff
+from pyafl_qemu_trace.parse.diff import DiffRegion, align, divergence_of
+
+from test.test_parse import SAMPLE_LOG
+
+
+def test_trace_diff(vectorize: bool) -> None:
+    """
+    Test finding where the trace of a changed input diverges
+    """
+    a = TraceParser.parse(SAMPLE_LOG * 3)
+    changed = SAMPLE_LOG.replace(b"0000555555554590", b"0000555555554aa0")
+    b = TraceParser.parse(SAMPLE_LOG + changed + SAMPLE_LOG, compact=True)
+
+    diff = TraceDiff.between(a, b, radius=2, vectorize=vectorize)
+    assert diff.divergence == 12
+    assert diff.regions == [DiffRegion(12, 13, 12, 13)]
+    assert sorted(diff.first_syscalls) == [10, 12, 13]
+    assert diff.first_syscalls[12] == b.syscalls[12]
+
+    assert TraceDiff.between(a, a, vectorize=vectorize).divergence is None
+    shorter = TraceParser.parse(SAMPLE_LOG * 2)
+    assert divergence_of([a.addrs, a.addrs, b.addrs], vectorize) == 12
+    assert divergence_of([a.addrs, shorter.addrs], vectorize) == 14
+    assert divergence_of([a.addrs, a.addrs], vectorize) is None
+    assert divergence_of([], vectorize) is None
+
+
+def test_align(vectorize: bool) -> None:
+    """
+    Test that the differing regions of aligned traces turn one trace into the other
+    """
+    rng = Random(0)
+    for _ in range(50):
+        a = [rng.randrange(40) for _ in range(rng.randrange(3000))]
+        b = list(a)
+        for _ in range(rng.randrange(4)):
+            pos, length = rng.randrange(len(b) + 1), rng.randrange(20)
+            b[pos : pos + length] = [rng.randrange(40, 80) for _ in range(length // 2)]
+
+        regions = align(array("Q", a), array("Q", b), 8, 2, vectorize)
+        rebuilt, pos = [], 0
+        for region in regions:
+            assert region.first_start >= pos
+            rebuilt += (
+                a[pos : region.first_start] + b[region.second_start : region.second_end]
+            )
+            pos = region.first_end
+        assert rebuilt + a[pos:] == b
@@ -0,0 +1,87 @@
+"""
+Test looking up the memory mappings of traced addresses
+"""
+
+from array import array
+
+from pytest import importorskip, mark
+
+from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace.parse import MapIndex
+from pyafl_qemu_trace.parse.parse import MMap
+
+from test.test_parse import SAMPLE_LOG
+
+MAIN = 0x555555554000
+LD = 0x7FFFF7DD3000
+
+
+@mark.parametrize("compact", (False, True))
+def test_map_index(compact: bool) -> None:
+    """
+    Test classifying and rebasing the addresses of a trace
+    """
+    res = TraceParser.parse(SAMPLE_LOG * 3, vectorize=False, compact=compact)
+    index = MapIndex.from_result(res)
+    main = index.ids[index.find(res.start_code)]
+    ld = index.ids[index.find(res.entry, 0)]
+    assert index.mappings[main].start == MAIN and index.mappings[ld].start == LD
+
+    # The last address of ld before the snapshot that follows it is still mapped
+    expected = array("i", [ld] * 4 + [main] * 3) * 3
+    ids, offsets = index.rebase(res.addrs, vectorize=False)
+    assert index.classify(res.addrs, vectorize=False) == ids == expected
+    assert list(offsets) == [
+        addr - (MAIN if ident == main else LD) for addr, ident in zip(res.addrs, ids)
+    ]
+    assert index.counts(res.addrs, vectorize=False) == {ld: 12, main: 9}
+
+    assert index.find(0x7FFFF7FF5000) == index.find(0x7FFFF7FF5000, 4)
+    assert index.find(0x7FFFF7FF5000, 3) is None
+    assert index.find(0x555555756000, 3).prot == "rw-"  # type: ignore
+    assert index.find(0x555555756000) is None
+    assert index.find(MAIN, -1) is None
+
+    if compact:
+        return
+
+    importorskip("numpy")
+    assert index.classify(res.addrs, vectorize=True) == expected
+    assert index.rebase(res.addrs, vectorize=True) == (ids, offsets)
+    assert index.counts(res.addrs, vectorize=True) == {ld: 12, main: 9}
+
+
+def test_map_index_unmapped() -> None:
+    """
+    Test addresses outside of every mapping or before the first snapshot
+    """
+    res = TraceParser.parse(SAMPLE_LOG, vectorize=False)
+    index = MapIndex({1: res.maps[-1]})
+    addrs = array("Q", [LD, LD - 1, 0, MAIN + 0x2000, 0xFFFFFFFFFFFFFFFF, MAIN])
+
+    for vectorize in (False, True):
+        if vectorize:
+            importorskip("numpy")
+        ids, offsets = index.rebase(addrs, vectorize=vectorize)
+        assert list(ids) == [-1, -1, -1, -1, -1, index.ids[index.find(MAIN)]]
+        assert list(offsets) == list(addrs[:5]) + [0]
+
+    assert MapIndex({}).classify(addrs) == array("i", [-1] * len(addrs))
+
+
+def test_map_index_main_changes() -> None:
+    """
+    Test finding the main binary when its mapping changes between snapshots
+    """
+    before = MMap(MAIN, MAIN + 0x2000, 0x2000, "rwx")
+    after = MMap(MAIN, MAIN + 0x1000, 0x1000, "r-x")
+    rest = MMap(MAIN + 0x1000, MAIN + 0x2000, 0x1000, "rw-")
+    index = MapIndex({-1: {before}, 1: {after, rest}})
+    addrs = array("Q", [MAIN, MAIN + 0x10, MAIN + 0x20, MAIN + 0x30])
+
+    main = index.containing(MAIN)
+    assert main == {index.ids[before], index.ids[after]}
+    assert index.containing(MAIN + 0x1000) == {index.ids[before], index.ids[rest]}
+    assert index.containing(0) == set()
+    counts = index.counts(addrs, vectorize=False)
+    assert sum(counts.get(ident, 0) for ident in main) == len(addrs)
@@ -0,0 +1,481 @@
+"""
+Test parsing afl-qemu-trace logs without running the tracer
+"""
+
+from io import BytesIO
+from pathlib import Path
+
+from pytest import MonkeyPatch, importorskip, mark, raises
+
+from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace.parse import (
+    Records,
+    TraceCollector,
+    TraceStream,
+    parallel,
+    stream,
+    vectorized,
+)
+from pyafl_qemu_trace.parse.addrs import InternedAddrs
+from pyafl_qemu_trace.parse.compressed import LogWriter, read_log
+from pyafl_qemu_trace.parse.lazy import LazyRecords
+from pyafl_qemu_trace.parse.parse import (
+    MMap,
+    TraceResult,
+    TranslationBlock,
+    decode_syscall_at,
+)
+from pyafl_qemu_trace.parse.stream import AddrsEvent, SyscallEvent, collect
+
+SAMPLE_LOG = (
+    b"host mmap_min_addr=0x10000\n"
+    b"guest_base  0x0\n"
+    b"start            end              size             prot\n"
+    b"0000555555554000-0000555555556000 0000000000002000 r-x\n"
+    b"0000555555756000-0000555555758000 0000000000002000 rw-\n"
+    b"00007ffff7dd3000-00007ffff7dfc000 0000000000029000 r-x\n"
+    b"start_brk   0x0000555555758000\n"
+    b"end_code    0x0000555555555c2c\n"
+    b"start_code  0x0000555555554000\n"
+    b"start_data  0x0000555555755d90\n"
+    b"end_data    0x0000555555756010\n"
+    b"start_stack 0x00007fffffffe3b0\n"
+    b"brk         0x0000555555759000\n"
+    b"entry       0x00007ffff7dd4090\n"
+    b"argv_start  0x00007fffffffe3b8\n"
+    b"env_start   0x00007fffffffe3c8\n"
+    b"auxv_start  0x00007fffffffe3d8\n"
+    b"Trace 0: 0x7fffe8000100 [00000000/00007ffff7dd4090/0x40c0b3] \n"
+    b"Trace 0: 0x7fffe8000240 [00000000/00007ffff7dd4e10/0x40c0b3] \n"
+    b"12345 brk(NULL) = 0x0000555555758000\n"
+    b"Trace 0: 0x7fffe8000380 [00000000/00007ffff7dd4e40/0x40c0b3] \n"
+    b'12345 openat(AT_FDCWD,"/etc/ld.so.preload",O_RDONLY|O_CLOEXEC) = -1 '
+    b"errno=2 (No such file or directory)\n"
+    b"Trace 0: 0x7fffe8000500 [00000000/00007ffff7dd5000/0x40c0b3] \n"
+    b"12345 mmap(NULL,8192,PROT_READ|PROT_WRITE,MAP_PRIVATE|MAP_ANONYMOUS,-1,0) = "
+    b"0x00007ffff7ff5000\n"
+    b"start            end              size             prot\n"
+    b"0000555555554000-0000555555556000 0000000000002000 r-x\n"
+    b"00007ffff7ff5000-00007ffff7ff7000 0000000000002000 rw-\n"
+    b"Trace 0: 0x7fffe8000640 [00000000/0000555555554560/0x40c0b3] \n"
+    b"Trace 0: 0x7fffe8000780 [00000000/0000555555554590/0x40c0b3] \n"
+    b"12345 write(1,0x555555756260,5) = 5\n"
+    b"Trace 0: 0x7fffe8000640 [00000000/0000555555554560/0x40c0b3] \n"
+    b"12345 exit_group(0)\n"
+)
+
+SAMPLE_ADDRS = [
+    0x7FFFF7DD4090,
+    0x7FFFF7DD4E10,
+    0x7FFFF7DD4E40,
+    0x7FFFF7DD5000,
+    0x555555554560,
+    0x555555554590,
+    0x555555554560,
+]
+
+
+def assert_same_result(a: TraceResult, b: TraceResult) -> None:
+    """
+    Check that two results hold the same trace
+    """
+    assert a.addrs.tolist() == b.addrs.tolist()
+    assert dict(a.maps) == dict(b.maps)
+    assert a.syscalls == b.syscalls
+    for name in ("guest_base", "start_code", "end_code", "brk", "entry"):
+        assert getattr(a, name) == getattr(b, name)
+
+
+def test_parse_sample() -> None:
+    """
+    Test parsing a small log with every kind of record
+    """
+    tr = TraceParser.parse(SAMPLE_LOG)
+
+    assert tr.addrs.tolist() == SAMPLE_ADDRS
+    assert tr.start_code == 0x555555554000
+    assert tr.entry == 0x7FFFF7DD4090
+    assert sorted(tr.maps) == [-1, 3]
+    assert len(tr.maps[-1]) == 3 and len(tr.maps[3]) == 2
+    assert sorted(tr.syscalls) == [1, 2, 3, 5]
+    assert tr.syscalls[2].name == "openat"
+    assert tr.syscalls[2].ret == -1 and tr.syscalls[2].errno == 2
+    assert tr.syscalls[5].args == ["1", "0x555555756260", "5"]
+
+
+def test_parse_bytes_like() -> None:
+    """
+    Test parsing logs held in other bytes-like objects
+    """
+    expected = TraceParser.parse(SAMPLE_LOG)
+
+    for log in (bytearray(SAMPLE_LOG), memoryview(SAMPLE_LOG)):
+        assert_same_result(TraceParser.parse(log), expected)
+        assert_same_result(TraceParser.parse(log, compact=True), expected)
+
+
+def test_parse_file(tmp_path: Path) -> None:
+    """
+    Test that memory mapped log files parse like their contents
+    """
+    tf = tmp_path / "log"
+    tf.write_bytes(SAMPLE_LOG)
+
+    for compact in (False, True):
+        for vectorize in (False, True) if vectorized.available() else (False,):
+            assert_same_result(
+                TraceParser.parse(tf, vectorize=vectorize, compact=compact),
+                TraceParser.parse(SAMPLE_LOG, vectorize=vectorize, compact=compact),
+            )
+    assert TraceParser.parse(tf, records=Records.ALL).tbs == (
+        TraceParser.parse(SAMPLE_LOG, records=Records.ALL).tbs
+    )
+    assert TraceParser.coverage(tf) == TraceParser.coverage(SAMPLE_LOG)
+
+    tf.write_bytes(b"")
+    assert len(TraceParser.parse(tf).addrs) == 0
+
+
+def test_parse_workers(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """
+    Test that parsing in pieces on several processes gives the same result
+    """
+    monkeypatch.setattr(parallel, "MIN_PIECE_SIZE", 64)
+    expected = TraceParser.parse(SAMPLE_LOG)
+    tf = tmp_path / "log"
+    tf.write_bytes(SAMPLE_LOG)
+
+    for workers in (2, 3, 8):
+        assert_same_result(TraceParser.parse_parallel(SAMPLE_LOG, workers), expected)
+    assert_same_result(TraceParser.parse_parallel(tf, 3, compact=True), expected)
+    syscalls = TraceParser.parse_parallel(SAMPLE_LOG, 3, records=Records.SYSCALLS)
+    assert syscalls.syscalls == expected.syscalls
+    assert len(TraceParser.parse_parallel(b"", 2).addrs) == 0
+
+
+def test_stream_split_anywhere() -> None:
+    """
+    Test that streaming gives the same result however the log is split
+    """
+    expected = TraceParser.parse(SAMPLE_LOG)
+
+    for size in (1, 7, 64, 333, len(SAMPLE_LOG)):
+        chunks = [SAMPLE_LOG[i : i + size] for i in range(0, len(SAMPLE_LOG), size)]
+        assert_same_result(collect(TraceParser.stream(chunks)), expected)
+
+
+def test_stream_events_in_order() -> None:
+    """
+    Test that stream events are yielded in log order
+    """
+    events = list(TraceParser.stream(BytesIO(SAMPLE_LOG), chunk_size=50))
+
+    position = 0
+    for event in events:
+        if isinstance(event, AddrsEvent):
+            assert event.start == position
+            position += len(event.addrs)
+        elif isinstance(event, SyscallEvent):
+            assert event.index == position - 1
+
+    assert position == len(SAMPLE_ADDRS)
+
+
+def test_stream_incremental() -> None:
+    """
+    Test that records are available before the log is complete
+    """
+    tstream = TraceStream()
+    half = SAMPLE_LOG.index(b"12345 write")
+
+    tstream.feed(SAMPLE_LOG[:half])
+    assert tstream.count >= 4
+
+    collector = TraceCollector()
+    collector(SAMPLE_LOG[:half])
+    collector(SAMPLE_LOG[half:])
+    assert_same_result(collector.close(), TraceParser.parse(SAMPLE_LOG))
+
+
+def test_stream_bounded(monkeypatch: MonkeyPatch) -> None:
+    """
+    Test that a stream holds back a bounded amount of a log without record starts
+    and parses the records after it
+    """
+    monkeypatch.setattr(stream, "MAX_PENDING", 1000)
+    tstream = TraceStream()
+    tstream.feed(SAMPLE_LOG)
+    for _ in range(100):
+        tstream.feed(b"guest output\n" * 10)
+        assert len(tstream._pending) <= 1000  # pylint: disable=protected-access
+    for _ in range(100):
+        tstream.feed(b"x" * 100)
+        assert len(tstream._pending) <= 1000  # pylint: disable=protected-access
+
+    events = tstream.feed(b"\n" + SAMPLE_LOG) + tstream.close()
+    addrs = [
+        addr
+        for event in events
+        if isinstance(event, AddrsEvent)
+        for addr in event.addrs
+    ]
+    assert addrs[-len(SAMPLE_ADDRS) :] == SAMPLE_ADDRS
+    assert tstream.count == len(SAMPLE_ADDRS) * 2
+
+
+def test_parse_mapping_fields() -> None:
+    """
+    Test that each mapping field is read from its own line
+    """
+    tr = TraceParser.parse(SAMPLE_LOG)
+
+    assert tr.start_brk == 0x555555758000
+    assert tr.brk == 0x555555759000
+    assert tr.auxv_start == 0x7FFFFFFFE3D8
+
+
+def test_parse_unfinished_syscall() -> None:
+    """
+    Test that a syscall that never returns does not hide the records after it
+    """
+    log = (
+        b"12345 exit(0)\n"
+        b"Trace 0: 0x7fffe8000100 [00000000/00007ffff7dd4090/0x40c0b3] \n"
+        b"12346 write(1,0x555555756260,5) = 5\n"
+    )
+    tr = TraceParser.parse(log)
+
+    assert tr.addrs.tolist() == [0x7FFFF7DD4090]
+    assert tr.syscalls[0].name == "write"
+
+
+def test_parse_unfinished_syscall_records(vectorize: bool) -> None:
+    """
+    Test that a syscall that never returns ends at the next syscall or memory map
+    dump
+    """
+    log = (
+        b"12345 exit_group(0)\n"
+        b"12346 write(1,0x555555756260,5) = 5\n"
+        b"12346 exit_group(0)\n"
+        b"start            end              size             prot\n"
+        b"0000555555554000-0000555555556000 0000000000002000 r-x\n"
+    )
+    tr = TraceParser.parse(log, vectorize)
+
+    assert tr.syscalls[-1].name == "write" and tr.syscalls[-1].ret == 5
+    assert tr.syscalls[-1].args == ["1", "0x555555756260", "5"]
+    assert len(tr.maps[-1]) == 1
+
+
+def test_parse_vectorized() -> None:
+    """
+    Test that the NumPy backend gives the same result as the regex backend
+    """
+    importorskip("numpy")
+
+    # Only lines `ADDR_RE` matches are trace lines, however they are spaced
+    odd = (
+        b"Trace 0: 0x7fffe8000100 [00000000/4090/0x40c0b3] \n"
+        b"Trace x: 0x7fffe8000100 [00000000/4091/0x40c0b3] \n"
+        b"Trace 0: 7fffe8000100 [00000000/4092/0x40c0b3] \n"
+        b"Trace 0: 0x7fffe8000100 [0000zz00/4093/0x40c0b3] \n"
+        b"Trace 0: 0x7fffe8000100 [00000000/4094/0x40c0b3 \n"
+        b"Trace 0: 0x7fffe8000100 00000000/4095/0x40c0b3] \n"
+        b"Trace\t0:  0x7fffe8000100\t[00000000/4096/0x40c0b3]\n"
+        b"Trace 0: 0x7fffe8000100 [00000000/4097/0x] \n"
+        b"Trace 0: 0x17fffe8000100000 [00000000/4098/0x40c0b3] \n"
+    )
+    log = SAMPLE_LOG * 50 + odd
+    for contents in (SAMPLE_LOG, log, odd, b""):
+        assert_same_result(
+            TraceParser.parse(contents, vectorize=True),
+            TraceParser.parse(contents, vectorize=False),
+        )
+    assert TraceParser.parse(odd, vectorize=True).addrs.tolist() == [
+        0x4090,
+        0x4096,
+        0x4098,
+    ]
+
+
+def test_parse_records() -> None:
+    """
+    Test parsing only some kinds of records
+    """
+    full = TraceParser.parse(SAMPLE_LOG)
+    backends = [False]
+    if vectorized.available():
+        backends.append(True)
+
+    for vectorize in backends:
+        addrs = TraceParser.parse(SAMPLE_LOG, vectorize, records=Records.ADDRS)
+        assert addrs.addrs.tolist() == SAMPLE_ADDRS
+        assert not addrs.maps and not addrs.syscalls and addrs.entry is None
+
+        syscalls = TraceParser.parse(SAMPLE_LOG, vectorize, records=Records.SYSCALLS)
+        assert len(syscalls.addrs) == 0
+        assert syscalls.syscalls == full.syscalls
+        assert not syscalls.maps and syscalls.entry is None
+
+        others = TraceParser.parse(
+            SAMPLE_LOG, vectorize, records=Records.MAPS | Records.MAPPING
+        )
+        assert dict(others.maps) == dict(full.maps) and not others.syscalls
+        assert others.entry == full.entry
+
+        collector = TraceCollector(vectorize=vectorize, records=Records.SYSCALLS)
+        collector(SAMPLE_LOG[:1200])
+        collector(SAMPLE_LOG[1200:])
+        assert collector.close().syscalls == full.syscalls
+
+    tbs = TraceParser.parse(SAMPLE_LOG, records=Records.ALL)
+    assert_same_result(tbs, full)
+    assert not full.tbs
+    assert len(tbs.tbs) == len(set(SAMPLE_ADDRS))
+    assert tbs.tbs[0x555555554560] == {TranslationBlock(0x7FFFE8000640, 0, 0x40C0B3)}
+
+
+def test_parse_platform_typecode() -> None:
+    """
+    Test that addresses are stored at the size of the platform
+    """
+    log = b"Trace 0: 0x7fffe8000100 [00000000/00010074/0x40c0b3] \n" * 3
+
+    assert TraceParser.parse(log).addrs.itemsize == 8
+    assert TraceParser.parse(log, platform="arm").addrs.itemsize == 4
+    assert TraceParser.parse(log, platform="arm").addrs.tolist() == [0x10074] * 3
+
+    # Addresses too wide for the platform are not silently truncated
+    for vectorize in (False, True) if vectorized.available() else (False,):
+        with raises(OverflowError):
+            TraceParser.parse(SAMPLE_LOG, vectorize, platform="arm")
+
+
+def test_parse_compact() -> None:
+    """
+    Test that compact results hold the same addresses in less space
+    """
+    log = SAMPLE_LOG * 300
+    plain = TraceParser.parse(log)
+    compact = TraceParser.parse(log, compact=True)
+
+    assert compact.addrs.tolist() == plain.addrs.tolist()
+    assert compact.addrs[5] == plain.addrs[5]
+    assert compact.addrs[-3:] == plain.addrs[-3:]
+    assert len(compact.addrs.table) == len(set(SAMPLE_ADDRS))
+    assert compact.addrs.ids.itemsize == 1
+    assert dict(compact.maps) == dict(plain.maps)
+    assert compact.syscalls == plain.syscalls
+
+
+def test_interned_addrs_widen() -> None:
+    """
+    Test that block IDs widen as the number of unique blocks grows
+    """
+    addrs = InternedAddrs("Q", range(0x1000, 0x1000 + 300))
+    addrs.extend([0x1000, 0x1001])
+
+    assert addrs.ids.typecode == "H"
+    assert len(addrs) == 302
+    assert addrs[0] == addrs[300] == 0x1000
+    assert list(addrs)[-1] == 0x1001
+
+
+def test_save_load(tmp_path: Path) -> None:
+    """
+    Test that results round trip through the binary trace format
+    """
+    for tr in (
+        TraceParser.parse(SAMPLE_LOG),
+        TraceParser.parse(
+            b"Trace 0: 0x7fffe8000100 [00000000/00010074/0x40c0b3] \n" * 3,
+            platform="i386",
+        ),
+        TraceParser.parse(SAMPLE_LOG, compact=True),
+        TraceParser.parse(SAMPLE_LOG, records=Records.ALL),
+    ):
+        tf = tmp_path / "trace.pqt"
+        tr.save(tf)
+
+        for copy in (False, True):
+            loaded = TraceResult.load(tf, copy=copy)
+            assert_same_result(loaded, tr)
+            assert loaded.start_brk == tr.start_brk
+            assert loaded.mmap_min is None
+            assert loaded.tbs == tr.tbs
+
+        mapped = TraceResult.load(tf).addrs
+        if isinstance(tr.addrs, InternedAddrs):
+            assert isinstance(mapped, InternedAddrs)
+        else:
+            assert isinstance(mapped, memoryview)
+            assert mapped.itemsize == tr.addrs.itemsize
+
+    # Protections too long for a map record are rejected rather than truncated
+    tr = TraceParser.parse(SAMPLE_LOG, records=Records.ALL)
+    tr.maps[0].add(MMap(0x1000, 0x2000, 0x1000, "rwx--"))
+    with raises(ValueError, match="longer than"):
+        tr.save(BytesIO())
+
+
+@mark.parametrize(
+    "suffix,package", ((".gz", None), (".zst", "zstandard"), (".lz4", "lz4.frame"))
+)
+def test_parse_compressed(tmp_path: Path, suffix: str, package: str) -> None:
+    """
+    Test that compressed logs are parsed as they are decompressed
+    """
+    if package is not None:
+        importorskip(package)
+
+    writer = LogWriter(tmp_path / f"trace{suffix}")
+    for pos in range(0, len(SAMPLE_LOG) * 50, 777):
+        writer((SAMPLE_LOG * 50)[pos : pos + 777])
+    path = writer.close()
+    assert writer.size == len(SAMPLE_LOG) * 50
+    assert path.stat().st_size < writer.size
+    assert b"".join(read_log(path, 1000)) == SAMPLE_LOG * 50
+
+    for compact in (False, True):
+        assert_same_result(
+            TraceParser.parse(path, compact=compact),
+            TraceParser.parse(SAMPLE_LOG * 50, compact=compact),
+        )
+    assert TraceParser.coverage(path) == TraceParser.coverage(SAMPLE_LOG * 50)
+
+
+def test_parse_lazy(tmp_path: Path) -> None:
+    """
+    Test that lazily decoded records match the eagerly decoded ones
+    """
+    log = SAMPLE_LOG * 3
+    expected = TraceParser.parse(log)
+    tf = tmp_path / "log"
+    tf.write_bytes(log)
+
+    for vectorize in (False, True) if vectorized.available() else (False,):
+        for source in (log, memoryview(log), tf):
+            lazy = TraceParser.parse_lazy(source, vectorize=vectorize)
+            assert isinstance(lazy.syscalls, LazyRecords)
+            assert lazy.syscalls.decoded == 0
+            assert 2 in lazy.syscalls and 4 not in lazy.syscalls
+            assert lazy.syscalls[2] == expected.syscalls[2]
+            assert lazy.syscalls.decoded == 1
+            assert list(lazy.maps) == list(expected.maps)
+            assert_same_result(lazy, expected)
+
+    # Dumps logged after the same index are merged like when parsing eagerly
+    log = SAMPLE_LOG + SAMPLE_LOG[SAMPLE_LOG.index(b"start ") :]
+    assert TraceParser.parse_lazy(log).maps == TraceParser.parse(log).maps
+
+    tr = TraceParser.parse_lazy(tf)
+    tr.save(tmp_path / "trace.pqt")
+    assert_same_result(TraceResult.load(tmp_path / "trace.pqt"), expected)
+
+    writer = LogWriter(tmp_path / "log.gz")
+    writer(log)
+    with raises(ValueError, match="compressed"):
+        TraceParser.parse_lazy(writer.close())
+    with raises(ValueError, match="No syscall"):
+        decode_syscall_at(log, 0, len(log))
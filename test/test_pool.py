@@ -0,0 +1,135 @@
+"""
+Test tracing with warm fork servers, using a fake tracer that speaks the fork server
+protocol since the tracer binaries may not be built
+"""
+
+import sys
+from signal import SIGKILL, SIGSEGV
+from typing import List
+
+from pytest import MonkeyPatch, fixture, mark, raises
+
+from pyafl_qemu_trace import TracerPool, TraceRunner
+from pyafl_qemu_trace.run import ForkServer
+
+PREAMBLE = b"guest_base  0x0\n"
+
+# Says hello on FD 199 once started, then forks a guest for each request read from
+# FD 198 and reports its PID and exit status. The guest logs one block whose address
+# is the length of its input, echoes its input and exits with that length, unless it
+# is told to crash or hang. A fork server told to die exits instead of forking.
+FORK_SERVER = f"""
+import os, signal, struct, sys, time
+
+log = os.open(sys.argv[1], os.O_WRONLY)
+os.write(log, {PREAMBLE!r})
+os.write(199, struct.pack("=I", 0))
+while len(os.read(198, 4)) == 4:
+    if os.pread(0, 4, 0) == b"die":
+        sys.exit(3)
+    pid = os.fork()
+    if not pid:
+        data = os.read(0, 1 << 16)
+        os.write(log, b"Trace 0: 0x1 [00000000/%016x/0x0] \\n" % len(data))
+        os.write(1, b"out:" + data)
+        if data == b"crash":
+            os.kill(os.getpid(), signal.SIGSEGV)
+        if data == b"hang":
+            time.sleep(60)
+        os._exit(len(data))
+    os.write(199, struct.pack("=I", pid))
+    os.write(199, struct.pack("=I", os.waitpid(pid, 0)[1]))
+"""
+
+
+def block(length: int) -> bytes:
+    """
+    The log line the fake guest writes for an input of `length` bytes
+    """
+    return b"Trace 0: 0x1 [00000000/%016x/0x0] \n" % length
+
+
+@fixture(name="fork_server")
+def fixture_fork_server(monkeypatch: MonkeyPatch) -> None:
+    """
+    Trace with the fake fork server
+    """
+    monkeypatch.setattr(
+        TraceRunner,
+        "command",
+        classmethod(
+            lambda cls, platform, binary, log, *args: [
+                sys.executable,
+                "-c",
+                FORK_SERVER,
+                log,
+            ]
+        ),
+    )
+
+
+@mark.usefixtures("fork_server")
+def test_fork_server() -> None:
+    """
+    Test that a fork server traces one input after another in forked guests,
+    through crashes and timeouts
+    """
+    with ForkServer("x86_64", "binary") as server:
+        assert server.preamble == PREAMBLE
+
+        assert server.run(b"abc") == (3, b"out:abc", b"", PREAMBLE + block(3))
+        assert server.run({"stdin": b"x"}) == (1, b"out:x", b"", PREAMBLE + block(1))
+
+        returncode, stdout, _, log = server.run(b"crash")
+        assert returncode == -SIGSEGV and stdout == b"out:crash"
+        assert log == PREAMBLE + block(5)
+
+        returncode, stdout, _, log = server.run(b"hang", timeout=0.5)
+        assert returncode == -1 and stdout == b"out:hang"
+        assert log == PREAMBLE + block(4)
+
+        chunks: List[bytes] = []
+        assert server.run(b"", log_sink=chunks.append) == (0, b"out:", b"", b"")
+        assert b"".join(chunks) == PREAMBLE + block(0)
+        assert server.executions == 5
+
+
+@mark.usefixtures("fork_server")
+def test_pool_trace() -> None:
+    """
+    Test that a pool parses the log of each input and marks timeouts as truncated
+    """
+    with TracerPool(1) as pool:
+        returncode, stdout, _, result = pool.trace(
+            "x86_64", "binary", input_data=b"abc"
+        )
+        assert (returncode, stdout, result.truncated) == (3, b"out:abc", False)
+        assert result.addrs.tolist() == [3]
+
+        returncode, _, _, result = pool.trace(
+            "x86_64", "binary", input_data=b"hang", timeout=0.5
+        )
+        assert returncode == -SIGKILL and result.truncated
+        assert result.addrs.tolist() == [4]
+
+
+@mark.usefixtures("fork_server")
+def test_pool_restart() -> None:
+    """
+    Test that a pool reuses its fork servers and replaces one that dies
+    """
+    with TracerPool(1) as pool:
+        assert pool.run("x86_64", "binary", input_data=b"ab")[0] == 2
+        assert pool.run("x86_64", "binary", input_data=b"abc")[0] == 3
+        assert pool.executions == 2
+
+        with raises(RuntimeError, match="instead of forking"):
+            pool.run("x86_64", "binary", input_data=b"die")
+
+        assert pool.run("x86_64", "binary", input_data=b"a") == (
+            1,
+            b"out:a",
+            b"",
+            PREAMBLE + block(1),
+        )
+        assert pool.executions == 3
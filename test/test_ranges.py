@@ -0,0 +1,65 @@
+"""
+Test looking up the ranges containing addresses
+"""
+
+from array import array
+from random import Random
+
+from pytest import raises
+
+from pyafl_qemu_trace.parse import InternedAddrs, RangeMap
+
+
+def test_range_map(vectorize: bool) -> None:
+    """
+    Test that looking up many addresses at once matches looking up each one
+    """
+    rng = Random(0)
+    bounds = sorted(rng.sample(range(0x1000, 0x100000, 16), 2000))
+    ranges = [(start, end, hex(start)) for start, end in zip(bounds[::2], bounds[1::2])]
+    rng.shuffle(ranges)
+    rmap = RangeMap.from_ranges(ranges)
+    assert len(rmap) == 1000 and list(rmap) == sorted(ranges)
+
+    addrs = [rng.randrange(0x100010) for _ in range(5000)] + [0, bounds[0], bounds[1]]
+    expected = array("q", map(rmap.index, addrs))
+    assert rmap.lookup_many(array("Q", addrs), vectorize) == expected
+    assert rmap.lookup_many(InternedAddrs("Q", addrs), vectorize) == expected
+    assert rmap.lookup_many(addrs[:0], vectorize) == array("q")
+
+    assert rmap[bounds[0]] == hex(bounds[0]) and bounds[0] in rmap
+    assert bounds[1] not in rmap and rmap.get(bounds[1]) is None
+    with raises(KeyError):
+        rmap[0]  # pylint: disable=pointless-statement
+
+
+def test_range_map_overlaps() -> None:
+    """
+    Test that overlapping ranges are rejected or left out
+    """
+    ranges = [(0x20, 0x30, "b"), (0x10, 0x20, "a"), (0x18, 0x28, "c")]
+    with raises(ValueError):
+        RangeMap.from_ranges(ranges)
+    with raises(ValueError):
+        RangeMap([0x20, 0x10], [0x30, 0x20], ["b", "a"])
+    assert list(RangeMap.from_ranges(ranges, strict=False)) == [
+        (0x10, 0x20, "a"),
+        (0x20, 0x30, "b"),
+    ]
+    assert RangeMap([], [], []).lookup_many([0x10]) == array("q", [-1])
+
+
+def test_range_map_visits(vectorize: bool) -> None:
+    """
+    Test that consecutive addresses in one range count as one visit of it, unless
+    they re-enter it at its start
+    """
+    rmap = RangeMap([0x10, 0x20, 0x40], [0x20, 0x30, 0x50], "abc")
+    addrs = [0x10, 0x14, 0x18, 0x10, 0x14, 0x20, 0x34, 0x24, 0x40, 0x44, 0x48, 0x10]
+    for trace in (addrs, array("Q", addrs), InternedAddrs("Q", addrs)):
+        assert rmap.visits(trace, vectorize=vectorize) == array("q", [0, 0, 1, 2, 0])
+        assert rmap.visits(trace, False, vectorize) == array(
+            "q", [0, 0, 0, 0, 0, 1, 1, 2, 2, 2, 0]
+        )
+    assert rmap.visits([], vectorize=vectorize) == array("q")
+    assert rmap.visits([0x34], vectorize=vectorize) == array("q")
@@ -2,6 +2,7 @@
 Test running afl-qemu-trace on an x86_64 binary
 """
 
+from asyncio import gather, run
 from pathlib import Path
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from signal import SIGTERM
@@ -10,10 +11,12 @@ from psutil import Process, NoSuchProcess
 from os import getpid
 from tempfile import NamedTemporaryFile
 
-from angr import Project
-
 from pyafl_qemu_trace import TraceRunner
 from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace import TracerPool
+from pyafl_qemu_trace import BatchTracer
+from pyafl_qemu_trace.run import CoverageSink, LogBuffer, LogFile, TraceDirSink
+from pyafl_qemu_trace.parse import MapIndex, TraceCollector
 from pyafl_qemu_trace.parse.parse import TraceResult
 
 TEST_BINS_DIR = Path(__file__).with_name("binaries")
@@ -80,6 +83,69 @@ def test_parse_x86_64() -> None:
     assert len(tr.addrs) > 125000
 
 
+def test_parse_view_x86_64() -> None:
+    """
+    Test running and parsing a log returned as a memoryview
+    """
+    xxd = str(TEST_BINS_DIR / "xxd")
+
+    buf = LogBuffer()
+    TraceRunner.run(
+        "x86_64",
+        xxd,
+        cwd="/tmp",
+        input_data=b"\x41" * 400,
+        timeout=30,
+        log_sink=buf,
+    )
+    log = buf.getvalue(view=True)
+    assert isinstance(log, memoryview)
+    tr = TraceParser.parse(log)
+    assert len(tr.addrs) > 125000
+
+
+def test_parse_compressed_x86_64(tmp_path: Path) -> None:
+    """
+    Test running with the log compressed to a file and parsing it from there
+    """
+    xxd = str(TEST_BINS_DIR / "xxd")
+
+    res = TraceRunner.run(
+        "x86_64",
+        xxd,
+        cwd="/tmp",
+        input_data=b"\x41" * 400,
+        timeout=30,
+        log_sink=LogFile(tmp_path / "xxd.log.gz"),
+    )
+    assert res[3] == tmp_path / "xxd.log.gz"
+    assert res[3].stat().st_size < 8000000
+    tr = TraceParser.parse(res[3])
+    assert len(tr.addrs) > 125000
+
+
+def test_parse_log_to_file_x86_64() -> None:
+    """
+    Test running with the tracer writing the log to a file and parsing it mapped
+    """
+    xxd = str(TEST_BINS_DIR / "xxd")
+
+    res = TraceRunner.run(
+        "x86_64",
+        xxd,
+        cwd="/tmp",
+        input_data=b"\x41" * 400,
+        timeout=30,
+        log_sink=LogFile(),
+    )
+    try:
+        assert res[3].stat().st_size > 8000000
+        tr = TraceParser.parse(res[3])
+        assert len(tr.addrs) > 125000
+    finally:
+        res[3].unlink()
+
+
 def test_parse_real_x86_64() -> None:
     """
     Test running and parsing on a larger x86_64 binary
@@ -181,23 +247,14 @@ def test_parse_multi_parallel_real_x86_64() -> None:
         kill_children()
         print("Done.")
 
-    p = Project(str(flight_routes), auto_load_libs=False)
-    addr_range = (
-        p.loader.main_object.min_addr,
-        p.loader.main_object.max_addr,
-    )
-
     for res in results:
         # Check the number of addresses in the trace that are actually in the address space
         # we expect for the binary -- a failure here could make it difficult to convert the trace
         # into another representation or explore it as a graph.
-        count_in = 0
-        count_out = 0
-        for addr in res.addrs:
-            if addr_range[0] <= addr <= addr_range[1]:
-                count_in += 1
-            else:
-                count_out += 1
+        index = MapIndex.from_result(res)
+        counts = index.counts(res.addrs)
+        count_in = sum(counts.pop(main, 0) for main in index.containing(res.start_code))
+        count_out = sum(counts.values())
 
         print(f"{count_in} addresses in, {count_out} addresses out of {len(res.addrs)}")
 
@@ -268,3 +325,110 @@ def test_run_x86_64_export() -> None:
 
     assert tfp.is_file() and tfp.stat().st_size > 0
     print(tf.name)
+
+
+def test_pool_x86_64() -> None:
+    """
+    Test tracing several inputs with warm fork servers
+    """
+    flight_routes = TEST_BINS_DIR / "Flight_Routes" / "Flight_Routes"
+    infiles = list(TEST_INPUT_DIR.iterdir())[:8]
+
+    with TracerPool(size=2) as pool:
+        with ThreadPoolExecutor(4) as executor:
+            results = list(
+                executor.map(
+                    lambda infile: pool.run(
+                        "x86_64",
+                        str(flight_routes),
+                        cwd=str(flight_routes.parent),
+                        input_data=infile.read_bytes(),
+                        timeout=30,
+                        ld_library_paths=[str(TEST_BINS_DIR / "Flight_Routes")],
+                    ),
+                    infiles,
+                )
+            )
+
+        assert pool.executions == len(infiles)
+        print(f"{pool.execs_per_sec:.1f} execs/s")
+
+    for infile, (retcode, _, _, log) in zip(infiles, results):
+        expected = TraceRunner.run(
+            "x86_64",
+            str(flight_routes),
+            cwd=str(flight_routes.parent),
+            input_data=infile.read_bytes(),
+            timeout=30,
+            ld_library_paths=[str(TEST_BINS_DIR / "Flight_Routes")],
+        )
+        assert retcode == expected[0]
+        assert len(TraceParser.parse(log).addrs) == len(
+            TraceParser.parse(expected[3]).addrs
+        )
+
+
+def test_batch_x86_64(tmp_path: Path) -> None:
+    """
+    Test tracing a corpus in a batch, resuming it and collecting its coverage
+    """
+    flight_routes = TEST_BINS_DIR / "Flight_Routes" / "Flight_Routes"
+    infiles = sorted(TEST_INPUT_DIR.iterdir())[:16]
+    batch = BatchTracer(
+        "x86_64",
+        str(flight_routes),
+        cwd=str(flight_routes.parent),
+        timeout=30,
+        ld_library_paths=[str(TEST_BINS_DIR / "Flight_Routes")],
+        tracers=4,
+        reducers=2,
+        journal=tmp_path / "journal",
+    )
+
+    sink = TraceDirSink(tmp_path / "traces")
+    stats = batch.run(infiles[:10], sink)
+    assert stats.done == 10 and not stats.failed
+    print(f"{stats.inputs_per_sec:.1f} inputs/s")
+
+    stats = batch.run(infiles, sink)
+    assert stats.done == 6 and stats.skipped == 10
+    for infile in infiles:
+        saved = TraceResult.load(tmp_path / "traces" / f"{infile.name}.pqt")
+        assert len(saved.addrs) > 0
+
+    coverage = CoverageSink()
+    stats = BatchTracer(
+        "x86_64",
+        str(flight_routes),
+        cwd=str(flight_routes.parent),
+        timeout=30,
+        ld_library_paths=[str(TEST_BINS_DIR / "Flight_Routes")],
+    ).run(infiles, coverage)
+    assert stats.done == len(infiles)
+    assert coverage.interesting and coverage.coverage.edges > 0
+
+
+def test_arun_x86_64_concurrent() -> None:
+    """
+    Test running many traces at once on one event loop, parsing them as they run
+    """
+    xxd = str(TEST_BINS_DIR / "xxd")
+
+    async def trace(a: bytes) -> TraceResult:
+        collector = TraceCollector()
+        retcode, _, _, log = await TraceRunner.arun(
+            "x86_64",
+            xxd,
+            input_data=a * 400,
+            ld_library_paths=["/lib64", "/lib"],
+            timeout=30,
+            log_sink=collector,
+        )
+        assert retcode == 0 and not log
+        return collector.close()
+
+    async def main() -> List[TraceResult]:
+        return await gather(*(trace(bytes([a])) for a in range(0x41, 0x61)))
+
+    for tr in run(main()):
+        assert len(tr.addrs) > 125000
@@ -0,0 +1,84 @@
+"""
+Test storing the syscalls of a trace as columns
+"""
+
+from pathlib import Path
+
+from pytest import raises
+
+from pyafl_qemu_trace import TraceParser
+from pyafl_qemu_trace.parse import SyscallTable
+from pyafl_qemu_trace.parse.parse import Syscall, TraceResult
+
+from test.test_parse import SAMPLE_LOG, assert_same_result
+
+
+def test_syscall_table(vectorize: bool) -> None:
+    """
+    Test that a parsed table holds the same syscalls as the dict of `Syscall`
+    """
+    log = SAMPLE_LOG * 3
+    expected = TraceParser.parse(log)
+    res = TraceParser.parse(log, vectorize=vectorize, syscall_table=True)
+    table = res.syscalls
+    assert isinstance(table, SyscallTable)
+    assert_same_result(res, expected)
+    assert list(table) == list(expected.syscalls)
+    assert 2 in table and 4 not in table
+    with raises(KeyError):
+        table[4]  # pylint: disable=pointless-statement
+
+    # The exit of the last copy of the log never returns
+    assert table.histogram() == {
+        "brk": 3,
+        "openat": 3,
+        "mmap": 3,
+        "write": 3,
+        "exit_group": 2,
+    }
+    failed = table.where("openat", failed=True, vectorize=vectorize)
+    assert [table.indices[row] for row in failed] == [2, 9, 16]
+    assert list(table.where(failed=False, vectorize=vectorize)) == [
+        row for row in range(14) if row % 5 != 1
+    ]
+    assert not table.where("read", vectorize=vectorize)
+
+    assert table.to_syscalls() == expected.syscalls
+    assert SyscallTable.from_syscalls(expected.syscalls) == table
+
+
+def test_syscall_table_sources(tmp_path: Path) -> None:
+    """
+    Test that every way of parsing a log can store the syscalls in a table
+    """
+    log = SAMPLE_LOG * 50
+    expected = TraceParser.parse(log)
+    tf = tmp_path / "log"
+    tf.write_bytes(log)
+
+    for res in (
+        TraceParser.parse(tf, syscall_table=True),
+        TraceParser.parse(tf, compact=True, syscall_table=True),
+        TraceParser.parse_parallel(tf, 2, syscall_table=True),
+    ):
+        assert isinstance(res.syscalls, SyscallTable)
+        assert_same_result(res, expected)
+
+    res.save(tmp_path / "trace.pqt")
+    assert_same_result(TraceResult.load(tmp_path / "trace.pqt"), expected)
+
+
+def test_syscall_table_order() -> None:
+    """
+    Test that syscalls logged after the same index replace each other
+    """
+    table = SyscallTable()
+    table.add(1, b"read", 3, b"0,0x1000,3")
+    table.add(1, b"close", -9, b"5", 9, b"Bad file descriptor")
+    table.add(2, b"read", 0, b"")
+    assert dict(table) == {
+        1: Syscall("close", -9, ["5"], 9, "Bad file descriptor"),
+        2: Syscall("read", 0, [""]),
+    }
+    with raises(ValueError):
+        table.add(0, b"read", 0, b"")
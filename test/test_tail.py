@@ -0,0 +1,76 @@
+"""
+Test keeping only the end of a trace
+"""
+
+from pathlib import Path
+from signal import SIGKILL
+
+from pytest import MonkeyPatch, mark, raises
+
+from pyafl_qemu_trace import TraceParser, TraceRunner
+from pyafl_qemu_trace.parse import TailCollector
+
+from test.test_budget import endless_command
+from test.test_parse import SAMPLE_ADDRS, SAMPLE_LOG
+
+
+@mark.parametrize("length", [1, 5, 7, 30, 1000])
+def test_tail(length: int, vectorize: bool) -> None:
+    """
+    Test that the tail holds the end of the full trace, however the log is split
+    """
+    log = SAMPLE_LOG * 10
+    full = TraceParser.parse(log)
+    start = max(len(full.addrs) - length, 0)
+
+    for size in (13, 500, len(log)):
+        collector = TailCollector(length, syscalls=3, maps=2, vectorize=vectorize)
+        for pos in range(0, len(log), size):
+            collector(log[pos : pos + size])
+        tail = collector.close()
+
+        assert tail.blocks == len(full.addrs) and tail.start == start
+        assert tail.result.addrs.tolist() == full.addrs.tolist()[start:]
+        assert tail.result.entry == full.entry
+        recent = sorted(full.syscalls)[-3:]
+        assert tail.result.syscalls == {
+            index - start: full.syscalls[index]
+            for index in recent
+            if index >= start - 1
+        }
+        kept = sorted(full.maps)[-2:]
+        maps = {index - start: full.maps[index] for index in kept if index >= start - 1}
+        earlier = [index for index in kept if index < start - 1]
+        if earlier and -1 not in maps:
+            maps[-1] = full.maps[earlier[-1]]
+        assert dict(tail.result.maps) == maps
+
+
+def test_tail_file(tmp_path: Path) -> None:
+    """
+    Test keeping the end of a log file
+    """
+    path = tmp_path / "trace.log"
+    path.write_bytes(SAMPLE_LOG * 3)
+    tail = TraceParser.tail(path, length=10)
+    assert tail.blocks == len(SAMPLE_ADDRS) * 3
+    assert tail.result.addrs.tolist() == (SAMPLE_ADDRS * 3)[-10:]
+    assert sorted(tail.result.syscalls) == [-1, 1, 2, 4, 5, 6, 8]
+    assert sorted(tail.result.maps) == [-1, 2, 6]
+
+    with raises(TypeError, match="bytes-like object or a Path"):
+        TraceParser.tail(str(path))
+
+
+def test_tail_runaway(monkeypatch: MonkeyPatch) -> None:
+    """
+    Test keeping the end of a trace that never ends
+    """
+    endless_command(monkeypatch)
+    returncode, _, _, tail = TraceRunner.tail(
+        "x86_64", "binary", timeout=1, length=100, syscalls=10
+    )
+    assert returncode == -SIGKILL and tail.result.truncated
+    assert tail.blocks > 100 and len(tail.result.addrs) == 100
+    assert set(tail.result.addrs) <= set(SAMPLE_ADDRS)
+    assert 0 < len(tail.result.syscalls) <= 10
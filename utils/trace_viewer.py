@@ -1,12 +1,20 @@
-from collections import defaultdict
+from array import array
+from bisect import bisect_left
 from dataclasses import dataclass, field
 from math import sqrt
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 from json import load
+from mmap import ACCESS_READ, mmap
+from struct import Struct
 
 from colour import Color
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from binaryninja.plugin import PluginCommand
 from binaryninja.binaryview import BinaryView
 from binaryninja.interaction import get_open_filename_input, get_directory_name_input
@@ -14,124 +22,7 @@ from binaryninja.highlight import HighlightColor
 from binaryninja.basicblock import BasicBlock
 from binaryninjaui import View, ViewType
 
-"""
-RangeMap implementation for fast lookups of ranges of values.
-"""
-
-from bisect import bisect_left
-from typing import Any, Generator, Optional, Tuple, Union
-
-
-class RangeMapNotFound:
-    """
-    A sentinel value indicating that no value was found.
-    """
-
-    ...
-
-
-T = TypeVar("T")
-V = TypeVar("V")
-
-
-class RangeMap(Dict[T, V]):
-    """Map ranges to values
-
-    Lookups are done in O(logN) time. There are no limits set on the upper or
-    lower bounds of the ranges, but ranges must not overlap.
-
-    """
-
-    def __init__(self, _map: Optional[Dict[T, V]] = None):
-        """
-        Initialize the rangemap, optionally with an existing mapping.
-
-        :param _map: Optional mapping to initialize the rangemap with.
-        """
-
-        self._upper: List[T] = []
-        self._lower: List[T] = []
-        self._values: List[V] = []
-        if _map is not None:
-            raise NotImplementedError(
-                "Initializing with an existing mapping is not supported."
-            )
-
-    def __len__(self) -> int:
-        """
-        Return the number of values stored in the mapping.
-        """
-        return len(self._values)
-
-    def __getitem__(
-        self, point_or_range: Union[Tuple[T, T], T]
-    ) -> Union[V, Type[RangeMapNotFound]]:
-        """
-        Retrieve a value by a single point or a specific range.
-
-        :param point_or_range: The value or value range to look up.
-        """
-        if isinstance(point_or_range, tuple):
-            low, high = point_or_range
-            i = bisect_left(self._upper, high)
-            point = low
-        else:
-            point = point_or_range
-            i = bisect_left(self._upper, point)
-        if i >= len(self._values) or self._lower[i] > point:
-            return RangeMapNotFound
-        return self._values[i]
-
-    def __setitem__(self, r: Tuple[T, T], value: V) -> None:
-        """
-        Set a value by a single point or a specific range.
-
-        :param r: The range for this value.
-        :param value: The value.
-        """
-        lower, upper = r
-        i = bisect_left(self._upper, upper)
-        if i < len(self._values) and self._lower[i] < upper:
-            raise IndexError(f"No overlaps permitted: {lower}-{upper}")
-        self._upper.insert(i, upper)
-        self._lower.insert(i, lower)
-        self._values.insert(i, value)
-
-    def __delitem__(self, r: Tuple[T, T]) -> None:
-        """
-        Delete a range and its value from the mapping.
-        """
-        lower, upper = r
-        i = bisect_left(self._upper, upper)
-        if self._upper[i] != upper or self._lower[i] != lower:
-            raise IndexError(f"Range not in map: {lower}-{upper}")
-        del self._upper[i]
-        del self._lower[i]
-        del self._values[i]
-
-    def __iter__(self) -> Generator[Tuple[T, T], None, None]:
-        """
-        Create an iterator over this rangemap.
-        """
-        yield from zip(self._lower, self._upper)
-
-    def __contains__(self, point_or_range: Union[Tuple[T, T], V]) -> bool:
-        """
-        Check if a point or range is in the mapping.
-
-        :param point_or_range: The point or range to check.
-        """
-        if isinstance(point_or_range, tuple):
-            low, high = point_or_range
-            i = bisect_left(self._upper, high)
-            point = low
-        else:
-            point = point_or_range
-            i = bisect_left(self._upper, point)
-        if i >= len(self._values) or self._lower[i] > point:
-            return False
-
-        return True
+from pyafl_qemu_trace.parse.ranges import RangeMap
 
 
 @dataclass
@@ -156,6 +47,43 @@ class AngrManagementTrace:
             return AngrManagementTrace(**load(f))
 
 
+# Binary trace format written by `TraceResult.save` (see pyafl_qemu_trace.parse.store),
+# read here directly
+PQTRACE_MAGIC = b"PQTRACE\0"
+PQTRACE_HEADER = Struct("<8sHHI13QI")
+PQTRACE_SECTION = Struct("<HHIQQ")
+PQTRACE_ADDRS, PQTRACE_TABLE, PQTRACE_IDS = 1, 2, 3
+PQTRACE_TYPECODES = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+def load_pqtrace_addrs(file: Path) -> Sequence[int]:
+    """
+    Load the addresses of a binary trace file as a memory mapped view, or as an
+    array if they were stored as IDs into a table of unique addresses
+    """
+    with file.open("rb") as f:
+        buf = memoryview(mmap(f.fileno(), 0, access=ACCESS_READ))
+
+    *_, count = PQTRACE_HEADER.unpack_from(buf)
+    sections = {}
+    for i in range(count):
+        kind, itemsize, _, offset, length = PQTRACE_SECTION.unpack_from(
+            buf, PQTRACE_HEADER.size + i * PQTRACE_SECTION.size
+        )
+        if kind in (PQTRACE_ADDRS, PQTRACE_TABLE, PQTRACE_IDS):
+            sections[kind] = buf[offset : offset + length].cast(
+                PQTRACE_TYPECODES[itemsize]
+            )
+
+    if PQTRACE_ADDRS in sections:
+        return sections[PQTRACE_ADDRS]
+
+    table = sections[PQTRACE_TABLE]
+    if np is not None:
+        return np.asarray(table)[np.asarray(sections[PQTRACE_IDS])]
+    return array(table.format, map(table.__getitem__, sections[PQTRACE_IDS]))
+
+
 @dataclass
 class QemuTrace:
     """
@@ -173,8 +101,13 @@ class QemuTrace:
     @classmethod
     def from_file(cls, file: Path) -> "QemuTrace":
         """
-        Load an angrmanagement trace from a file
+        Load a trace exported with `TraceResult.export` or saved with
+        `TraceResult.save` from a file
         """
+        with file.open("rb") as f:
+            if f.read(len(PQTRACE_MAGIC)) == PQTRACE_MAGIC:
+                return QemuTrace(load_pqtrace_addrs(file))
+
         with file.open("r") as f:
             return QemuTrace(**load(f))
 
@@ -231,10 +164,14 @@ class TraceViewer:
         """
         Initialize Trace Viewer
         """
-        self.traces: List[
-            AngrManagementTrace
-        ] = []  # List of raw traces we have imported
-        self.coverage: Dict[int, int] = defaultdict(int)  # Coverage of traces
+        self.traces: List[str] = []  # IDs of the traces we have imported
+        # Basic blocks of the binary sorted by address
+        self.blocks: List[BasicBlock] = []
+        # Number of executions of each block over all traces
+        self.counts: Sequence[int] = []
+        # Count and highlight each block was last drawn with, which are new objects
+        # whenever the colors are computed again
+        self.drawn: Dict[int, Tuple[int, HighlightColor]] = {}
         self.colors: List[Tuple[int, HighlightColor]] = []
         self.bv = Optional[BinaryView]
 
@@ -270,33 +207,65 @@ class TraceViewer:
         """
         if self.lookup is None:
             print("initializing map...")
-            self.lookup = RangeMap()
-            for func in self.bv.functions:
-                for bbl in func.basic_blocks:
-                    try:
-                        self.lookup[(bbl.start, bbl.end)] = bbl
-                    except Exception as e:
-                        print(e)
+            # Blocks shared by several functions are only counted once
+            unique = {
+                (bbl.start, bbl.end): bbl
+                for func in self.bv.functions
+                for bbl in func.basic_blocks
+            }
+            self.lookup = RangeMap.from_ranges(
+                ((bbl.start, bbl.end, bbl) for bbl in unique.values()), strict=False
+            )
+            if len(self.lookup) < len(unique):
+                print(f"skipped {len(unique) - len(self.lookup)} overlapping blocks")
+
+            self.blocks = self.lookup.values
+            if np is not None:
+                self.counts = np.zeros(len(self.blocks), dtype=np.int64)
+            else:
+                self.counts = [0] * len(self.blocks)
+            self.drawn.clear()
             print("done...")
 
-    def compute_coverage(self) -> None:
+    def block_ids(self, addrs: Sequence[int], collapse: bool = False) -> Sequence[int]:
+        """
+        Find the basic blocks containing a sequence of addresses, all at once
+
+        :param addrs: The addresses
+        :param collapse: Whether consecutive addresses in the same block count as one
+            execution of it, unless the later one re-enters the block at its start
+        :return: The index in `blocks` of the block of each address, leaving out
+            addresses that are not in any block
         """
-        (re)-compute coverage of the traces
+        return self.lookup.visits(addrs, collapse)
+
+    def compute_coverage(self, ids: Sequence[int]) -> None:
         """
-        self.coverage.clear()
+        Add the executions of the blocks of a trace to the coverage
+
+        :param ids: The index in `blocks` of each block the trace executed
+        """
+        if np is not None:
+            self.counts += np.bincount(
+                np.asarray(ids, dtype=np.int64), minlength=len(self.blocks)
+            )
+            return
 
-        for trace in self.traces:
-            for bbl in trace.bb_addrs:
-                self.coverage[bbl] += 1
+        for ident in ids:
+            self.counts[ident] += 1
 
     def compute_colorage(self) -> None:
         """
         (re)-compute coloring of the traces
         """
-        if len(self.coverage) == 0:
+        mx = (
+            int(self.counts.max(initial=0))
+            if np is not None
+            else max(self.counts, default=0)
+        )
+        if mx == 0:
             return
 
-        mx = max(self.coverage.values())
         steps = [mx]
         while steps[-1] > 2:
             steps += [int(sqrt(steps[-1]))]
@@ -320,34 +289,56 @@ class TraceViewer:
 
     def recolor_graph(self) -> None:
         """
-        Recolor the graph
-        """
-        for addr, val in self.coverage.items():
-            for func in self.bv.get_functions_containing(addr):
-                for bbl in func.basic_blocks:
-                    if bbl.start <= addr <= bbl.end:
-                        self.bv.set_comment_at(
-                            bbl.start, f"Trace Coverage: {val} executions."
-                        )
-                        for i, c in enumerate(self.colors):
-                            cv = c[0]
-                            if val <= cv:
-                                bbl.set_user_highlight(self.colors[max(0, i - 1)][1])
-                                break
-                        break
-                break
-
-    def add_trace(self, trace: AngrManagementTrace) -> None:
+        Recolor the graph in one pass over the covered blocks, only touching blocks
+        whose count or color changed since they were last drawn
+        """
+        if not self.colors:
+            return
+
+        steps = [val for val, _ in self.colors]
+        if np is not None:
+            covered = np.flatnonzero(self.counts).tolist()
+            counts = self.counts[covered].tolist()
+        else:
+            covered = [i for i, val in enumerate(self.counts) if val]
+            counts = [self.counts[i] for i in covered]
+
+        for ident, val in zip(covered, counts):
+            highlight = self.colors[max(0, bisect_left(steps, val) - 1)][1]
+            drawn = self.drawn.get(ident)
+            if drawn is not None and drawn[0] == val and drawn[1] is highlight:
+                continue
+            bbl = self.blocks[ident]
+            if drawn is None or drawn[0] != val:
+                self.bv.set_comment_at(bbl.start, f"Trace Coverage: {val} executions.")
+            bbl.set_user_highlight(highlight)
+            self.drawn[ident] = (val, highlight)
+
+    def add_trace(
+        self, trace: AngrManagementTrace, ids: Sequence[int], redraw: bool = True
+    ) -> None:
         """
         Add a trace to the trace viewer
+
+        :param trace: The trace
+        :param ids: The index in `blocks` of each block the trace executed
+        :param redraw: Whether to recolor the graph, which can be left until the
+            last of several traces is added
         """
-        self.traces.append(trace)
+        self.traces.append(trace.id)
 
-        self.compute_coverage()
+        self.compute_coverage(ids)
+        if redraw:
+            self.redraw()
+
+    def redraw(self) -> None:
+        """
+        Recolor the graph for the coverage of every trace added so far
+        """
         self.compute_colorage()
         self.recolor_graph()
 
-    def add_file(self, tracefile: Path) -> None:
+    def add_file(self, tracefile: Path, redraw: bool = True) -> None:
         """
         Add a trace file to the trace viewer
         """
@@ -366,7 +357,7 @@ class TraceViewer:
 
         trace = AngrManagementTrace.from_file(tracefile)
 
-        self.add_trace(trace)
+        self.add_trace(trace, self.block_ids(trace.bb_addrs), redraw)
 
     def add(self, bv: BinaryView) -> None:
         """
@@ -389,9 +380,10 @@ class TraceViewer:
             return
 
         for tracefile in tracedir.glob("*.json"):
-            self.add_file(tracefile)
+            self.add_file(tracefile, redraw=False)
+        self.redraw()
 
-    def add_file_qemu(self, tracefile: Path) -> None:
+    def add_file_qemu(self, tracefile: Path, redraw: bool = True) -> None:
         """
         Add a trace file to the trace viewer
         """
@@ -400,27 +392,13 @@ class TraceViewer:
 
         qtrace = QemuTrace.from_file(tracefile)
 
-        bbtrace = []
-
-        for addr in qtrace.addrs:
-            # Don't add if we're in the last block (unless we are the first instr, bc then we may
-            # have a self loop which we want to add)
-            if not bbtrace or (
-                addr < bbtrace[-1].start
-                or bbtrace[-1].start < addr <= bbtrace[-1].end
-                or bbtrace[-1].end < addr
-            ):
-                try:
-                    bbl = self.lookup[addr]
-                    if bbl is not RangeMapNotFound:
-                        bbtrace.append(bbl)
-                except Exception as e:
-                    print(e)
-
-        bb_addrs = map(lambda b: b.start, bbtrace)
+        # Translation blocks are smaller than basic blocks, so don't count a block
+        # again while we're in it (unless we are back at its start, bc then we may
+        # have a self loop which we want to count)
+        ids = self.block_ids(qtrace.addrs, collapse=True)
 
         amt = AngrManagementTrace(
-            bb_addrs=bb_addrs,
+            bb_addrs=[],
             syscalls=[],
             id=tracefile.name,
             created_at="NOW",
@@ -428,7 +406,7 @@ class TraceViewer:
             complete=True,
         )
 
-        self.add_trace(amt)
+        self.add_trace(amt, ids, redraw)
 
     def add_file_reface(self, dbfile: Path) -> None:
         """
@@ -446,7 +424,7 @@ class TraceViewer:
             comparison = int(sp_dat[0])
             branches = {int(k): v for k, v in sp_dat[1].items()}
             cmp_bb = self.lookup.get(comparison)
-            if cmp_bb is RangeMapNotFound:
+            if cmp_bb is None:
                 print("Couldn't find ", hex(comparison))
                 continue
             cast(
@@ -457,7 +435,7 @@ class TraceViewer:
             cmp_bb.set_user_highlight(source_hl)
             for target_addr, target_times in branches.items():
                 target_bb = self.lookup.get(target_addr)
-                if target_bb is RangeMapNotFound:
+                if target_bb is None:
                     continue
                 self.bv.set_comment_at(
                     target_addr, f"STUCK POINT {i} TARGET ({target_times} TIMES)"
@@ -471,7 +449,9 @@ class TraceViewer:
         """
         self.bv = bv
         self.check_map()
-        tracefile = Path(get_open_filename_input("trace file:", "*.json")).resolve()
+        tracefile = Path(
+            get_open_filename_input("trace file:", "*.json *.pqt")
+        ).resolve()
         self.add_file_qemu(tracefile)
 
     def add_multiple_qemu(self, bv: BinaryView) -> None:
@@ -485,9 +465,10 @@ class TraceViewer:
         if not tracedir.is_dir():
             return
 
-        for tracefile in tracedir.glob("*.json"):
+        for tracefile in (*tracedir.glob("*.json"), *tracedir.glob("*.pqt")):
             print(f"Adding {tracefile}")
-            self.add_file_qemu(tracefile)
+            self.add_file_qemu(tracefile, redraw=False)
+        self.redraw()
 
     def add_reface_db(self, bv: BinaryView) -> None:
         """